@@ -0,0 +1,82 @@
+"""Admission control: shed low-priority work when the writer falls behind.
+
+Requests are classed, most important first:
+
+0. ``DRIVER_INGEST`` - the driver's fixes, never shed
+1. ``STATE_READ`` - polling endpoints (/bus, /stops, /fleet, ...)
+2. ``STUDENT_INGEST`` - students' fixes
+3. ``ANALYTICS`` - cluster views and exports
+
+The load signal is write queue latency: how long the oldest intent of each
+batch waited before the writer got to it (see writer.py), smoothed and
+decaying back to zero while the writer is idle. Each doubling past
+``BUS_ADMISSION_TARGET_MS`` sheds one more class from the bottom:
+
+* over the target: analytics
+* over 2x: student fixes too (deferred - told to report again later)
+* over 4x: state reads too (503 with ``Retry-After``)
+"""
+import math
+import os
+import threading
+import time as time_module
+from typing import Optional
+
+import metrics
+
+DRIVER_INGEST = 0
+STATE_READ = 1
+STUDENT_INGEST = 2
+ANALYTICS = 3
+CLASS_NAMES = ('driver_ingest', 'state_read', 'student_ingest', 'analytics')
+
+TARGET_MS = float(os.environ.get("BUS_ADMISSION_TARGET_MS", "100"))
+SMOOTHING = 0.3   # weight of the newest latency sample
+DECAY_SECONDS = 1.0  # the signal halves roughly every 0.7 s without samples
+RETRY_AFTER = 2.0  # seconds suggested to shed clients
+
+
+class AdmissionController:
+    def __init__(self, target_ms: float = TARGET_MS, clock=time_module.monotonic) -> None:
+        self.target_ms = target_ms
+        self.clock = clock
+        self._delay_ms = 0.0
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _decayed(self, now: float) -> float:
+        return self._delay_ms * math.exp(-(now - self._updated) / DECAY_SECONDS)
+
+    def observe_delay(self, delay_ms: float, now: Optional[float] = None) -> None:
+        """Feed one queue latency sample (the writer calls this per batch)"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            self._delay_ms = SMOOTHING * delay_ms + (1 - SMOOTHING) * self._decayed(now)
+            self._updated = now
+        metrics.set_gauge('admission.delay_ms', round(self._delay_ms, 1))
+
+    def delay_ms(self, now: Optional[float] = None) -> float:
+        return self._decayed(self.clock() if now is None else now)
+
+    def level(self, now: Optional[float] = None) -> int:
+        """0 when healthy, up to 3 (only driver fixes admitted)"""
+        delay = self.delay_ms(now)
+        if delay <= self.target_ms:
+            return 0
+        return min(3, 1 + int(math.log2(delay / self.target_ms)))
+
+    def admit(self, request_class: int, now: Optional[float] = None) -> bool:
+        if request_class == DRIVER_INGEST:
+            return True
+        if request_class <= 3 - self.level(now):
+            return True
+        metrics.incr(f'admission.shed.{CLASS_NAMES[request_class]}')
+        return False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._delay_ms = 0.0
+            self._updated = self.clock()
+
+
+admission = AdmissionController()
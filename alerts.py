@@ -0,0 +1,315 @@
+"""Arrival alerts: "tell me when bus S1/A is N stops or M minutes from stop X".
+
+Subscriptions are indexed by ``(bus_id, target stop seq)``. Inside each
+bucket they sit in two heaps, ordered by how early they want to hear - the
+largest ``stops_before`` / ``minutes_before`` first - so a match pops
+exactly the subscriptions that are due and leaves the rest untouched.
+
+Nothing is evaluated per GPS fix in general: ``on_stop()`` runs when a bus
+arrives at or leaves a stop and ``on_position()`` when the bus itself moves
+(an ETA update). Both only look at the targets subscribed for that bus, and
+return immediately for buses nobody watches.
+
+Subscriptions and fired alerts are shared between gunicorn workers through
+the main database (``alert_subscriptions`` / ``alert_deliveries``); the
+heaps are each worker's index over them, kept current by ``sync()``.
+Whichever worker sees the bus reach the threshold fires the subscription;
+deleting its row is the claim, so two workers seeing the same arrival
+deliver one alert.
+
+Each subscription fires once. ``poll()`` pushes fired alerts to the
+subscriber's ``GET /alerts/stream`` connections (server-sent events) open in
+this worker; alerts no stream has received are held until one connects.
+"""
+import heapq
+import json
+import os
+import queue
+import threading
+import time as time_module
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import db as dbm
+import metrics
+from writer import writes
+
+ETA_SPEED = 6.0  # m/s, average bus speed including traffic, for rough ETAs
+ALERT_TTL = 3 * 3600.0  # seconds an unfired subscription is kept
+MAX_PENDING = 20  # newest held alerts handed to a stream when it opens
+# Each open stream holds a server thread; past this many per worker,
+# clients poll take_held() instead
+MAX_STREAMS = int(os.environ.get("BUS_ALERT_MAX_STREAMS", "8"))
+
+
+class Subscription:
+    __slots__ = ('id', 'user_id', 'bus_id', 'stop_seq', 'stop_name', 'stops_before',
+                 'minutes_before', 'created', 'fired')
+
+    def __init__(self, sub_id: int, user_id: str, bus_id: str, stop_seq: int, stop_name: str,
+                 stops_before: Optional[int], minutes_before: Optional[float], created: float) -> None:
+        self.id = sub_id
+        self.user_id = user_id
+        self.bus_id = bus_id
+        self.stop_seq = stop_seq
+        self.stop_name = stop_name
+        self.stops_before = stops_before
+        self.minutes_before = minutes_before
+        self.created = created
+        self.fired = False
+
+    @classmethod
+    def from_row(cls, row: Any) -> "Subscription":
+        return cls(row['id'], row['user_id'], row['bus_id'], row['stop_seq'], row['stop_name'],
+                   row['stops_before'], row['minutes_before'], row['created'])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'bus_id': self.bus_id, 'stop_seq': self.stop_seq,
+                'stop_name': self.stop_name, 'stops_before': self.stops_before,
+                'minutes_before': self.minutes_before}
+
+
+class _Bucket:
+    """Subscriptions for one (bus, target stop)"""
+    __slots__ = ('by_stops', 'by_minutes', 'live')
+
+    def __init__(self) -> None:
+        self.by_stops: List[Tuple[int, int, Subscription]] = []       # (-stops_before, id, sub)
+        self.by_minutes: List[Tuple[float, int, Subscription]] = []   # (-minutes_before, id, sub)
+        self.live = 0
+
+
+class AlertMatcher:
+    def __init__(self, speed: float = ETA_SPEED, ttl: float = ALERT_TTL) -> None:
+        self.speed = speed
+        self.ttl = ttl
+        self._subs: Dict[int, Subscription] = {}
+        self._buckets: Dict[Tuple[str, int], _Bucket] = {}
+        self._targets: Dict[str, Set[int]] = {}  # bus -> target stop seqs
+        self._streams: Dict[str, List["queue.Queue[Dict[str, Any]]"]] = {}
+        self._cursor = 0  # last alert_deliveries id poll() has dispatched
+        self._route: Optional[Tuple[Any, Dict[int, float]]] = None  # (stops, seq -> meters from start)
+        self._lock = threading.RLock()
+
+    # --- route geometry -----------------------------------------------------
+    def _along(self) -> Dict[int, float]:
+        """Distance along the route of every stop, rebuilt when the stop list changes"""
+        stops = dbm.get_stops()
+        if self._route is None or self._route[0] is not stops:
+            along: Dict[int, float] = {}
+            total, prev = 0.0, None
+            for stop in stops:
+                if prev is not None:
+                    total += dbm.calculate_distance(prev['lat'], prev['lon'], stop['lat'], stop['lon'])
+                along.setdefault(stop['seq'], total)
+                prev = stop
+            self._route = (stops, along)
+        return self._route[1]
+
+    # --- subscriptions ----------------------------------------------------
+    def subscribe(self, user_id: str, bus_id: str, stop: Any, stops_before: Optional[int] = None,
+                  minutes_before: Optional[float] = None, now: Optional[float] = None) -> Subscription:
+        """Watch for ``bus_id`` nearing ``stop`` (a stops row; several stops can share a seq)"""
+        if stops_before is None and minutes_before is None:
+            raise ValueError("Give stops_before and/or minutes_before")
+        stop_seq = stop['seq']
+        now = time_module.time() if now is None else now
+        sub_id = writes.call_shard(dbm.DB_PATH, dbm.insert_alert_subscription, user_id, bus_id, stop_seq,
+                                   stop['name'], stops_before, minutes_before, now)
+        sub = Subscription(sub_id, user_id, bus_id, stop_seq, stop['name'], stops_before, minutes_before, now)
+        with self._lock:
+            self._index(sub)
+        metrics.incr('alerts.subscribed')
+
+        # The bus may already be close enough
+        state = dbm.get_bus_state(bus_id)
+        if state is not None:
+            self._match(bus_id, state['stop_index'], state['lat'], state['lon'], now, targets=(stop_seq,))
+        return sub
+
+    def cancel(self, sub_id: int, user_id: Optional[str] = None) -> bool:
+        if not writes.call_shard(dbm.DB_PATH, dbm.delete_alert_subscription, sub_id, user_id):
+            return False
+        with self._lock:
+            sub = self._subs.get(sub_id)
+            if sub is not None:
+                self._retire(sub)
+        return True
+
+    def for_user(self, user_id: str) -> List[Subscription]:
+        rows, _ = dbm.get_alert_subscriptions(user_id)
+        return [Subscription.from_row(row) for row in rows]
+
+    def sync(self) -> int:
+        """Mirror subscriptions made, fired or cancelled in other workers; returns the number of changes"""
+        rows, last_id = dbm.get_alert_subscriptions()
+        live = {row['id']: row for row in rows}
+        changed = 0
+        with self._lock:
+            # Ids above last_id were handed out after the read (by this worker)
+            for sub in [s for s in self._subs.values() if s.id <= last_id and s.id not in live]:
+                self._retire(sub)
+                changed += 1
+            for sub_id, row in live.items():
+                if sub_id not in self._subs:
+                    self._index(Subscription.from_row(row))
+                    changed += 1
+        return changed
+
+    def _index(self, sub: Subscription) -> None:
+        self._subs[sub.id] = sub
+        bucket = self._buckets.get((sub.bus_id, sub.stop_seq))
+        if bucket is None:
+            bucket = self._buckets[(sub.bus_id, sub.stop_seq)] = _Bucket()
+            self._targets.setdefault(sub.bus_id, set()).add(sub.stop_seq)
+        if sub.stops_before is not None:
+            heapq.heappush(bucket.by_stops, (-sub.stops_before, sub.id, sub))
+        if sub.minutes_before is not None:
+            heapq.heappush(bucket.by_minutes, (-sub.minutes_before, sub.id, sub))
+        bucket.live += 1
+
+    def _retire(self, sub: Subscription) -> None:
+        # Heap entries are dropped lazily; the fired flag marks them dead
+        sub.fired = True
+        self._subs.pop(sub.id, None)
+        key = (sub.bus_id, sub.stop_seq)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.live -= 1
+            if bucket.live <= 0:
+                del self._buckets[key]
+                targets = self._targets.get(sub.bus_id)
+                if targets is not None:
+                    targets.discard(sub.stop_seq)
+                    if not targets:
+                        del self._targets[sub.bus_id]
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Drop subscriptions that never fired, and alerts, older than the TTL (workers follow on sync)"""
+        cutoff = (time_module.time() if now is None else now) - self.ttl
+        return writes.call_shard(dbm.DB_PATH, dbm.prune_alerts, cutoff)
+
+    def clear(self) -> None:
+        """Forget this worker's index (the shared tables are left alone)"""
+        with self._lock:
+            self._subs.clear()
+            self._buckets.clear()
+            self._targets.clear()
+            self._route = None
+
+    # --- evaluation -------------------------------------------------------
+    def on_stop(self, bus_id: str, stop_index: int, now: Optional[float] = None) -> List[Subscription]:
+        """A bus arrived at / left ``stop_index``"""
+        if bus_id not in self._targets:
+            return []
+        stop = dbm.current_stop_for_index(stop_index)
+        lat, lon = (stop['lat'], stop['lon']) if stop else (None, None)
+        return self._match(bus_id, stop_index, lat, lon, time_module.time() if now is None else now)
+
+    def on_position(self, bus_id: str, stop_index: int, lat: float, lon: float,
+                    now: Optional[float] = None) -> List[Subscription]:
+        """The bus moved; re-check the minutes-based subscriptions against the new ETA"""
+        if bus_id not in self._targets:
+            return []
+        return self._match(bus_id, stop_index, lat, lon, time_module.time() if now is None else now)
+
+    def eta_seconds(self, stop_index: int, lat: Optional[float], lon: Optional[float],
+                    target: int) -> Optional[float]:
+        """Rough seconds from this position (last passed stop ``stop_index``) to stop ``target``"""
+        along = self._along()
+        if target not in along or stop_index not in along:
+            return None
+        nxt = stop_index + 1
+        if lat is None or nxt not in along or target <= stop_index:
+            meters = along[target] - along[stop_index]
+        else:
+            stop = dbm.current_stop_for_index(nxt)
+            meters = dbm.calculate_distance(lat, lon, stop['lat'], stop['lon']) + along[target] - along[nxt]
+        return max(meters, 0.0) / self.speed
+
+    def _match(self, bus_id: str, stop_index: int, lat: Optional[float], lon: Optional[float],
+               now: float, targets: Optional[Tuple[int, ...]] = None) -> List[Subscription]:
+        fired: List[Subscription] = []
+        with self._lock:
+            for target in list(targets or self._targets.get(bus_id, ())):
+                bucket = self._buckets.get((bus_id, target))
+                stops_away = target - stop_index
+                if bucket is None or stops_away < 0:
+                    continue  # passed already; waits for the next trip
+                heap = bucket.by_stops
+                while heap and (heap[0][2].fired or -heap[0][0] >= stops_away):
+                    sub = heapq.heappop(heap)[2]
+                    if not sub.fired:
+                        fired.append(sub)
+                        self._retire(sub)
+                heap = bucket.by_minutes
+                if heap and bucket.live > 0:
+                    eta = self.eta_seconds(stop_index, lat, lon, target)
+                    while eta is not None and heap and (heap[0][2].fired or -heap[0][0] * 60 >= eta):
+                        sub = heapq.heappop(heap)[2]
+                        if not sub.fired:
+                            fired.append(sub)
+                            self._retire(sub)
+        for sub in fired:
+            eta = self.eta_seconds(stop_index, lat, lon, sub.stop_seq)
+            alert = dict(sub.to_dict(), stops_away=sub.stop_seq - stop_index,
+                         eta_s=round(eta) if eta is not None else None, t=now)
+            writes.submit_shard(dbm.DB_PATH, dbm.fire_alert, sub.id, sub.user_id, json.dumps(alert), now)
+            metrics.incr('alerts.fired')
+        return fired
+
+    # --- delivery ---------------------------------------------------------
+    def poll(self) -> int:
+        """Push alerts fired by any worker to the streams open in this one; returns how many went out"""
+        delivered: List[int] = []
+        with self._lock:
+            if not self._streams:
+                return 0
+            for row in dbm.get_alert_deliveries(self._cursor):
+                self._cursor = row['id']
+                streams = self._streams.get(row['user_id'])
+                if streams:
+                    alert = json.loads(row['payload'])
+                    for stream in streams:
+                        stream.put(alert)
+                    delivered.append(row['id'])
+        if delivered:
+            writes.submit_shard(dbm.DB_PATH, dbm.mark_alerts_delivered, delivered)
+        return len(delivered)
+
+    def open_stream(self, user_id: str) -> Optional["queue.Queue[Dict[str, Any]]"]:
+        """A queue receiving this user's alerts, starting with any held ones; None at MAX_STREAMS"""
+        stream: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        with self._lock:
+            if sum(len(streams) for streams in self._streams.values()) >= MAX_STREAMS:
+                metrics.incr('alerts.streams_refused')
+                return None
+            if not self._streams:
+                # poll() skipped everything while no stream was open here;
+                # older alerts are picked up below, per user, as held ones
+                self._cursor = dbm.last_alert_delivery_id()
+            held = dbm.get_undelivered_alerts(user_id, self._cursor, MAX_PENDING)
+            for row in held:
+                stream.put(json.loads(row['payload']))
+            self._streams.setdefault(user_id, []).append(stream)
+        if held:
+            writes.submit_shard(dbm.DB_PATH, dbm.mark_alerts_delivered, [row['id'] for row in held])
+        metrics.incr('alerts.streams_opened')
+        return stream
+
+    def take_held(self, user_id: str) -> List[Dict[str, Any]]:
+        """The user's held alerts, marked delivered (for clients polling instead of streaming)"""
+        held = dbm.get_undelivered_alerts(user_id, dbm.last_alert_delivery_id(), MAX_PENDING)
+        if held:
+            writes.submit_shard(dbm.DB_PATH, dbm.mark_alerts_delivered, [row['id'] for row in held])
+        return [json.loads(row['payload']) for row in held]
+
+    def close_stream(self, user_id: str, stream: "queue.Queue[Dict[str, Any]]") -> None:
+        with self._lock:
+            streams = self._streams.get(user_id, [])
+            if stream in streams:
+                streams.remove(stream)
+            if not streams:
+                self._streams.pop(user_id, None)
+
+
+alerts = AlertMatcher()
@@ -1,13 +1,35 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
-from typing import Dict, Any
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, g
+from typing import Dict, Any, Optional, Tuple
 from functools import wraps
 from datetime import timedelta, datetime, time
 import db as dbm
-import threading
+import codec
+import export
+import history
+import migrations
+import tokens
+import metrics
+from writer import writes, QueueFull
+from ratelimit import limiter
+from cadence import coverage, report_hint, NORMAL_MS, SLOW_MS, MAX_SILENCE_MS
+from sampler import sampler
+from scheduler import scheduler, Job
+from plausibility import plausibility
+from geofence import geofences
+from respcache import responses
+import respcache
+from alerts import alerts, ETA_SPEED
+from admission import admission, STATE_READ, STUDENT_INGEST, ANALYTICS
+import admission as admission_module
+from snapshot import snapshots, JournaledDict
+from arbitration import arbiter, DRIVER, STUDENT, MANUAL
+import clustering
+import hashlib
+import math
+import queue
 import time as time_module
 
 import os
-from datetime import datetime, timezone, timedelta
 
 app = Flask(__name__)
 
@@ -26,15 +48,19 @@ app.config.update(
     SESSION_COOKIE_NAME='bus_tracker_session'
 )
 
-# Track active sessions
-active_sessions = {}
+# Track active sessions, keyed by a digest of the session id so snapshots
+# and journals never hold an id that could be replayed as a cookie
+active_sessions = JournaledDict('active_sessions', snapshots)
+
+# AUTH_MODE=token replaces server-side sessions with signed tokens (tokens.py)
+AUTH_MODE = os.environ.get("AUTH_MODE", "session")
+TOKEN_COOKIE_NAME = 'bus_tracker_token'
+signer = tokens.TokenSigner(app.secret_key,
+                            revocations=tokens.revocations if tokens.REVOCATION_ENABLED else None)
 
 BUS_ID = "S1/A"  # default bus id
 QUORUM = 1      # change quorum here if needed
 
-# Track last driver location update time
-last_driver_update = {}
-
 # Dummy user database - In a real app, this would be in a database
 USERS = {
     "driver1": {
@@ -61,15 +87,37 @@ from uuid import uuid4
 def generate_session_id():
     return str(uuid4())
 
+def session_key(session_id: Optional[str]) -> Optional[str]:
+    """Key of a session in active_sessions"""
+    return hashlib.sha256(session_id.encode()).hexdigest() if session_id else None
+
+def load_user() -> Optional[Dict[str, Any]]:
+    """The logged-in user (username, role, bus_id), or None"""
+    if AUTH_MODE == "token":
+        # Verified once per request, from the token alone
+        if 'user' not in g:
+            token = request.cookies.get(TOKEN_COOKIE_NAME)
+            g.user = signer.verify(token) if token else None
+        return g.user
+    key = session_key(session.get('session_id'))
+    if not key or key not in active_sessions:
+        return None
+    return active_sessions[key]
+
+def current_user() -> Dict[str, Any]:
+    return load_user() or {}
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        session_id = session.get('session_id')
-        if not session_id or session_id not in active_sessions:
-            session.clear()
+        user = load_user()
+        if user is None:
+            if AUTH_MODE != "token":
+                session.clear()
             return redirect(url_for('login'))
-        # Update session data from active_sessions
-        session.update(active_sessions[session_id])
+        if AUTH_MODE != "token":
+            # Update session data from active_sessions
+            session.update(user)
         return f(*args, **kwargs)
     return decorated_function
 
@@ -77,23 +125,52 @@ def role_required(role):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            session_id = session.get('session_id')
-            if not session_id or session_id not in active_sessions:
-                session.clear()
+            user = load_user()
+            if user is None:
+                if AUTH_MODE != "token":
+                    session.clear()
                 return redirect(url_for('login'))
-            user_data = active_sessions[session_id]
-            if user_data.get('role') != role:
+            if user.get('role') != role:
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+def rate_limited(f):
+    """Charge a write request to the caller's token buckets (429 when empty)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        user = current_user()
+        bus_id = data.get("bus_id") or user.get('bus_id') or BUS_ID
+        allowed, retry_after, _ = limiter.check(user.get('username'), user.get('role'), bus_id)
+        if not allowed:
+            return jsonify({"error": "Too many requests", "retry_after": retry_after}), 429
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admitted(request_class: int):
+    """Shed the request with 503 while the server is too loaded for its class (see admission.py)"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not admission.admit(request_class):
+                retry_after = admission_module.RETRY_AFTER
+                response = jsonify({"error": "Server overloaded", "retry_after": retry_after})
+                response.headers['Retry-After'] = str(int(retry_after))
+                return response, 503
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 def update_session_data():
     """Update active_sessions with current session data"""
-    session_id = session.get('session_id')
-    if session_id and session_id in active_sessions:
+    key = session_key(session.get('session_id'))
+    if key and key in active_sessions:
         # Update stored session data
-        active_sessions[session_id].update({
+        active_sessions[key].update({
             'username': session.get('username'),
             'role': session.get('role'),
             'bus_id': session.get('bus_id'),
@@ -101,41 +178,92 @@ def update_session_data():
         })
 
 init_done = False
-bus_status: Dict[str, str] = {}  # e.g., { BUS_ID: "departing" }
+bus_status: Dict[str, str] = JournaledDict('bus_status', snapshots)  # e.g., { BUS_ID: "departing" }
+# Trip id of the last reset this worker's tracking state reflects, per bus
+reset_trips: Dict[str, int] = JournaledDict('reset_trips', snapshots)
 
 def reset_bus_to_start():
-    """Reset bus to starting stop - used for daily reset and manual reset"""
-    dbm.reset_bus_to_starting_stop(BUS_ID)
-    bus_status.pop(BUS_ID, None)
-    last_driver_update.pop(BUS_ID, None)
+    """Reset bus to starting stop - used for the manual reset"""
+    state = writes.call(BUS_ID, dbm.reset_bus_to_starting_stop, BUS_ID)
+    reset_bus_memory(BUS_ID, state.get('trip_id'))
     app.logger.info(f"Bus {BUS_ID} reset to starting stop")
 
-def daily_reset_scheduler():
-    """Background thread that resets the bus at midnight every day"""
-    while True:
-        now = datetime.now()
-        # Calculate time until next midnight
-        tomorrow = now + timedelta(days=1)
-        midnight = datetime.combine(tomorrow.date(), time(0, 0, 0))
-        seconds_until_midnight = (midnight - now).total_seconds()
-        
-        # Sleep until midnight
-        time_module.sleep(seconds_until_midnight)
-        
-        # Reset the bus
-        reset_bus_to_start()
-        app.logger.info("Daily automatic reset completed at midnight")
+def reset_bus_memory(bus_id: str, trip_id: Optional[int] = None) -> None:
+    """Forget this process's tracking of a reset bus: status, GPS freshness, stop occupancy"""
+    if trip_id is not None:
+        reset_trips[bus_id] = trip_id
+    bus_status.pop(bus_id, None)
+    forget_gps(bus_id, DRIVER)
+    geofences.forget(bus_id)
+    alerts.on_stop(bus_id, 0)
+
+def record_stop_event(bus_id: str, stop_index: int, event: str, source: Optional[str],
+                      now: Optional[float] = None) -> None:
+    """Log an arrival/departure and check the arrival alerts watching this bus"""
+    writes.submit(bus_id, dbm.record_stop_event, bus_id, stop_index, event, source)
+    alerts.on_stop(bus_id, stop_index, now)
+
+def daily_reset() -> None:
+    """Midnight reset of the bus in the database (one worker)"""
+    state = writes.call(BUS_ID, dbm.reset_bus_to_starting_stop, BUS_ID)
+    reset_bus_memory(BUS_ID, state.get('trip_id'))
+    app.logger.info("Daily automatic reset completed at midnight")
+
+def sync_bus_reset() -> None:
+    """Apply a reset committed by another worker to this worker's in-memory tracking.
+
+    Every reset bumps the bus's trip id, so the tracking state is only
+    dropped once the new row is on disk - never before the reset commits.
+    """
+    trip_id = dbm.get_trip_id(BUS_ID)
+    seen = reset_trips.get(BUS_ID)
+    if seen is None:
+        reset_trips[BUS_ID] = trip_id
+    elif trip_id != seen:
+        # Reload the reset row now rather than at the next bus_state_sync
+        dbm.invalidate_bus_state(BUS_ID)
+        reset_bus_memory(BUS_ID, trip_id)
+        app.logger.info(f"Bus {BUS_ID} was reset by another worker (trip {trip_id})")
+
+def downsample_history() -> None:
+    deleted = dbm.downsample_location_history(keep_hours=24)
+    metrics.incr('scheduler.downsample_history.rows_deleted', deleted)
+
+def archive_history() -> None:
+    """Roll closed, already downsampled days out of the live database (see history.py)"""
+    for day in history.roll_closed_days():
+        app.logger.info(f"History for {day} moved to {history.archive_path(day)}")
 
 @app.before_request
 def ensure_init() -> None:
+    # The schema is migrated once at startup (wsgi.py); only the scheduler
+    # thread starts here, inside the worker process that serves requests
     global init_done
     if not init_done:
-        dbm.init_db()
-        # Start daily reset scheduler in background thread
-        reset_thread = threading.Thread(target=daily_reset_scheduler, daemon=True)
-        reset_thread.start()
+        if os.environ.get("BUS_SCHEDULER", "1") == "1":
+            scheduler.start()
         init_done = True
 
+@app.cli.command("migrate")
+def migrate_command() -> None:
+    """Apply pending schema migrations"""
+    for path, count in migrations.migrate_all().items():
+        print(f"{path}: {count} migration(s) applied")
+
+@app.cli.command("seed")
+def seed_command() -> None:
+    """Reseed stops, reset the default bus and clear confirmations"""
+    migrations.migrate_all()
+    dbm.seed_database()
+    print("Stops reseeded and default bus reset")
+
+@app.cli.command("archive")
+def archive_command() -> None:
+    """Roll closed days of GPS history into the archive now"""
+    migrations.migrate_all()
+    rolled = history.roll_closed_days()
+    print(f"Archived {len(rolled)} day(s): {', '.join(rolled) or 'none due'}")
+
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -144,6 +272,14 @@ def login():
         password = request.form['password']
         
         user = USERS.get(username)
+        if user and user['password'] == password and AUTH_MODE == "token":
+            bus_id = user.get('bus_id', BUS_ID) if user['role'] == 'driver' else None
+            target = 'driver_page' if user['role'] == 'driver' else 'student_page'
+            response = redirect(url_for(target))
+            response.set_cookie(TOKEN_COOKIE_NAME, signer.issue(username, user['role'], bus_id),
+                                max_age=int(signer.ttl), secure=is_production, httponly=True,
+                                samesite='Lax')
+            return response
         if user and user['password'] == password:
             # Generate new session
             session.permanent = True
@@ -165,7 +301,7 @@ def login():
                 session_data['bus_id'] = bus_id
             
             # Store in active sessions
-            active_sessions[session_id] = session_data
+            active_sessions[session_key(session_id)] = session_data
             
             if user['role'] == 'driver':
                 return redirect(url_for('driver_page'))
@@ -178,9 +314,16 @@ def login():
 
 @app.route('/logout')
 def logout():
-    session_id = session.get('session_id')
-    if session_id:
-        active_sessions.pop(session_id, None)
+    if AUTH_MODE == "token":
+        user = load_user()
+        if user is not None:
+            signer.revoke(user)
+        response = redirect(url_for('login'))
+        response.delete_cookie(TOKEN_COOKIE_NAME)
+        return response
+    key = session_key(session.get('session_id'))
+    if key:
+        active_sessions.pop(key, None)
     session.clear()
     return redirect(url_for('login'))
 
@@ -196,24 +339,92 @@ def cleanup_inactive_sessions():
     for sid in inactive_sessions:
         active_sessions.pop(sid, None)
 
+# Maintenance jobs (see scheduler.py). Exclusive jobs run in one worker per
+# slot; jobs touching this process's memory (sessions, the reset bus's
+# tracking state) run in every worker. Jobs that can run for minutes go on
+# the long lane so the frequent sync and delivery jobs keep their cadence.
+scheduler.add(Job("daily_reset", daily_reset, daily=time(0, 0)))
+# Every worker follows the reset once it has committed (the trip id moves)
+BUS_RESET_SYNC_SECONDS = float(os.environ.get("BUS_RESET_SYNC_SECONDS", "1"))
+scheduler.add(Job("bus_reset_sync", sync_bus_reset, every=BUS_RESET_SYNC_SECONDS, exclusive=False))
+scheduler.add(Job("session_cleanup", cleanup_inactive_sessions, every=300, exclusive=False))
+scheduler.add(Job("downsample_history", downsample_history, daily=time(2, 0), lane="long"))
+if history.ARCHIVE_DIR:
+    # After downsampling, before the vacuum that shrinks the live files
+    scheduler.add(Job("archive_history", archive_history, daily=time(2, 30), lane="long"))
+scheduler.add(Job("analyze", dbm.optimize_databases, every=3600, lane="long"))
+scheduler.add(Job("vacuum", lambda: dbm.optimize_databases(vacuum=True), daily=time(3, 0), lane="long"))
+# Other workers write bus_state too; reload their changes into this mirror
+BUS_STATE_SYNC_SECONDS = float(os.environ.get("BUS_STATE_SYNC_SECONDS", "2"))
+if BUS_STATE_SYNC_SECONDS > 0:
+    scheduler.add(Job("bus_state_sync", dbm.refresh_bus_states, every=BUS_STATE_SYNC_SECONDS, exclusive=False))
+if hasattr(limiter.store, 'prune'):
+    scheduler.add(Job("ratelimit_prune", limiter.store.prune, every=3600))
+def log_source_change(change) -> None:
+    app.logger.info(f"Bus {change.bus_id} GPS source {change.previous} -> {change.source}")
+
+arbiter.subscribe(log_source_change)
+scheduler.add(Job("alerts_prune", alerts.prune, every=300))
+# Subscriptions and fired alerts are shared through the main database; each
+# worker mirrors the subscriptions it matches against and pushes fired
+# alerts to the streams it holds
+ALERT_SYNC_SECONDS = float(os.environ.get("BUS_ALERT_SYNC_SECONDS", "2"))
+ALERT_POLL_SECONDS = float(os.environ.get("BUS_ALERT_POLL_SECONDS", "1"))
+scheduler.add(Job("alerts_sync", alerts.sync, every=ALERT_SYNC_SECONDS, exclusive=False))
+scheduler.add(Job("alerts_deliver", alerts.poll, every=ALERT_POLL_SECONDS, exclusive=False))
+# Announce GPS sources going stale even when nobody asks about the bus
+scheduler.add(Job("gps_source_sweep", arbiter.sweep, every=5, exclusive=False))
+# Pick up tokens revoked by logouts in other workers
+AUTH_REVOCATION_SYNC_SECONDS = float(os.environ.get("AUTH_REVOCATION_SYNC_SECONDS", "5"))
+if AUTH_MODE == "token" and signer.revocations is not None:
+    scheduler.add(Job("token_revocation_sync", signer.revocations.refresh,
+                      every=AUTH_REVOCATION_SYNC_SECONDS, exclusive=False))
+    scheduler.add(Job("token_revocation_prune", signer.revocations.prune, every=3600))
+
 # Add before_request handler to update session activity
 @app.before_request
 def before_request():
-    global init_done
-    if not init_done:
-        dbm.init_db()
-        init_done = True
-    
-    # Update last active time for current session
-    if request.endpoint != 'static':
+    # Update last active time for current session (tokens have no server-side state)
+    if request.endpoint != 'static' and AUTH_MODE != "token":
         update_session_data()
-        cleanup_inactive_sessions()
+
+def respond(payload: Dict[str, Any], status: int = 200):
+    """JSON response, or a compact encoding if the client asked for one"""
+    mimetype = codec.negotiate(request.accept_mimetypes)
+    if mimetype is None:
+        return app.response_class(respcache.dumps(payload), status=status, mimetype=respcache.JSON_MIMETYPE)
+    body, mimetype = codec.encode_response(payload, mimetype)
+    return app.response_class(body, status=status, mimetype=mimetype)
+
+def cached_response(endpoint: str, bus_id: str, version: Tuple[Any, ...], build, negotiate: bool = True):
+    """Like respond(), but reuses the encoded body while ``version`` is unchanged"""
+    mimetype = codec.negotiate(request.accept_mimetypes) if negotiate else None
+    key = (endpoint, bus_id, mimetype)
+    cached = responses.get(key, version)
+    if cached is None:
+        if mimetype is None:
+            cached = responses.put(key, version, respcache.dumps(build()), respcache.JSON_MIMETYPE)
+        else:
+            cached = responses.put(key, version, *codec.encode_response(build(), mimetype))
+    return app.response_class(cached[0], mimetype=cached[1])
+
+@app.errorhandler(QueueFull)
+def write_queue_full(e):
+    """Backpressure: the single writer is saturated, ask the client to retry"""
+    return jsonify({"error": "Server busy", "retry_after": 1.0}), 429
+
+@app.get("/metrics")
+@login_required
+@role_required('driver')
+def get_metrics():
+    return jsonify(metrics.snapshot())
 
 @app.get("/")
 def home():
-    if 'username' not in session:
+    user = load_user()
+    if user is None:
         return redirect(url_for('login'))
-    if session['role'] == 'driver':
+    if user['role'] == 'driver':
         return redirect(url_for('driver_page'))
     return redirect(url_for('student_page'))
 
@@ -221,7 +432,7 @@ def home():
 @login_required
 @role_required('driver')
 def driver_page():
-    return render_template("driver.html", bus_id=session.get('bus_id', BUS_ID))
+    return render_template("driver.html", bus_id=current_user().get('bus_id') or BUS_ID)
 
 @app.get("/student")
 @login_required
@@ -230,15 +441,277 @@ def student_page():
     return render_template("student.html", bus_id=BUS_ID)
 
 
-# Rate limiting for location updates (per user)
-last_update_time = {}
-MIN_UPDATE_INTERVAL = 1.0  # seconds
+# Student location sharing toggle (per bus)
+student_location_enabled = JournaledDict('student_location_enabled', snapshots)  # {bus_id: True/False}
 
-# Track last student location update time
-last_student_update = {}
+def process_location_fix(user_id: str, user_type: str, data: Dict[str, Any],
+                         now: Optional[datetime] = None) -> Tuple[Any, int]:
+    """Run one GPS fix through rate limiting, storage and stop detection.
 
-# Student location sharing toggle (per bus)
-student_location_enabled = {}  # {bus_id: True/False}
+    This is the whole ingest path behind POST /location/share, kept free of
+    request/session access so the replay tooling can drive it without HTTP.
+    Returns the response payload and HTTP status code.
+    """
+    # Replays pass their own clock; live requests use the arbiter's monotonic one
+    clock_now = None if now is None else now.timestamp()
+    if now is None:
+        now = datetime.now()
+
+    # Parse and validate input
+    try:
+        bus_id = data.get("bus_id", BUS_ID)
+        lat = float(data.get("lat"))
+        lon = float(data.get("lon"))
+        accuracy = float(data.get("accuracy", 20.0))
+
+        # Basic validation
+        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180) or accuracy <= 0:
+            return {"error": "Invalid coordinates or accuracy"}, 400
+
+    except (ValueError, TypeError):
+        return {"error": "Invalid location data"}, 400
+
+    # Check if student location sharing is enabled for this bus
+    if user_type == 'student':
+        if not student_location_enabled.get(bus_id, False):
+            return {"error": "Student location sharing is disabled"}, 403
+
+    # Under overload student fixes are deferred first; the driver's always get in
+    if user_type == 'student' and not admission.admit(STUDENT_INGEST):
+        return {
+            "bus_id": bus_id,
+            "shed": True,
+            "updated_bus": False,
+            "next_report_ms": SLOW_MS,
+            "min_move_m": 0
+        }, 200
+
+    # Token-bucket rate limiting per user (and per bus for students)
+    allowed, retry_after, _ = limiter.check(user_id, user_type, bus_id, now.timestamp())
+    if not allowed:
+        return {
+            "error": "Too many updates",
+            "retry_after": retry_after,
+            "next_report_ms": int(math.ceil(retry_after * 1000))
+        }, 429
+
+    # Drop implausible fixes (jumps, poor accuracy, off-route, far from the
+    # other students) before they reach the sampler, storage or clustering
+    rejected = plausibility.check(bus_id, user_id, user_type, lat, lon, accuracy, now.timestamp())
+    if rejected:
+        if user_type == 'driver':
+            # The driver's phone is still live; one bad fix must not hand the
+            # bus to student GPS or manual controls
+            arbiter.report(bus_id, DRIVER, clock_now)
+        return {
+            "bus_id": bus_id,
+            "rejected": rejected,
+            "updated_bus": False,
+            "next_report_ms": NORMAL_MS,
+            "min_move_m": 0
+        }, 200
+
+    # Only a rotating quorum of students per bus is stored (see sampler.py);
+    # the others are asked to pause until the next rotation
+    if user_type == 'student' and not sampler.observe(bus_id, user_id, lat, lon, accuracy, now.timestamp()):
+        return {
+            "bus_id": bus_id,
+            "paused": True,
+            "updated_bus": False,
+            "next_report_ms": min(sampler.pause_ms(now.timestamp()), MAX_SILENCE_MS),
+            "min_move_m": 0
+        }, 200
+
+    # Store location in database for all users (fire-and-forget through the writer)
+    writes.submit(bus_id, dbm.update_user_location, bus_id, user_id, user_type, lat, lon, accuracy)
+
+    # While the driver's GPS is live a student fix can't move the bus: keep it
+    # (and the student's freshness) but skip clustering and stop detection
+    if user_type == 'student' and arbiter.is_fresh(bus_id, DRIVER, clock_now):
+        arbiter.report(bus_id, STUDENT, clock_now)
+        metrics.incr('ingest.student_store_only')
+        hint = report_hint(user_type, bus_status.get(bus_id), None, True,
+                           coverage.touch(bus_id, user_id, now.timestamp()))
+        return dict(hint, bus_id=bus_id, user_type=user_type, accuracy=accuracy,
+                    location_source=None, updated_bus=False), 200
+
+    # Keep the bus's live clusters current (see clustering.py)
+    clusterer = clustering.for_bus(bus_id)
+    clusterer.add(user_id, user_type, lat, lon, accuracy, now.timestamp())
+
+    # Priority: Driver GPS > Student GPS > Manual controls (see arbitration.py).
+    # This fix positions the bus only if its source is the active one.
+    source = DRIVER if user_type == 'driver' else STUDENT
+    should_update_bus = arbiter.report(bus_id, source, clock_now) == source
+    location_source = source if should_update_bus else None
+
+    # Update bus position if this is the authoritative source
+    if should_update_bus:
+
+        # Students position the bus by their majority cluster when there is one
+        if location_source == 'student':
+            majority = clusterer.majority()
+            if majority:
+                lat, lon = majority['center_lat'], majority['center_lon']
+
+        # Stop arrivals and departures come from the geofence engine, which
+        # applies entry/exit hysteresis per bus (see geofence.py)
+        events = geofences.evaluate(bus_id, lat, lon, now.timestamp())
+        stop_fence = geofences.nearest(bus_id, lat, lon, kind='stop')
+
+        current_state = dbm.get_bus_state(bus_id)
+        previous_status = bus_status.get(bus_id)
+
+        if stop_fence:
+            # Inside a stop's fence - snap to stop coordinates for clean positioning
+            state = writes.call(bus_id, dbm.set_bus_to_stop, bus_id, stop_fence.attrs['seq'])
+            bus_status[bus_id] = "arrived"
+        else:
+            # Not at any stop - update to exact GPS coordinates
+            state = writes.call(bus_id, dbm.update_bus_location, bus_id, lat, lon)
+            bus_status[bus_id] = "departing"
+
+        for event in events:
+            if event.fence.kind == 'stop' and event.kind in ('enter', 'exit'):
+                action = "arrived at" if event.kind == 'enter' else "departing from"
+                app.logger.info(f"Bus {bus_id} {action} stop {event.fence.name}")
+
+        # Keep a timeline of arrivals/departures for history and exports
+        if current_state and state:
+            transition = (bus_status.get(bus_id), state.get('stop_index'))
+            if transition != (previous_status, current_state['stop_index']):
+                record_stop_event(bus_id, transition[1], transition[0], location_source, now.timestamp())
+            else:
+                # Same stop, new position: only the ETAs changed
+                alerts.on_position(bus_id, state['stop_index'], lat, lon, now.timestamp())
+
+    # Get updated state and stop info
+    state = dbm.get_bus_state(bus_id)
+    if state:
+        state = dict(state)
+        stop = dbm.current_stop_for_index(state.get("stop_index", 0))
+
+        # Tell the client when to report next (see cadence.py)
+        next_stop = dbm.current_stop_for_index(state.get("stop_index", 0) + 1)
+        distance_to_next = (
+            dbm.calculate_distance(lat, lon, next_stop['lat'], next_stop['lon']) if next_stop else None
+        )
+        driver_active = arbiter.is_fresh(bus_id, DRIVER, clock_now)
+        if user_type == 'student':
+            active_students = coverage.touch(bus_id, user_id, now.timestamp())
+        else:
+            active_students = coverage.active(bus_id, now.timestamp())
+        state.update(report_hint(user_type, bus_status.get(bus_id), distance_to_next,
+                                 driver_active, active_students))
+
+        state.update({
+            "stop_name": stop["name"] if stop else None,
+            "stop_id": stop["id"] if stop else None,
+            "status": bus_status.get(bus_id),
+            "accuracy": accuracy,
+            "user_type": user_type,  # Include user type in response
+            "location_source": location_source if should_update_bus else None,
+            "updated_bus": should_update_bus  # Did this update move the bus?
+        })
+
+    return state, 200
+
+# --- Snapshots and warm start (see snapshot.py) ---
+JOURNALED = {d.name: d for d in (bus_status, reset_trips, student_location_enabled, active_sessions)}
+SNAPSHOT_SECONDS = float(os.environ.get("BUS_SNAPSHOT_SECONDS", "10"))
+
+def journal_fence_event(event) -> None:
+    snapshots.journal({'d': 'geofence', 'bus': event.bus_id, 'fence': event.fence.id,
+                       'kind': event.kind, 't': event.t})
+
+geofences.subscribe(journal_fence_event)
+
+def forget_gps(bus_id: str, source: str) -> None:
+    """Drop a GPS source's freshness, e.g. when the driver stops sharing"""
+    arbiter.forget(bus_id, source)
+    snapshots.journal({'d': 'gps_forget', 'bus': bus_id, 'source': source})
+
+def capture_tracking_state(now: Optional[float] = None) -> Dict[str, Any]:
+    """Everything a restarted worker needs to carry on tracking mid-route"""
+    wall = time_module.time() if now is None else now
+    return {
+        'taken_at': wall,
+        'bus_status': dict(bus_status),
+        'student_location_enabled': dict(student_location_enabled),
+        'active_sessions': dict(active_sessions),
+        'gps_ages': arbiter.export(now),
+        'geofences': geofences.export(),
+    }
+
+def take_snapshot(now: Optional[float] = None) -> None:
+    size = snapshots.take(lambda: capture_tracking_state(now))
+    metrics.incr('snapshot.taken')
+    metrics.observe('snapshot.bytes', size)
+
+def warm_start(now: Optional[float] = None) -> bool:
+    """Restore tracking state from every worker's last snapshot and journal, if any"""
+    started = time_module.perf_counter()
+    sections = snapshots.load()
+    if not sections:
+        return False
+    wall = time_module.time() if now is None else now
+    # Sections come least recently written first, so where workers disagree
+    # about a key the one that wrote last wins
+    for values in JOURNALED.values():
+        values.load({})
+    gps_ages: Dict[str, Dict[str, float]] = {}
+    entries = 0
+    for state, journal in sections:
+        for name, values in JOURNALED.items():
+            values.merge(state.get(name, {}))
+        geofences.restore(state.get('geofences', {}))
+        # GPS freshness is snapshotted (fixes are too frequent to journal) and
+        # ages by the downtime; only explicit forgets are journaled. Any
+        # worker's fix counts, so keep the freshest age per source.
+        downtime = max(wall - state['taken_at'], 0.0)
+        for bus, ages in state.get('gps_ages', {}).items():
+            merged = gps_ages.setdefault(bus, {})
+            for source, age in ages.items():
+                merged[source] = min(age + downtime, merged.get(source, age + downtime))
+        for entry in journal:
+            if entry['d'] == 'geofence':
+                geofences.apply(entry['bus'], entry['fence'], entry['kind'], entry['t'])
+            elif entry['d'] == 'gps_forget':
+                gps_ages.get(entry['bus'], {}).pop(entry['source'], None)
+            elif entry['d'] in JOURNALED:
+                JOURNALED[entry['d']].apply(entry)
+        entries += len(journal)
+    arbiter.restore(gps_ages, now)
+    for data in active_sessions.values():
+        if isinstance(data.get('last_active'), str):
+            data['last_active'] = datetime.fromisoformat(data['last_active'])
+    elapsed_ms = (time_module.perf_counter() - started) * 1000
+    metrics.set_gauge('startup.warm_start_ms', elapsed_ms)
+    app.logger.info(f"Warm start: restored {len(bus_status)} bus(es) and {entries} journal "
+                    f"entries from {len(sections)} section(s) in {elapsed_ms:.1f} ms")
+    return True
+
+# Every worker snapshots its own memory, into its own section
+if snapshots.path and SNAPSHOT_SECONDS > 0:
+    scheduler.add(Job("snapshot", take_snapshot, every=SNAPSHOT_SECONDS, exclusive=False))
+# Write out journal lines buffered since a quiet spell's last change
+if snapshots.path and snapshots.flush_every > 0:
+    scheduler.add(Job("journal_flush", snapshots.flush, every=snapshots.flush_every, exclusive=False))
+
+def reset_tracking_state() -> None:
+    """Forget all in-memory tracking state (used by the replay tooling)"""
+    # Forgetting is not a change to journal: load() bypasses the journal
+    bus_status.load({})
+    arbiter.clear()
+    limiter.reset()
+    coverage.clear()
+    sampler.clear()
+    plausibility.clear()
+    geofences.clear()
+    responses.invalidate()
+    alerts.clear()
+    clustering.clear()
+    student_location_enabled.load({})
 
 # --- API ---
 @app.post("/location/share")
@@ -246,138 +719,26 @@ student_location_enabled = {}  # {bus_id: True/False}
 def share_location():
     """Allow both drivers and students to share location"""
     try:
-        user_type = session.get('role')
-        
-        # Rate limiting check
-        user_id = session.get('username')
-        now = datetime.now()
-        if user_id in last_update_time:
-            time_since_last = (now - last_update_time[user_id]).total_seconds()
-            if time_since_last < MIN_UPDATE_INTERVAL:
-                return jsonify({
-                    "error": "Too many updates",
-                    "retry_after": MIN_UPDATE_INTERVAL - time_since_last
-                }), 429
-        
-        # Parse and validate input
-        data = request.get_json(force=True)
+        # JSON, or a compact binary/msgpack fix by Content-Type (see codec.py)
         try:
-            bus_id = data.get("bus_id", BUS_ID)
-            lat = float(data.get("lat"))
-            lon = float(data.get("lon"))
-            accuracy = float(data.get("accuracy", 20.0))
-            
-            # Basic validation
-            if not (-90 <= lat <= 90) or not (-180 <= lon <= 180) or accuracy <= 0:
-                return jsonify({"error": "Invalid coordinates or accuracy"}), 400
-                
-        except (ValueError, TypeError):
-            return jsonify({"error": "Invalid location data"}), 400
-        
-        # Check if student location sharing is enabled for this bus
-        if user_type == 'student':
-            if not student_location_enabled.get(bus_id, False):
-                return jsonify({"error": "Student location sharing is disabled"}), 403
-        
-        # Store location in database for all users
-        dbm.update_user_location(bus_id, user_id, user_type, lat, lon, accuracy)
-        last_update_time[user_id] = now
-        
-        # Update last update time based on user type
-        if user_type == 'driver':
-            last_driver_update[bus_id] = now
-        else:  # student
-            last_student_update[bus_id] = now
-        
-        # Priority logic: Determine if this user should update bus position
-        # Priority: Driver GPS > Student GPS > Manual controls
-        should_update_bus = False
-        location_source = None
-        
-        if user_type == 'driver':
-            # Driver always updates bus position
-            should_update_bus = True
-            location_source = 'driver'
-        elif user_type == 'student':
-            # Student only updates if driver GPS is not active (>30 seconds old)
-            if bus_id not in last_driver_update:
-                should_update_bus = True
-                location_source = 'student'
-            else:
-                seconds_since_driver = (now - last_driver_update[bus_id]).total_seconds()
-                if seconds_since_driver > 30:
-                    should_update_bus = True
-                    location_source = 'student'
-        
-        # Update bus position if this is the authoritative source
-        if should_update_bus:
-            
-            # Check proximity to stops FIRST (within 50 meters)
-            proximity_result = dbm.check_stop_proximity(bus_id, lat, lon, radius_meters=50)
-            
-            current_state = dbm.get_bus_state(bus_id)
-            
-            if proximity_result:
-                # Driver is near a stop (within 50m)
-                stop_id = proximity_result['id']
-                stop_index = proximity_result['seq']
-                
-                # Snap to stop coordinates for clean positioning
-                state = dbm.set_bus_to_stop(bus_id, stop_index)
-                bus_status[bus_id] = "arrived"
-                
-                app.logger.info(f"Bus {bus_id} arrived at stop {proximity_result['name']} (within 50m)")
-            else:
-                # Not near any stop - update to exact GPS coordinates
-                state = dbm.update_bus_location(bus_id, lat, lon)
-                
-                # Determine if departing from current stop
-                if current_state and current_state['stop_index'] is not None:
-                    current_stop = dbm.current_stop_for_index(current_state['stop_index'])
-                    if current_stop:
-                        # Check distance from current stop
-                        distance_from_current = dbm.calculate_distance(
-                            lat, lon, current_stop['lat'], current_stop['lon']
-                        )
-                        
-                        if distance_from_current > 50:
-                            # Moving away from current stop
-                            bus_status[bus_id] = "departing"
-                            # Get next stop for status message
-                            next_stop = dbm.current_stop_for_index(current_state['stop_index'] + 1)
-                            if next_stop:
-                                app.logger.info(f"Bus {bus_id} departing to {next_stop['name']}")
-                        else:
-                            # Still near current stop but not snapped
-                            bus_status[bus_id] = "arrived"
-                    else:
-                        bus_status[bus_id] = "departing"
-                else:
-                    bus_status[bus_id] = "departing"
-        
-        # Get updated state and stop info
-        state = dbm.get_bus_state(bus_id)
-        if state:
-            state = dict(state)
-            stop = dbm.current_stop_for_index(state.get("stop_index", 0))
-            state.update({
-                "stop_name": stop["name"] if stop else None,
-                "stop_id": stop["id"] if stop else None,
-                "status": bus_status.get(bus_id),
-                "accuracy": accuracy,
-                "user_type": user_type,  # Include user type in response
-                "location_source": location_source if should_update_bus else None,
-                "updated_bus": should_update_bus  # Did this update move the bus?
-            })
-        
-        return jsonify(state)
-        
+            data = codec.decode_fix(request.mimetype, request.get_data())
+        except codec.CodecError as e:
+            return jsonify({"error": str(e)}), 400
+        user = current_user()
+        payload, status_code = process_location_fix(
+            user.get('username'), user.get('role'), data
+        )
+        return respond(payload, status_code)
+
+    except QueueFull:
+        raise
     except Exception as e:
         app.logger.error(f"Error in location sharing: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
 @app.get("/location/active")
 @login_required
+@admitted(ANALYTICS)
 def get_active_locations():
     """Get all active location sharers for the bus"""
     bus_id = request.args.get("bus_id", BUS_ID)
@@ -393,7 +754,8 @@ def get_active_locations():
             })
         
         # Get current clusters
-        clusters = dbm.find_location_clusters(bus_id, max_radius=80.0, min_points=2)
+        # Current clusters, maintained incrementally at ingest
+        clusters = clustering.for_bus(bus_id).snapshot(time_module.time())
         
         # Process driver information
         driver_locations = [loc for loc in locations if loc['user_type'] == 'driver']
@@ -413,20 +775,10 @@ def get_active_locations():
             "average_accuracy": sum(loc['accuracy'] for loc in student_locations) / len(student_locations) if student_locations else None
         }
         
-        # Process cluster information
-        cluster_info = [{
-            "center_lat": c['center_lat'],
-            "center_lon": c['center_lon'],
-            "radius": c['radius'],
-            "point_count": len(c['points']),
-            "is_majority": len(c['points']) > len(locations) / 2,
-            "source": c['source']
-        } for c in clusters]
-        
         return jsonify({
             "driver": driver_info,
             "students": student_info,
-            "clusters": cluster_info,
+            "clusters": clusters,
             "active_users": len(locations),
             "last_update": max(loc['timestamp'] for loc in locations)
         })
@@ -438,55 +790,117 @@ def get_active_locations():
 
 @app.get("/bus/<path:bus_id>")
 @login_required
+@admitted(STATE_READ)
 def get_bus(bus_id: str):
     state = dbm.get_bus_state(bus_id)
     if not state:
         return jsonify({}), 404
-    stop = dbm.current_stop_for_index(state["stop_index"])
-    state = dict(state)
-    state["stop_name"] = stop["name"] if stop else None
-    state["stop_id"] = stop["id"] if stop else None
-    state["status"] = bus_status.get(bus_id)
-    return jsonify(state)
+    status = bus_status.get(bus_id)
+
+    def build() -> Dict[str, Any]:
+        stop = dbm.current_stop_for_index(state["stop_index"])
+        payload = state.as_dict()
+        payload["stop_name"] = stop["name"] if stop else None
+        payload["stop_id"] = stop["id"] if stop else None
+        payload["status"] = status
+        return payload
+
+    # Polled by every open page; re-encoded only after the state changes
+    return cached_response('bus', bus_id, (state, status, dbm.get_stops()), build)
 
 @app.get("/stops")
 @login_required
+@admitted(STATE_READ)
 def get_stops():
     rows = dbm.get_stops()
-    return jsonify([dict(r) for r in rows])
+    return cached_response('stops', '', (rows,), lambda: [dict(r) for r in rows], negotiate=False)
+
+FLEET_PAGE_SIZE = 100
+FLEET_MAX_PAGE_SIZE = 500
+FLEET_FIELDS = (
+    "bus_id", "stop_index", "stop_name", "next_stop_name", "status", "lat", "lon",
+    "gps_source", "driver_age_s", "student_age_s", "next_stop_m", "eta_s", "trip_id", "timestamp",
+)
+
+def _age_seconds(bus_id: str, source: str) -> Optional[float]:
+    age = arbiter.age(bus_id, source)
+    return round(age, 1) if age is not None else None
+
+def fleet_entry(row) -> Dict[str, Any]:
+    """One bus of the /fleet overview, built from a get_fleet_overview() row"""
+    bus_id = row["bus_id"]
+    driver_age = _age_seconds(bus_id, DRIVER)
+    student_age = _age_seconds(bus_id, STUDENT)
+    gps_source = arbiter.active_source(bus_id)
+    if gps_source == MANUAL:
+        gps_source = None
+
+    next_stop_m = eta_s = None
+    if row["next_lat"] is not None and row["lat"] is not None:
+        next_stop_m = round(dbm.calculate_distance(row["lat"], row["lon"], row["next_lat"], row["next_lon"]))
+        eta_s = round(next_stop_m / ETA_SPEED)
+
+    return {
+        "bus_id": bus_id,
+        "stop_index": row["stop_index"],
+        "stop_name": row["stop_name"],
+        "next_stop_name": row["next_stop_name"],
+        "status": bus_status.get(bus_id),
+        "lat": round(row["lat"], 6) if row["lat"] is not None else None,
+        "lon": round(row["lon"], 6) if row["lon"] is not None else None,
+        "gps_source": gps_source,
+        "driver_age_s": driver_age,
+        "student_age_s": student_age,
+        "next_stop_m": next_stop_m,
+        "eta_s": eta_s,
+        "trip_id": row["trip_id"],
+        "timestamp": row["timestamp"],
+    }
+
+@app.get("/fleet")
+@login_required
+@admitted(STATE_READ)
+def get_fleet():
+    """All buses at once: state, stop names, GPS freshness and ETA.
+
+    Query args: route (e.g. S1), after (cursor from the previous page),
+    limit, and format=compact for a columnar {fields, rows} encoding.
+    """
+    route = request.args.get("route") or None
+    after = request.args.get("after") or None
+    try:
+        limit = min(max(int(request.args.get("limit", FLEET_PAGE_SIZE)), 1), FLEET_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    buses = [fleet_entry(row) for row in dbm.get_fleet_overview(route, after, limit)]
+    next_cursor = buses[-1]["bus_id"] if len(buses) == limit else None
+    metrics.observe('fleet.page_size', len(buses))
+
+    if request.args.get("format") == "compact":
+        return jsonify({
+            "fields": FLEET_FIELDS,
+            "rows": [[bus[f] for f in FLEET_FIELDS] for bus in buses],
+            "next": next_cursor,
+        })
+    return jsonify({"buses": buses, "next": next_cursor})
 
 @app.post("/driver/departed")
 @login_required
 @role_required('driver')
+@rate_limited
 def driver_departed():
     """Only use if driver location is outdated (>30 seconds)"""
     data = request.get_json(force=True)
     bus_id = data.get("bus_id", BUS_ID)
     
     # verify the driver is assigned to this bus
-    if bus_id != session.get('bus_id'):
+    if bus_id != current_user().get('bus_id'):
         return jsonify({"error": "unauthorized"}), 403
     
-    # Check if we have recent driver or student location
-    now = datetime.now()
-    gps_active = False
-    gps_source = None
-    
-    # Priority 1: Check driver GPS
-    if bus_id in last_driver_update:
-        seconds_since_update = (now - last_driver_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'driver'
-    
-    # Priority 2: Check student GPS if driver not active
-    if not gps_active and bus_id in last_student_update:
-        seconds_since_update = (now - last_student_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'student'
-    
-    if gps_active:
+    # Manual controls only apply while no GPS source is live
+    gps_source = arbiter.active_source(bus_id)
+    if gps_source != MANUAL:
         return jsonify({
             "error": "Using live GPS - manual control disabled",
             "message": f"Bus position is being tracked via {gps_source} GPS",
@@ -499,6 +913,7 @@ def driver_departed():
     state = dbm.get_bus_state(bus_id)
     if not state:
         return jsonify({}), 404
+    record_stop_event(bus_id, state["stop_index"], "departing", "manual")
     stop = dbm.current_stop_for_index(state["stop_index"])
     resp = dict(state)
     resp["stop_name"] = stop["name"] if stop else None
@@ -510,35 +925,19 @@ def driver_departed():
 @app.post("/driver/arrived")
 @login_required
 @role_required('driver')
+@rate_limited
 def driver_arrived():
     """Only use if driver location is outdated (>30 seconds)"""
     data = request.get_json(force=True)
     bus_id = data.get("bus_id", BUS_ID)
     
     # verify the driver is assigned to this bus
-    if bus_id != session.get('bus_id'):
+    if bus_id != current_user().get('bus_id'):
         return jsonify({"error": "unauthorized"}), 403
     
-    # Check if we have recent driver or student location
-    now = datetime.now()
-    gps_active = False
-    gps_source = None
-    
-    # Priority 1: Check driver GPS
-    if bus_id in last_driver_update:
-        seconds_since_update = (now - last_driver_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'driver'
-    
-    # Priority 2: Check student GPS if driver not active
-    if not gps_active and bus_id in last_student_update:
-        seconds_since_update = (now - last_student_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'student'
-    
-    if gps_active:
+    # Manual controls only apply while no GPS source is live
+    gps_source = arbiter.active_source(bus_id)
+    if gps_source != MANUAL:
         return jsonify({
             "error": "Using live GPS - manual control disabled",
             "message": f"Bus position is being tracked via {gps_source} GPS",
@@ -552,7 +951,9 @@ def driver_arrived():
     
     # Fallback: clear status when arriving
     bus_status.pop(bus_id, None)
-    state = dbm.move_bus_to_next_stop(bus_id)
+    state = writes.call(bus_id, dbm.move_bus_to_next_stop, bus_id)
+    if state:
+        record_stop_event(bus_id, state["stop_index"], "arrived", "manual")
     stop = dbm.current_stop_for_index(state.get("stop_index", 0))
     state["stop_name"] = stop["name"] if stop else None
     state["stop_id"] = stop["id"] if stop else None
@@ -563,13 +964,14 @@ def driver_arrived():
 @app.post("/driver/reset")
 @login_required
 @role_required('driver')
+@rate_limited
 def driver_reset():
     """Manual reset button for driver - resets bus to starting stop"""
     data = request.get_json(force=True)
     bus_id = data.get("bus_id", BUS_ID)
     
     # verify the driver is assigned to this bus
-    if bus_id != session.get('bus_id'):
+    if bus_id != current_user().get('bus_id'):
         return jsonify({"error": "unauthorized"}), 403
     
     # Reset bus to start
@@ -593,12 +995,13 @@ def driver_reset():
 @app.post("/location/stop")
 @login_required
 @role_required('driver')
+@rate_limited
 def stop_location_sharing():
     """Immediately stop GPS tracking and enable manual controls"""
-    bus_id = session.get('bus_id', BUS_ID)
+    bus_id = current_user().get('bus_id') or BUS_ID
     
-    # Clear the GPS timestamp to immediately enable manual controls
-    last_driver_update.pop(bus_id, None)
+    # Drop the driver's freshness to immediately enable manual controls
+    forget_gps(bus_id, DRIVER)
     
     app.logger.info(f"GPS tracking stopped for bus {bus_id} - manual controls enabled")
     
@@ -610,6 +1013,7 @@ def stop_location_sharing():
 @app.post("/driver/toggle-student-location")
 @login_required
 @role_required('driver')
+@rate_limited
 def toggle_student_location():
     """Toggle student location sharing on/off"""
     data = request.get_json(force=True)
@@ -617,7 +1021,7 @@ def toggle_student_location():
     enabled = data.get("enabled", False)
     
     # Verify the driver is assigned to this bus
-    if bus_id != session.get('bus_id'):
+    if bus_id != current_user().get('bus_id'):
         return jsonify({"error": "unauthorized"}), 403
     
     # Update the toggle state
@@ -625,7 +1029,7 @@ def toggle_student_location():
     
     # If disabling, clear all student location updates
     if not enabled:
-        last_student_update.pop(bus_id, None)
+        forget_gps(bus_id, STUDENT)
         app.logger.info(f"Student location sharing disabled for bus {bus_id}")
     else:
         app.logger.info(f"Student location sharing enabled for bus {bus_id}")
@@ -644,7 +1048,7 @@ def get_student_location_status():
     bus_id = request.args.get("bus_id", BUS_ID)
     
     # Verify the driver is assigned to this bus
-    if bus_id != session.get('bus_id'):
+    if bus_id != current_user().get('bus_id'):
         return jsonify({"error": "unauthorized"}), 403
     
     return jsonify({
@@ -655,6 +1059,7 @@ def get_student_location_status():
 @app.get("/student/location-status")
 @login_required
 @role_required('student')
+@admitted(STATE_READ)
 def get_student_sharing_status():
     """Check if student location sharing is enabled"""
     bus_id = request.args.get("bus_id", BUS_ID)
@@ -667,30 +1072,15 @@ def get_student_sharing_status():
 @app.post("/student/arrived")
 @login_required
 @role_required('student')
+@rate_limited
 def student_arrived():
     """Students can confirm arrival - but only moves bus if GPS is inactive (>30s)"""
     data = request.get_json(force=True)
     bus_id = data.get("bus_id", BUS_ID)
-    student_id = session.get('username', 'S1')  # Use logged in username as student ID
+    student_id = current_user().get('username', 'S1')  # Use logged in username as student ID
 
     # Check if driver's or student's GPS is active
-    now = datetime.now()
-    gps_active = False
-    gps_source = None
-    
-    # Priority 1: Check driver GPS
-    if bus_id in last_driver_update:
-        seconds_since_update = (now - last_driver_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'driver'
-    
-    # Priority 2: Check student GPS if driver not active
-    if not gps_active and bus_id in last_student_update:
-        seconds_since_update = (now - last_student_update[bus_id]).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-            gps_source = 'student'
+    gps_active = arbiter.active_source(bus_id) != MANUAL
 
     state = dbm.get_bus_state(bus_id)
     if not state:
@@ -702,17 +1092,19 @@ def student_arrived():
         return jsonify({"error": "stop not found"}), 404
 
     # Always record the confirmation
-    dbm.insert_confirmation(bus_id, stop["id"], "student", student_id)
-    cnt = dbm.count_confirmations(bus_id, stop["id"])
+    # Repeated taps by the same student are recorded but counted once per trip
+    cnt = writes.call(bus_id, dbm.insert_confirmation, bus_id, stop["id"], "student", student_id)
 
     moved = False
     new_state: Dict[str, Any] = dict(state)
     
     # Only move bus if GPS is NOT active and quorum is reached
     if cnt >= QUORUM and not gps_active:
-        new_state = dbm.move_bus_to_next_stop(bus_id)
+        new_state = writes.call(bus_id, dbm.move_bus_to_next_stop, bus_id)
         moved = True
         bus_status.pop(bus_id, None)
+        if new_state:
+            record_stop_event(bus_id, new_state["stop_index"], "arrived", "students")
     elif cnt >= QUORUM and gps_active:
         # Quorum reached but GPS is active - don't move
         app.logger.info(f"Student confirmation quorum reached for bus {bus_id}, but GPS is active - ignoring manual control")
@@ -728,6 +1120,7 @@ def student_arrived():
 
 @app.get("/confirmations")
 @login_required
+@admitted(STATE_READ)
 def get_confirmations():
     bus_id = request.args.get("bus_id", BUS_ID)
     stop_id = int(request.args.get("stop_id", "0"))
@@ -736,27 +1129,112 @@ def get_confirmations():
 
 @app.get("/gps/status")
 @login_required
+@admitted(STATE_READ)
 def get_gps_status():
     """Check if driver's GPS is currently active"""
     bus_id = request.args.get("bus_id", BUS_ID)
     
-    now = datetime.now()
-    gps_active = False
-    last_update_time = None
-    
-    if bus_id in last_driver_update:
-        last_update_time = last_driver_update[bus_id]
-        seconds_since_update = (now - last_update_time).total_seconds()
-        if seconds_since_update < 30:
-            gps_active = True
-    
+    age = arbiter.age(bus_id, DRIVER)
+    last_update_time = datetime.now() - timedelta(seconds=age) if age is not None else None
+    gps_source = arbiter.active_source(bus_id)
+
     return jsonify({
         "bus_id": bus_id,
-        "gps_active": gps_active,
+        "gps_active": arbiter.is_fresh(bus_id, DRIVER),
+        "gps_source": None if gps_source == MANUAL else gps_source,
         "last_update": last_update_time.isoformat() if last_update_time else None
     })
 
+@app.get("/export")
+@login_required
+@role_required('driver')
+@admitted(ANALYTICS)
+def export_history():
+    """Stream the driver's bus history for a date range as CSV or NDJSON (see export.py)"""
+    args = request.args
+    try:
+        job = export.Export(args.get("dataset", "locations"), args.get("from"), args.get("to"),
+                            fmt=args.get("format", "csv"), bus_id=current_user().get('bus_id') or BUS_ID,
+                            compress=args.get("gzip") == "1")
+    except export.ExportError as e:
+        return jsonify({"error": str(e)}), 400
+    return app.response_class(iter(job), mimetype=job.mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{job.filename}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+ALERT_HEARTBEAT_SECONDS = 15
+ALERT_POLL_FALLBACK_SECONDS = 15  # the student page's /alerts/held interval when refused a stream
+
+@app.post("/alerts")
+@login_required
+@rate_limited
+def create_alert():
+    """Subscribe to an arrival alert: bus_id, stop_id and stops_before and/or minutes_before"""
+    data = request.get_json(silent=True) or {}
+    bus_id = data.get("bus_id", BUS_ID)
+    stop = next((s for s in dbm.get_stops() if s["id"] == data.get("stop_id")), None)
+    if stop is None:
+        return jsonify({"error": "Unknown stop"}), 400
+    try:
+        stops_before = int(data["stops_before"]) if data.get("stops_before") is not None else None
+        minutes_before = float(data["minutes_before"]) if data.get("minutes_before") is not None else None
+        sub = alerts.subscribe(current_user().get('username'), bus_id, stop, stops_before, minutes_before)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(sub.to_dict()), 201
+
+@app.get("/alerts")
+@login_required
+def list_alerts():
+    user_id = current_user().get('username')
+    response = jsonify([sub.to_dict() for sub in alerts.for_user(user_id)])
+    # Fired alerts no stream has received yet; the page opens its stream for them too
+    response.headers['X-Alerts-Held'] = str(dbm.count_undelivered_alerts(user_id))
+    return response
+
+@app.delete("/alerts/<int:sub_id>")
+@login_required
+def cancel_alert(sub_id: int):
+    if not alerts.cancel(sub_id, current_user().get('username')):
+        return jsonify({"error": "Unknown alert"}), 404
+    return jsonify({"id": sub_id, "cancelled": True})
+
+@app.get("/alerts/held")
+@login_required
+def held_alerts():
+    """Fired alerts not delivered yet, for clients that could not open a stream"""
+    return jsonify(alerts.take_held(current_user().get('username')))
+
+@app.get("/alerts/stream")
+@login_required
+def alert_stream():
+    """Server-sent events: one 'alert' event per fired subscription"""
+    user_id = current_user().get('username')
+    stream = alerts.open_stream(user_id)
+    if stream is None:
+        # Too many open streams in this worker; the page polls /alerts/held
+        response = jsonify({"error": "Too many alert streams", "retry_after": ALERT_POLL_FALLBACK_SECONDS})
+        response.headers['Retry-After'] = str(ALERT_POLL_FALLBACK_SECONDS)
+        return response, 503
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    alert = stream.get(timeout=ALERT_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: alert\ndata: {respcache.dumps(alert).decode('utf-8')}\n\n"
+        finally:
+            alerts.close_stream(user_id, stream)
+
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 if __name__ == "__main__":
-    dbm.init_db()
+    migrations.migrate_all()
     app.run(debug=True) 
\ No newline at end of file
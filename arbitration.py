@@ -0,0 +1,173 @@
+"""Which GPS source positions each bus.
+
+Priority is driver GPS, then student GPS, then manual controls: a source is
+active while its last fix is fresher than the route's threshold (30 s by
+default). The arbiter keeps the last fix time per bus and source on a
+monotonic clock, so ``active_source()`` is two dict lookups and immune to
+wall-clock jumps. Callers replaying a recorded trace pass their own ``now``
+(seconds) to every call instead.
+
+Thresholds can be tuned per route with ``BUS_GPS_FRESHNESS_<ROUTE>=driver:student``
+(e.g. ``BUS_GPS_FRESHNESS_S1=45:60``), or ``BUS_GPS_FRESHNESS`` for the
+default. Whenever a bus's active source changes - a fix from a higher
+priority source, or the current one going stale - subscribers get a
+``SourceChange``; staleness is noticed on the next lookup or ``sweep()``.
+"""
+import os
+import threading
+import time as time_module
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db as dbm
+import metrics
+
+DRIVER = 'driver'
+STUDENT = 'student'
+MANUAL = 'manual'
+
+
+def _freshness(name: Optional[str] = None) -> Optional[Tuple[float, float]]:
+    value = os.environ.get(f"BUS_GPS_FRESHNESS_{name.upper()}" if name else "BUS_GPS_FRESHNESS")
+    if not value:
+        return None
+    driver_s, _, student_s = value.partition(':')
+    return float(driver_s), float(student_s or driver_s)
+
+
+DEFAULT_FRESHNESS = _freshness() or (30.0, 30.0)  # (driver, student) seconds
+
+
+class SourceChange:
+    __slots__ = ('bus_id', 'previous', 'source', 't')
+
+    def __init__(self, bus_id: str, previous: str, source: str, t: float) -> None:
+        self.bus_id = bus_id
+        self.previous = previous
+        self.source = source  # 'driver', 'student' or 'manual'
+        self.t = t
+
+
+class SourceArbiter:
+    def __init__(self, default: Tuple[float, float] = DEFAULT_FRESHNESS,
+                 clock: Callable[[], float] = time_module.monotonic) -> None:
+        self.default = default
+        self.clock = clock
+        self._routes: Dict[str, Tuple[float, float]] = {}
+        self._thresholds: Dict[str, Tuple[float, float]] = {}  # bus -> (driver, student)
+        self._seen: Dict[str, Dict[str, float]] = {}  # bus -> source -> last fix
+        self._active: Dict[str, str] = {}  # last reported source per bus
+        self._listeners: List[Callable[[SourceChange], None]] = []
+        self._lock = threading.Lock()
+
+    def set_freshness(self, route: str, driver: float, student: float) -> None:
+        """Override the freshness thresholds (seconds) for every bus on a route"""
+        with self._lock:
+            self._routes[route] = (driver, student)
+            self._thresholds.clear()
+
+    def thresholds(self, bus_id: str) -> Tuple[float, float]:
+        limits = self._thresholds.get(bus_id)
+        if limits is None:
+            route = dbm.route_for_bus(bus_id)
+            limits = self._routes.get(route) or _freshness(route) or self.default
+            self._thresholds[bus_id] = limits
+        return limits
+
+    def subscribe(self, listener: Callable[[SourceChange], None]) -> None:
+        self._listeners.append(listener)
+
+    def _source(self, bus_id: str, now: float) -> str:
+        seen = self._seen.get(bus_id)
+        if not seen:
+            return MANUAL
+        driver_s, student_s = self.thresholds(bus_id)
+        last = seen.get(DRIVER)
+        if last is not None and now - last < driver_s:
+            return DRIVER
+        last = seen.get(STUDENT)
+        if last is not None and now - last < student_s:
+            return STUDENT
+        return MANUAL
+
+    def _settle(self, bus_id: str, now: float) -> str:
+        """The bus's active source, emitting a change if it differs from the last one"""
+        source = self._source(bus_id, now)
+        with self._lock:
+            previous = self._active.get(bus_id, MANUAL)
+            if source == previous:
+                return source
+            self._active[bus_id] = source
+        metrics.incr(f'arbitration.{source}')
+        change = SourceChange(bus_id, previous, source, now)
+        for listener in self._listeners:
+            listener(change)
+        return source
+
+    # --- updates ----------------------------------------------------------
+    def report(self, bus_id: str, source: str, now: Optional[float] = None) -> str:
+        """Record a fix from 'driver' or 'student'; returns the bus's active source"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            self._seen.setdefault(bus_id, {})[source] = now
+        return self._settle(bus_id, now)
+
+    def forget(self, bus_id: str, source: Optional[str] = None, now: Optional[float] = None) -> str:
+        """Drop one source (or all) for a bus, e.g. when the driver stops sharing"""
+        with self._lock:
+            seen = self._seen.get(bus_id)
+            if seen is not None:
+                if source is None:
+                    seen.clear()
+                else:
+                    seen.pop(source, None)
+        return self._settle(bus_id, self.clock() if now is None else now)
+
+    def sweep(self, now: Optional[float] = None) -> None:
+        """Settle every bus, so sources going stale are announced without a lookup"""
+        now = self.clock() if now is None else now
+        for bus_id in list(self._seen):
+            self._settle(bus_id, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._seen.clear()
+            self._active.clear()
+            self._thresholds.clear()
+
+    def export(self, now: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        """Seconds since each bus's last fix per source, for snapshots"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            return {bus: {source: now - t for source, t in seen.items()}
+                    for bus, seen in self._seen.items() if seen}
+
+    def restore(self, ages: Dict[str, Dict[str, float]], now: Optional[float] = None) -> None:
+        """Load exported ages (already advanced by the downtime) onto this clock"""
+        now = self.clock() if now is None else now
+        with self._lock:
+            for bus, sources in ages.items():
+                self._seen[bus] = {source: now - age for source, age in sources.items()}
+        for bus in ages:
+            self._settle(bus, now)
+
+    # --- lookups ----------------------------------------------------------
+    def active_source(self, bus_id: str, now: Optional[float] = None) -> str:
+        """'driver', 'student' or 'manual'"""
+        return self._settle(bus_id, self.clock() if now is None else now)
+
+    def is_fresh(self, bus_id: str, source: str, now: Optional[float] = None) -> bool:
+        age = self.age(bus_id, source, now)
+        if age is None:
+            return False
+        driver_s, student_s = self.thresholds(bus_id)
+        return age < (driver_s if source == DRIVER else student_s)
+
+    def age(self, bus_id: str, source: str, now: Optional[float] = None) -> Optional[float]:
+        """Seconds since the source's last fix for this bus, or None"""
+        last = self._seen.get(bus_id, {}).get(source)
+        if last is None:
+            return None
+        return (self.clock() if now is None else now) - last
+
+
+arbiter = SourceArbiter()
@@ -0,0 +1,237 @@
+"""Micro-benchmarks for the storage and ingest layers.
+
+Usage:
+    python bench.py shards --shards 1 2 4 8 --workers 8 --fixes 2000
+    python bench.py codec --fixes 100000
+    python bench.py auth --requests 5000
+    python bench.py workers --buses 1 10 200 --processes 0 1 2 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time as time_module
+from typing import Any, Dict, List, Optional
+
+import codec
+import db as dbm
+
+
+def _configure_db(db_path: str, shards: int) -> None:
+    dbm.DB_PATH = db_path
+    dbm.SHARD_COUNT = shards
+
+
+def _write_fixes(args: tuple) -> Dict[str, Any]:
+    """Worker process: write GPS fixes for random buses as fast as possible"""
+    db_path, shards, buses, fixes, seed = args
+    _configure_db(db_path, shards)
+    rng = random.Random(seed)
+    errors = 0
+    start = time_module.perf_counter()
+    for i in range(fixes):
+        bus_id = buses[rng.randrange(len(buses))]
+        try:
+            dbm.update_user_location(bus_id, f"w{seed}u{i % 50}", 'student',
+                                     17.5 + rng.random() / 100, 78.35 + rng.random() / 100, 10.0)
+        except Exception:
+            errors += 1
+    return {'seconds': time_module.perf_counter() - start, 'errors': errors}
+
+
+def bench_shards(shard_counts: List[int], workers: int, fixes: int, buses: int) -> List[Dict[str, Any]]:
+    """Measure fleet-wide write throughput for each shard count.
+
+    Each of ``workers`` processes (standing in for gunicorn workers) writes
+    ``fixes`` GPS fixes for random buses through ``update_user_location``.
+    """
+    bus_ids = [f"S{i + 1}/A" for i in range(buses)]
+    results = []
+    for shards in shard_counts:
+        tmp = tempfile.mkdtemp(prefix='bench-shards-')
+        try:
+            _configure_db(os.path.join(tmp, 'bus.db'), shards)
+            dbm.init_db()
+            for bus_id in bus_ids:
+                dbm.ensure_bus(bus_id)
+            jobs = [(dbm.DB_PATH, shards, bus_ids, fixes, seed) for seed in range(workers)]
+            start = time_module.perf_counter()
+            with multiprocessing.Pool(workers) as pool:
+                outcomes = pool.map(_write_fixes, jobs)
+            elapsed = time_module.perf_counter() - start
+            total = workers * fixes
+            results.append({
+                'shards': shards,
+                'workers': workers,
+                'writes': total,
+                'errors': sum(o['errors'] for o in outcomes),
+                'seconds': round(elapsed, 3),
+                'writes_per_second': round(total / elapsed, 1),
+            })
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def bench_codec(fixes: int, seed: int = 1) -> List[Dict[str, Any]]:
+    """Bytes on the wire and server-side decode time per fix for each encoding"""
+    rng = random.Random(seed)
+    points = [(17.49 + rng.random() / 20, 78.33 + rng.random() / 20, 3 + rng.random() * 40)
+              for _ in range(fixes)]
+    bus_id = 'S1/A'
+    encodings = {
+        'application/json': lambda lat, lon, acc: json.dumps(
+            {'bus_id': bus_id, 'lat': lat, 'lon': lon, 'accuracy': acc}).encode('utf-8'),
+        codec.FIX_MIMETYPE: lambda lat, lon, acc: codec.encode_fix(lat, lon, acc, bus_id),
+    }
+    if codec.msgpack is not None:
+        encodings[codec.MSGPACK_MIMETYPE] = lambda lat, lon, acc: codec.msgpack.packb(
+            {'bus_id': bus_id, 'lat': lat, 'lon': lon, 'accuracy': acc})
+
+    results = []
+    for mimetype, encode in encodings.items():
+        bodies = [encode(*p) for p in points]
+        start = time_module.perf_counter()
+        for body in bodies:
+            codec.decode_fix(mimetype, body)
+        elapsed = time_module.perf_counter() - start
+        results.append({
+            'encoding': mimetype,
+            'fixes': fixes,
+            'bytes_per_fix': round(sum(len(b) for b in bodies) / fixes, 1),
+            'decode_us_per_fix': round(elapsed / fixes * 1e6, 3),
+        })
+    return results
+
+
+def bench_auth(requests: int) -> List[Dict[str, Any]]:
+    """Per-request cost of the auth decorators: server-side sessions vs. signed tokens.
+
+    Each mode logs in as the driver and then makes ``requests`` GETs to a
+    trivial view behind ``login_required`` and ``role_required('driver')``,
+    counting how many responses rewrote a cookie.
+    """
+    os.environ.setdefault("BUS_SCHEDULER", "0")
+    tmp = tempfile.mkdtemp(prefix='bench-auth-')
+    try:
+        _configure_db(os.path.join(tmp, 'bus.db'), 1)
+        import app as app_module
+        import migrations
+        from snapshot import snapshots
+        snapshots.path = None
+        migrations.migrate_all()
+        flask_app = app_module.app
+        flask_app.add_url_rule('/_bench/auth', 'bench_auth', app_module.login_required(
+            app_module.role_required('driver')(lambda: 'ok')))
+        results = []
+        for mode in ('session', 'token'):
+            app_module.AUTH_MODE = mode
+            client = flask_app.test_client()
+            client.post('/login', data={'username': 'driver1', 'password': 'driverpass123'})
+            rewrites = 0
+            start = time_module.perf_counter()
+            for _ in range(requests):
+                response = client.get('/_bench/auth')
+                if response.status_code != 200:
+                    raise RuntimeError(f"{mode}: unexpected {response.status_code}")
+                rewrites += 'Set-Cookie' in response.headers
+            elapsed = time_module.perf_counter() - start
+            results.append({
+                'mode': mode,
+                'requests': requests,
+                'us_per_request': round(elapsed / requests * 1e6, 1),
+                'cookie_rewrites': rewrites,
+            })
+        token = app_module.signer.issue('driver1', 'driver', 'S1/A')
+        start = time_module.perf_counter()
+        for _ in range(requests):
+            app_module.signer.verify(token)
+        results.append({'mode': 'token verify only', 'requests': requests,
+                        'us_per_request': round((time_module.perf_counter() - start) / requests * 1e6, 2)})
+        return results
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_workers(bus_counts: List[int], processes: List[int], points: int,
+                  rounds: int) -> List[Dict[str, Any]]:
+    """Fleet-wide cluster recomputation inline vs. on worker pools of several sizes.
+
+    Each bus gets ``points`` recent fixes (one driver, the rest students
+    scattered around it); a round rebuilds every bus's clusters from
+    scratch once. Pools are warmed up before timing.
+    """
+    import workers
+    rng = random.Random(7)
+    batches: Dict[str, bytes] = {}
+    for b in range(max(bus_counts)):
+        lat, lon = 17.49 + rng.random() * 0.05, 78.33 + rng.random() * 0.06
+        fixes = [(b * points + i, lat + rng.gauss(0, 0.0006), lon + rng.gauss(0, 0.0006),
+                  rng.uniform(4, 30), i == 0) for i in range(points)]
+        batches[f"R{b % 20}/{b}"] = workers.pack_fixes(fixes)
+    bus_ids = list(batches)
+
+    results = []
+    for size in processes:
+        pool = workers.WorkerPool(size)
+        try:
+            pool.map_buses('clustering:batch_clusters', {bus_id: (batches[bus_id],) for bus_id in bus_ids})
+            for buses in bus_counts:
+                start = time_module.perf_counter()
+                for _ in range(rounds):
+                    pool.map_buses('clustering:batch_clusters',
+                                   {bus_id: (batches[bus_id],) for bus_id in bus_ids[:buses]})
+                ms = (time_module.perf_counter() - start) / rounds * 1000
+                results.append({'processes': size, 'buses': buses, 'points_per_bus': points,
+                                'ms_per_round': round(ms, 2), 'cpus': os.cpu_count()})
+        finally:
+            pool.close()
+    inline = {r['buses']: r['ms_per_round'] for r in results if r['processes'] == processes[0]}
+    for r in results:
+        r['speedup'] = round(inline[r['buses']] / r['ms_per_round'], 2)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bus tracker benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('shards', help="write throughput vs. number of SQLite shards")
+    p.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--fixes', type=int, default=2000, help="fixes written per worker")
+    p.add_argument('--buses', type=int, default=200)
+
+    p = sub.add_parser('codec', help="bytes on the wire and decode time per GPS fix")
+    p.add_argument('--fixes', type=int, default=100000)
+
+    p = sub.add_parser('auth', help="per-request cost of session vs. token authentication")
+    p.add_argument('--requests', type=int, default=5000)
+
+    p = sub.add_parser('workers', help="cluster recomputation speedup on the worker pool")
+    p.add_argument('--buses', type=int, nargs='+', default=[1, 10, 200])
+    p.add_argument('--processes', type=int, nargs='+', default=[0, 1, 2, 4],
+                   help="pool sizes to compare; 0 runs inline and is the speedup baseline")
+    p.add_argument('--points', type=int, default=40, help="recent fixes per bus")
+    p.add_argument('--rounds', type=int, default=5)
+
+    args = parser.parse_args(argv)
+    if args.bench == 'shards':
+        results = bench_shards(args.shards, args.workers, args.fixes, args.buses)
+    elif args.bench == 'codec':
+        results = bench_codec(args.fixes)
+    elif args.bench == 'auth':
+        results = bench_auth(args.requests)
+    elif args.bench == 'workers':
+        results = bench_workers(args.buses, args.processes, args.points, args.rounds)
+    for row in results:
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Server-side hints telling clients how often to report GPS.
+
+Every /location/share response carries ``next_report_ms`` (wait at least
+this long before the next fix) and ``min_move_m`` (skip fixes that moved
+less than this). Clients report anyway once ``MAX_SILENCE_MS`` has passed
+since their last fix, whatever the hint said. Reporting is fast
+when the bus is approaching a stop, slow while it dwells, and students back
+off when the driver's GPS is live or enough classmates already cover the bus.
+"""
+import threading
+from typing import Dict, Optional
+
+FAST_MS = 1000
+NORMAL_MS = 3000
+SLOW_MS = 10000
+IDLE_MS = 15000  # students while driver GPS is authoritative (< MAX_SILENCE_MS)
+
+APPROACH_RADIUS = 300.0  # meters from the next stop counted as "approaching"
+COVERED_STUDENTS = 5     # active student reporters that fully cover a bus
+STUDENT_WINDOW = 30.0    # seconds a student counts as an active reporter
+
+# Clients report at least this often regardless of movement, so the
+# 30 s GPS freshness window never lapses while a phone is sharing
+MAX_SILENCE_MS = 20000
+
+
+class StudentCoverage:
+    """Active student reporters per bus over a sliding time window"""
+
+    def __init__(self, window: float = STUDENT_WINDOW) -> None:
+        self.window = window
+        self._seen: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, bus_id: str, user_id: str, now: float) -> int:
+        """Record a report and return the number of active reporters"""
+        with self._lock:
+            seen = self._seen.setdefault(bus_id, {})
+            seen[user_id] = now
+            cutoff = now - self.window
+            for uid in [u for u, t in seen.items() if t < cutoff]:
+                del seen[uid]
+            return len(seen)
+
+    def active(self, bus_id: str, now: float) -> int:
+        with self._lock:
+            cutoff = now - self.window
+            return sum(1 for t in self._seen.get(bus_id, {}).values() if t >= cutoff)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._seen.clear()
+
+
+coverage = StudentCoverage()
+
+
+def report_hint(user_type: str, status: Optional[str], distance_to_next: Optional[float],
+                driver_active: bool, active_students: int) -> Dict[str, int]:
+    """Pick the reporting cadence for the sender of a fix"""
+    approaching = distance_to_next is not None and distance_to_next <= APPROACH_RADIUS
+
+    if user_type == 'driver':
+        if status == 'arrived' and not approaching:
+            return {"next_report_ms": SLOW_MS, "min_move_m": 25}
+        if approaching:
+            return {"next_report_ms": FAST_MS, "min_move_m": 5}
+        return {"next_report_ms": NORMAL_MS, "min_move_m": 10}
+
+    # Students: their fixes only position the bus when the driver is silent
+    if driver_active:
+        return {"next_report_ms": IDLE_MS, "min_move_m": 50}
+    if status == 'arrived' and not approaching:
+        return {"next_report_ms": SLOW_MS, "min_move_m": 25}
+    if active_students >= COVERED_STUDENTS:
+        # Spread the load: each student reports proportionally less often
+        share = min(SLOW_MS, NORMAL_MS * active_students // COVERED_STUDENTS)
+        return {"next_report_ms": share, "min_move_m": 15}
+    if approaching:
+        return {"next_report_ms": FAST_MS, "min_move_m": 5}
+    return {"next_report_ms": NORMAL_MS, "min_move_m": 10}
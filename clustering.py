@@ -0,0 +1,413 @@
+"""Incremental per-bus clustering of recent GPS fixes.
+
+``batch_clusters()`` rebuilds a bus's clusters from scratch out of a batch
+of recent fixes. ``OnlineClusterer`` keeps a 30 s sliding window in memory
+instead: each user contributes their latest fix, points
+are bucketed in a grid of ``max_radius``-sized cells, and clusters are the
+connected components of points within ``max_radius`` of each other.
+
+Unlike ``batch_clusters()`` - driver-anchored clusters whose
+members lie within ``max_radius`` of the weighted centre - these are
+single-link clusters: riders strung out along the road chain into one
+cluster, however long. Connected components are what can be maintained
+incrementally; a cluster's diameter is not bounded.
+
+* Inserting a fix looks only at the 3x3 neighbouring cells and merges the
+  clusters it touches - roughly O(neighbours).
+* A rider's repeat fix is updated in place. An expiring fix is removed.
+  Either way the cluster is re-flooded to detect a split only if the
+  point's old neighbours can no longer reach each other without it
+  (a search that stops at the first path found).
+* Each cluster keeps running accuracy-weighted sums, and clusters are
+  bucketed by member count as points join and leave. The majority
+  cluster and its centre are therefore available in O(1).
+"""
+import threading
+from collections import deque
+from itertools import count
+from math import cos, radians
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+import db as dbm
+from workers import unpack_fixes
+
+METERS_PER_DEGREE = 111320.0
+WINDOW_SECONDS = 30.0
+MAX_RADIUS = 80.0
+MIN_POINTS = 2
+
+Cell = Tuple[int, int]
+
+
+class Point:
+    __slots__ = ('user_id', 'user_type', 'lat', 'lon', 'accuracy', 't', 'x', 'y', 'cell', 'cluster')
+
+    def __init__(self, user_id: str, user_type: str, lat: float, lon: float, accuracy: float,
+                 t: float, x: float, y: float, cell: Cell) -> None:
+        self.user_id = user_id
+        self.user_type = user_type
+        self.lat = lat
+        self.lon = lon
+        self.accuracy = accuracy
+        self.t = t
+        self.x = x
+        self.y = y
+        self.cell = cell
+        self.cluster: Optional['Cluster'] = None
+
+    @property
+    def weight(self) -> float:
+        # Inverse square of accuracy (capped at 5m), as in batch_clusters
+        return 1 / max(self.accuracy, 5.0) ** 2
+
+
+class _Sizes:
+    """Clusters bucketed by member count; the largest is kept as sizes change by one"""
+    __slots__ = ('buckets', 'largest')
+
+    def __init__(self) -> None:
+        self.buckets: Dict[int, Set['Cluster']] = {}
+        self.largest = 0
+
+    def resize(self, cluster: 'Cluster', old: int, new: int) -> None:
+        bucket = self.buckets.get(old)
+        if bucket is not None:
+            bucket.discard(cluster)
+            if not bucket:
+                del self.buckets[old]
+        if new > 0:
+            self.buckets.setdefault(new, set()).add(cluster)
+        if new > self.largest:
+            self.largest = new
+        elif old == self.largest and old not in self.buckets:
+            # It was alone at the top and shrank by one (or emptied)
+            self.largest = new
+
+    def top(self) -> Optional['Cluster']:
+        bucket = self.buckets.get(self.largest)
+        return next(iter(bucket)) if bucket else None
+
+
+class Cluster:
+    __slots__ = ('id', 'members', 'w', 'wlat', 'wlon', 'drivers', 'sizes')
+
+    def __init__(self, cluster_id: int, sizes: _Sizes) -> None:
+        self.id = cluster_id
+        self.members: Set[str] = set()
+        self.w = 0.0
+        self.wlat = 0.0
+        self.wlon = 0.0
+        self.drivers = 0
+        self.sizes = sizes
+
+    def add(self, p: Point) -> None:
+        size = len(self.members)
+        self.members.add(p.user_id)
+        self.sizes.resize(self, size, len(self.members))
+        w = p.weight
+        self.w += w
+        self.wlat += p.lat * w
+        self.wlon += p.lon * w
+        self.drivers += p.user_type == 'driver'
+        p.cluster = self
+
+    def remove(self, p: Point) -> None:
+        size = len(self.members)
+        self.members.discard(p.user_id)
+        self.sizes.resize(self, size, len(self.members))
+        w = p.weight
+        self.w -= w
+        self.wlat -= p.lat * w
+        self.wlon -= p.lon * w
+        self.drivers -= p.user_type == 'driver'
+        p.cluster = None
+
+    @property
+    def center(self) -> Tuple[float, float]:
+        return self.wlat / self.w, self.wlon / self.w
+
+
+class OnlineClusterer:
+    def __init__(self, max_radius: float = MAX_RADIUS, min_points: int = MIN_POINTS,
+                 window: float = WINDOW_SECONDS) -> None:
+        self.max_radius = max_radius
+        self.min_points = min_points
+        self.window = window
+        self.points: Dict[str, Point] = {}
+        self.grid: Dict[Cell, Set[str]] = {}
+        self.clusters: Dict[int, Cluster] = {}
+        self._expiry: Deque[Tuple[float, str]] = deque()
+        self._ids = count(1)
+        self._sizes = _Sizes()
+        self._lon_scale: Optional[float] = None
+        self._lock = threading.Lock()
+
+    # --- geometry -------------------------------------------------------
+    def _project(self, lat: float, lon: float) -> Tuple[float, float]:
+        if self._lon_scale is None:
+            self._lon_scale = METERS_PER_DEGREE * cos(radians(lat))
+        return lon * self._lon_scale, lat * METERS_PER_DEGREE
+
+    def _neighbours(self, p: Point, members: Optional[Set[str]] = None) -> List[Point]:
+        r2 = self.max_radius ** 2
+        cx, cy = p.cell
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for uid in self.grid.get((cx + dx, cy + dy), ()):
+                    if uid == p.user_id or (members is not None and uid not in members):
+                        continue
+                    q = self.points[uid]
+                    if (q.x - p.x) ** 2 + (q.y - p.y) ** 2 <= r2:
+                        found.append(q)
+        return found
+
+    # --- updates --------------------------------------------------------
+    def add(self, user_id: str, user_type: str, lat: float, lon: float,
+            accuracy: float, now: float) -> Cluster:
+        """Insert (or replace) a user's latest fix and return its cluster"""
+        with self._lock:
+            self._expire(now)
+            x, y = self._project(lat, lon)
+            cell = (int(x // self.max_radius), int(y // self.max_radius))
+            p = Point(user_id, user_type, lat, lon, accuracy, now, x, y, cell)
+            old = self.points.get(user_id)
+            if old is not None:
+                return self._move(old, p)
+            self.points[user_id] = p
+            self.grid.setdefault(cell, set()).add(user_id)
+            self._expiry.append((now, user_id))
+
+            touched = {q.cluster.id: q.cluster for q in self._neighbours(p)}
+            if not touched:
+                cluster = Cluster(next(self._ids), self._sizes)
+                self.clusters[cluster.id] = cluster
+            else:
+                cluster = self._merge(touched.values())
+            cluster.add(p)
+            return cluster
+
+    def _move(self, old: Point, p: Point) -> Cluster:
+        """Replace a user's fix in place; re-flood only if one of its links broke"""
+        old_links = {q.user_id for q in self._neighbours(old)}
+        cluster = old.cluster
+        cluster.remove(old)
+        if p.cell != old.cell:
+            cell = self.grid[old.cell]
+            cell.discard(old.user_id)
+            if not cell:
+                del self.grid[old.cell]
+            self.grid.setdefault(p.cell, set()).add(p.user_id)
+        self.points[p.user_id] = p
+        self._expiry.append((p.t, p.user_id))
+        cluster.add(p)
+
+        links = self._neighbours(p)
+        linked = {q.user_id for q in links}
+        lost = old_links - linked
+        # The rider moved out of range of someone: unless each of them still
+        # reaches the rider another way, the cluster has split
+        if lost and not (linked and all(self._reaches(self.points[uid], linked, cluster.members)
+                                        for uid in lost)):
+            self._split(cluster)
+        touched = {q.cluster.id: q.cluster for q in links}
+        touched[p.cluster.id] = p.cluster
+        return self._merge(touched.values()) if len(touched) > 1 else p.cluster
+
+    def _merge(self, clusters) -> Cluster:
+        """Merge clusters into the largest of them and return it"""
+        ordered = sorted(clusters, key=lambda c: len(c.members), reverse=True)
+        cluster = ordered[0]
+        for other in ordered[1:]:
+            for uid in list(other.members):
+                q = self.points[uid]
+                other.remove(q)
+                cluster.add(q)
+            del self.clusters[other.id]
+        return cluster
+
+    def expire(self, now: float) -> None:
+        with self._lock:
+            self._expire(now)
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.window
+        while self._expiry and self._expiry[0][0] <= cutoff:
+            t, uid = self._expiry.popleft()
+            p = self.points.get(uid)
+            # Skip queue entries superseded by a newer fix from the same user
+            if p is not None and p.t == t:
+                self._remove(p)
+
+    def _remove(self, p: Point) -> None:
+        links = self._neighbours(p)
+        del self.points[p.user_id]
+        cell = self.grid[p.cell]
+        cell.discard(p.user_id)
+        if not cell:
+            del self.grid[p.cell]
+        cluster = p.cluster
+        cluster.remove(p)
+        if not cluster.members:
+            del self.clusters[cluster.id]
+        elif len(links) > 1:
+            # A point linked to one neighbour (or none) leaves nothing behind
+            # to split; otherwise the neighbours must still reach each other
+            first = {links[0].user_id}
+            if not all(self._reaches(q, first, cluster.members) for q in links[1:]):
+                self._split(cluster)
+
+    def _reaches(self, start: Point, targets: Set[str], members: Set[str]) -> bool:
+        """Whether start is connected to any of targets; stops at the first one found"""
+        seen = {start.user_id}
+        stack = [start]
+        while stack:
+            for q in self._neighbours(stack.pop(), members):
+                if q.user_id in targets:
+                    return True
+                if q.user_id not in seen:
+                    seen.add(q.user_id)
+                    stack.append(q)
+        return False
+
+    def _split(self, cluster: Cluster) -> None:
+        """Re-flood a cluster that lost a point and split off disconnected parts"""
+        remaining = set(cluster.members)
+        start = next(iter(remaining))
+        reached = {start}
+        stack = [self.points[start]]
+        while stack:
+            for q in self._neighbours(stack.pop(), remaining):
+                if q.user_id not in reached:
+                    reached.add(q.user_id)
+                    stack.append(q)
+        orphans = remaining - reached
+        while orphans:
+            part = Cluster(next(self._ids), self._sizes)
+            self.clusters[part.id] = part
+            seed = orphans.pop()
+            stack = [self.points[seed]]
+            group = {seed}
+            while stack:
+                for q in self._neighbours(stack.pop(), orphans):
+                    orphans.discard(q.user_id)
+                    group.add(q.user_id)
+                    stack.append(q)
+            for uid in group:
+                q = self.points[uid]
+                cluster.remove(q)
+                part.add(q)
+
+    # --- queries --------------------------------------------------------
+    def majority(self, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Largest cluster if it holds more than half of the live points (O(1))"""
+        with self._lock:
+            if now is not None:
+                self._expire(now)
+            c = self._sizes.top()
+            if c is None or len(c.members) < self.min_points or len(c.members) * 2 <= len(self.points):
+                return None
+            lat, lon = c.center
+            return {
+                'center_lat': lat,
+                'center_lon': lon,
+                'point_count': len(c.members),
+                'total_points': len(self.points),
+                'source': 'driver' if c.drivers else 'students',
+            }
+
+    def snapshot(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Clusters with at least min_points members, largest first"""
+        with self._lock:
+            if now is not None:
+                self._expire(now)
+            total = len(self.points)
+            result = []
+            for c in self.clusters.values():
+                if len(c.members) < self.min_points:
+                    continue
+                lat, lon = c.center
+                radius = max(dbm.calculate_distance(lat, lon, self.points[u].lat, self.points[u].lon)
+                             for u in c.members)
+                result.append({
+                    'center_lat': lat,
+                    'center_lon': lon,
+                    'radius': radius,
+                    'point_count': len(c.members),
+                    'is_majority': len(c.members) > total / 2,
+                    'source': 'driver' if c.drivers else 'students',
+                })
+            result.sort(key=lambda c: c['point_count'], reverse=True)
+            return result
+
+
+def batch_clusters(blob: bytes, max_radius: float = MAX_RADIUS,
+                   min_points: int = MIN_POINTS) -> List[Dict[str, Any]]:
+    """Clusters of a ``workers.pack_fixes()`` batch, rebuilt from scratch.
+
+    The newest driver fix (if any) claims every point within ``max_radius``, then each remaining point
+    in turn gathers its unclaimed neighbours and, if enough of them stay
+    within ``max_radius`` of their accuracy-weighted centre, claims them.
+    Fixes must be ordered newest first. Pure computation, so it can run in a
+    worker process (see workers.py).
+    """
+    ids, lats, lons, accs, drivers = unpack_fixes(blob)
+    distance = dbm.calculate_distance
+    n = len(ids)
+    clusters: List[Dict[str, Any]] = []
+    used: Set[int] = set()
+
+    first_driver = next((i for i in range(n) if drivers[i]), None)
+    if first_driver is not None:
+        dlat, dlon = lats[first_driver], lons[first_driver]
+        near = [i for i in range(n) if distance(dlat, dlon, lats[i], lons[i]) <= max_radius]
+        if len(near) >= min_points:
+            clusters.append({'center_lat': dlat, 'center_lon': dlon, 'radius': max_radius,
+                             'point_ids': [ids[i] for i in near], 'source': 'driver'})
+            used.update(near)
+
+    for i in range(n):
+        if i in used:
+            continue
+        near = [j for j in range(n) if j not in used
+                and distance(lats[i], lons[i], lats[j], lons[j]) <= max_radius]
+        if len(near) < min_points:
+            continue
+        # Weight by inverse square of accuracy (capped at 5m)
+        total = weighted_lat = weighted_lon = 0.0
+        for j in near:
+            w = 1 / max(accs[j], 5.0) ** 2
+            total += w
+            weighted_lat += lats[j] * w
+            weighted_lon += lons[j] * w
+        center_lat, center_lon = weighted_lat / total, weighted_lon / total
+        valid, radius = [], 0.0
+        for j in near:
+            d = distance(center_lat, center_lon, lats[j], lons[j])
+            if d <= max_radius:
+                valid.append(j)
+                radius = max(radius, d)
+        if len(valid) >= min_points:
+            clusters.append({'center_lat': center_lat, 'center_lon': center_lon, 'radius': radius,
+                             'point_ids': [ids[j] for j in valid], 'source': 'students'})
+            used.update(valid)
+
+    clusters.sort(key=lambda c: len(c['point_ids']), reverse=True)
+    return clusters
+
+
+_clusterers: Dict[str, OnlineClusterer] = {}
+_registry_lock = threading.Lock()
+
+
+def for_bus(bus_id: str) -> OnlineClusterer:
+    clusterer = _clusterers.get(bus_id)
+    if clusterer is None:
+        with _registry_lock:
+            clusterer = _clusterers.setdefault(bus_id, OnlineClusterer())
+    return clusterer
+
+
+def clear() -> None:
+    with _registry_lock:
+        _clusterers.clear()
@@ -0,0 +1,141 @@
+"""Compact wire encodings for GPS fixes and bus state.
+
+Fixes (request bodies of POST /location/share), chosen by Content-Type:
+
+* ``application/json`` - the default ``{"bus_id", "lat", "lon", "accuracy"}``.
+* ``application/x-bus-fix`` - fixed little-endian struct, 11 bytes plus the
+  bus id: version (u8, =1), lat and lon in microdegrees (i32), accuracy in
+  decimeters (u16), then the UTF-8 bus id filling the rest of the body
+  (empty for the default bus).
+* ``application/msgpack`` - the JSON map in MessagePack, when the
+  ``msgpack`` package is installed.
+
+Responses, chosen by Accept:
+
+* ``application/x-bus-compact+json`` - JSON with the short keys in
+  ``SHORT_KEYS``, null fields left out and ISO timestamps turned into
+  integer epoch seconds.
+* ``application/msgpack`` - the same compact map in MessagePack.
+* anything else - the regular JSON.
+"""
+import json
+import struct
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+FIX_MIMETYPE = 'application/x-bus-fix'
+MSGPACK_MIMETYPE = 'application/msgpack'
+COMPACT_JSON_MIMETYPE = 'application/x-bus-compact+json'
+
+FIX_VERSION = 1
+_FIX = struct.Struct('<BiiH')
+
+SHORT_KEYS = {
+    'bus_id': 'b',
+    'stop_index': 'i',
+    'stop_id': 'si',
+    'stop_name': 'sn',
+    'lat': 'la',
+    'lon': 'lo',
+    'status': 's',
+    'timestamp': 't',
+    'trip_id': 'tr',
+    'location_source': 'src',
+    'location_accuracy': 'acc',
+    'sample_size': 'n',
+    'last_arrival_time': 'ta',
+    'last_departure_time': 'td',
+    'gps_active': 'g',
+    'updated_bus': 'u',
+    'paused': 'p',
+    'rejected': 'r',
+    'next_report_ms': 'nr',
+    'min_move_m': 'mm',
+    'retry_after': 'ra',
+    'error': 'e',
+    'accuracy': 'a',
+    'user_type': 'ut',
+}
+TIMESTAMP_KEYS = ('timestamp', 'last_arrival_time', 'last_departure_time', 'last_update')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def encode_fix(lat: float, lon: float, accuracy: float, bus_id: str = '') -> bytes:
+    return _FIX.pack(FIX_VERSION, round(lat * 1e6), round(lon * 1e6),
+                     min(round(accuracy * 10), 0xFFFF)) + bus_id.encode('utf-8')
+
+
+def decode_fix(mimetype: str, body: bytes) -> Dict[str, Any]:
+    """Decode and validate a fix body in one pass; raises CodecError"""
+    if mimetype == FIX_MIMETYPE:
+        if len(body) < _FIX.size:
+            raise CodecError("Fix too short")
+        version, lat_e6, lon_e6, accuracy_dm = _FIX.unpack_from(body)
+        if version != FIX_VERSION:
+            raise CodecError(f"Unsupported fix version {version}")
+        if not (-90_000_000 <= lat_e6 <= 90_000_000) or not (-180_000_000 <= lon_e6 <= 180_000_000) \
+                or accuracy_dm == 0:
+            raise CodecError("Invalid coordinates or accuracy")
+        data = {'lat': lat_e6 / 1e6, 'lon': lon_e6 / 1e6, 'accuracy': accuracy_dm / 10}
+        if len(body) > _FIX.size:
+            try:
+                data['bus_id'] = body[_FIX.size:].decode('utf-8')
+            except UnicodeDecodeError:
+                raise CodecError("Invalid bus id")
+        return data
+
+    try:
+        if mimetype == MSGPACK_MIMETYPE:
+            if msgpack is None:
+                raise CodecError("MessagePack is not available")
+            data = msgpack.unpackb(body, raw=False)
+        else:
+            data = json.loads(body)
+    except CodecError:
+        raise
+    except Exception:
+        raise CodecError("Malformed body")
+    if not isinstance(data, dict):
+        raise CodecError("Expected an object")
+    return data
+
+
+def _epoch(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return int(datetime.fromisoformat(value).timestamp())
+        except ValueError:
+            return value
+    return value
+
+
+def compact(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Shorten keys, drop nulls and turn ISO timestamps into epoch seconds"""
+    return {
+        SHORT_KEYS.get(key, key): _epoch(value) if key in TIMESTAMP_KEYS else value
+        for key, value in payload.items() if value is not None
+    }
+
+
+def negotiate(accept_mimetypes) -> Optional[str]:
+    """Pick a compact response type from a werkzeug Accept header, or None for JSON"""
+    offered = [COMPACT_JSON_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack is not None else [])
+    # Only explicitly listed types count; */* keeps the regular JSON
+    explicit = {value: quality for value, quality in accept_mimetypes if value in offered and quality > 0}
+    if not explicit:
+        return None
+    return max(explicit, key=explicit.get)
+
+
+def encode_response(payload: Dict[str, Any], mimetype: str) -> Tuple[bytes, str]:
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(compact(payload), use_bin_type=True), MSGPACK_MIMETYPE
+    return json.dumps(compact(payload), separators=(',', ':')).encode('utf-8'), COMPACT_JSON_MIMETYPE
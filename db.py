@@ -1,10 +1,43 @@
+import os
 import sqlite3
+import threading
+import time as time_module
+import zlib
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
-from typing import List, Tuple, Optional, Dict, Any
+from typing import Callable, List, Tuple, Optional, Dict, Any, Iterator
 
 DB_PATH = "bus.db"
 DEFAULT_BUS_ID = "S1/A"
 
+# In-memory mirror of confirmation_counts for each bus's current trip:
+# (bus, stop, trip) -> (count, monotonic time it was read or written). Other
+# workers confirm and reset too, so entries older than CONFIRMATION_TTL
+# seconds are re-read (a primary-key lookup) instead of served.
+_confirmation_counts: Dict[Tuple[str, int, int], Tuple[int, float]] = {}
+_current_trips: Dict[str, int] = {}
+CONFIRMATION_TTL = float(os.environ.get("BUS_CONFIRMATION_TTL", "2"))
+
+# Write-through mirror of bus_state rows and a cache of the (static) stops.
+# Every helper that writes bus_state refreshes the mirror from the row it
+# just wrote, so reads never go to disk. BUS_STATE_CHECK=1 makes every read
+# compare the mirror against SQLite and raise on a mismatch (for tests and
+# replays); invalidate_bus_state()/refresh_bus_states() pick up writes made
+# by other worker processes. Inside a writer transaction (defer_mirror())
+# the updates are held until the batch commits, so readers never see a row
+# that may still be rolled back.
+_bus_states: Dict[str, "BusState"] = {}
+_stops: Optional[List[sqlite3.Row]] = None
+_stops_by_seq: Dict[int, sqlite3.Row] = {}
+STATE_CHECK = os.environ.get("BUS_STATE_CHECK") == "1"
+_deferred = threading.local()
+
+# Per-bus tables (bus_state, user_locations, confirmations, history) can be
+# spread over several SQLite files so buses don't serialize on one writer
+# lock. With a single shard everything lives in DB_PATH as before.
+SHARD_COUNT = int(os.environ.get("BUS_DB_SHARDS", "1"))
+SHARD_KEY = os.environ.get("BUS_DB_SHARD_KEY", "bus")  # 'bus' or 'route'
+
 SEED_STOPS: List[Tuple[str, float, float, int]] = [
     ('Starting Point', 17.495643, 78.335691, 0),
     ('Stop A', 17.495255, 78.340605, 1), 
@@ -21,137 +54,173 @@ def iso_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+def route_for_bus(bus_id: str) -> str:
+    """Route part of a bus id, e.g. 'S1' for 'S1/A'"""
+    return bus_id.split('/', 1)[0]
+
+
+def shard_index(bus_id: str) -> int:
+    """Stable shard number for a bus (crc32 of the bus or route id)"""
+    if SHARD_COUNT <= 1:
+        return 0
+    key = route_for_bus(bus_id) if SHARD_KEY == 'route' else bus_id
+    return zlib.crc32(key.encode('utf-8')) % SHARD_COUNT
+
+
+def shard_path(index: int) -> str:
+    if SHARD_COUNT <= 1:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{index}{ext}"
+
+
+def all_shard_paths() -> List[str]:
+    return [shard_path(i) for i in range(max(SHARD_COUNT, 1))]
+
+
+def get_conn(bus_id: Optional[str] = None, path: Optional[str] = None) -> sqlite3.Connection:
+    """Open a connection to the main database, the shard holding bus_id, or the file at path"""
+    if path is None:
+        path = DB_PATH if bus_id is None else shard_path(shard_index(bus_id))
+    conn = sqlite3.connect(path)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+@contextmanager
+def connection(bus_id: Optional[str] = None, conn: Optional[sqlite3.Connection] = None,
+               path: Optional[str] = None) -> Iterator[sqlite3.Connection]:
+    """Use the caller's connection, or open one that commits and closes on exit.
+
+    Write helpers accept an optional ``conn`` so several of them can run in
+    one transaction (see writer.py); without it each call commits on its own.
+    """
+    if conn is not None:
+        yield conn
+        return
+    conn = get_conn(bus_id, path)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def iter_shard_conns() -> Iterator[sqlite3.Connection]:
+    """Yield a connection to every shard in turn (for fleet-wide reads)"""
+    for path in all_shard_paths():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
 def init_db() -> None:
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Create stops table
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS stops(
-            id INTEGER PRIMARY KEY,
-            name TEXT,
-            lat REAL,
-            lon REAL,
-            seq INTEGER
-        )
-        """
-    )
-    
-    # Create enhanced bus_state table
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS bus_state(
-            bus_id TEXT PRIMARY KEY,
-            stop_index INTEGER,
-            lat REAL,
-            lon REAL,
-            timestamp TEXT,
-            status TEXT,  -- 'arrived', 'departing', etc
-            location_source TEXT,  -- 'driver', 'students', 'last_known'
-            location_accuracy REAL,
-            sample_size INTEGER,
-            last_arrival_time TEXT,
-            last_departure_time TEXT
-        )
-        """
-    )
-    
-    # Create confirmations table
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS confirmations(
-            id INTEGER PRIMARY KEY,
-            bus_id TEXT,
-            stop_id INTEGER,
-            user_type TEXT,
-            user_id TEXT,
-            timestamp TEXT
-        )
-        """
-    )
-    
-    # Create enhanced user_locations table
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS user_locations(
-            id INTEGER PRIMARY KEY,
-            bus_id TEXT,
-            user_id TEXT,
-            user_type TEXT,
-            lat REAL,
-            lon REAL,
-            accuracy REAL,
-            speed REAL,
-            heading REAL,
-            timestamp TEXT,
-            cluster_id INTEGER,  -- For tracking which cluster this point belongs to
-            weight REAL,         -- For weighted aggregation
-            UNIQUE(bus_id, user_id) ON CONFLICT REPLACE
-        )
-        """
-    )
-    
-    # Create location_clusters table
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS location_clusters(
-            id INTEGER PRIMARY KEY,
-            bus_id TEXT,
-            lat REAL,
-            lon REAL,
-            radius REAL,
-            point_count INTEGER,
-            total_points INTEGER,
-            timestamp TEXT,
-            is_majority BOOLEAN
-        )
-        """
-    )
-    conn.commit()
-
-    # Reseed stops every run to enforce the configured list
-    cur.execute("DELETE FROM stops")
-    for name, lat, lon, seq in SEED_STOPS:
-        cur.execute(
-            "INSERT INTO stops(name, lat, lon, seq) VALUES (?, ?, ?, ?)",
-            (name, lat, lon, seq),
-        )
-    conn.commit()
+    """Create or upgrade the schema, then reset everything to the seed data.
 
-    # Reset bus to first stop every run
-    cur.execute("SELECT id, lat, lon FROM stops ORDER BY seq LIMIT 1")
-    first = cur.fetchone()
+    Destructive - meant for fresh databases in tools (replay, bench) and the
+    ``flask --app app seed`` admin command. Application startup only runs
+    ``migrations.migrate_all()``.
+    """
+    import migrations
+    migrations.migrate_all()
+    seed_database()
+
+
+def seed_database() -> None:
+    """Reseed stops, put the default bus back at the first stop and clear confirmations"""
+    # Stops are small and read-only, so every shard carries its own copy
+    # and per-bus queries can join against them without leaving the shard.
+    paths = [DB_PATH] + [p for p in all_shard_paths() if p != DB_PATH]
+    for path in paths:
+        conn = sqlite3.connect(path)
+        conn.execute("DELETE FROM stops")
+        conn.executemany("INSERT INTO stops(name, lat, lon, seq) VALUES (?, ?, ?, ?)", SEED_STOPS)
+        conn.execute("DELETE FROM confirmations")
+        conn.execute("DELETE FROM confirmation_counts")
+        conn.commit()
+        conn.close()
+    _confirmation_counts.clear()
+    _current_trips.clear()
+    invalidate_bus_state()
+    invalidate_stops()
+
+    conn = get_conn(DEFAULT_BUS_ID)
+    first = conn.execute("SELECT lat, lon FROM stops ORDER BY seq LIMIT 1").fetchone()
     if first:
-        stop_index = 0
-        lat = first[1]
-        lon = first[2]
-        ts = iso_now()
-        cur.execute(
+        conn.execute(
             "REPLACE INTO bus_state(bus_id, stop_index, lat, lon, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (DEFAULT_BUS_ID, stop_index, lat, lon, ts),
+            (DEFAULT_BUS_ID, 0, first["lat"], first["lon"], iso_now()),
         )
-        # Clear confirmations on startup for simplicity
-        cur.execute("DELETE FROM confirmations")
         conn.commit()
     conn.close()
 
 
 def get_stops() -> List[sqlite3.Row]:
-    conn = get_conn()
-    rows = conn.execute("SELECT * FROM stops ORDER BY seq").fetchall()
-    conn.close()
-    return rows
+    """All stops in route order, read from disk once and then cached"""
+    global _stops
+    if _stops is None:
+        conn = get_conn()
+        rows = conn.execute("SELECT * FROM stops ORDER BY seq, id").fetchall()
+        conn.close()
+        by_seq: Dict[int, sqlite3.Row] = {}
+        for row in rows:
+            by_seq.setdefault(row["seq"], row)
+        _stops_by_seq.clear()
+        _stops_by_seq.update(by_seq)
+        _stops = rows
+    return _stops
+
+
+def invalidate_stops() -> None:
+    global _stops
+    _stops = None
+    _stops_by_seq.clear()
+
+
+def ensure_bus(bus_id: str, conn: Optional[sqlite3.Connection] = None) -> None:
+    """Create a bus_state row at the first stop if the bus is not known yet"""
+    with connection(bus_id, conn) as conn:
+        first = conn.execute("SELECT lat, lon FROM stops ORDER BY seq LIMIT 1").fetchone()
+        if first:
+            conn.execute(
+                "INSERT OR IGNORE INTO bus_state(bus_id, stop_index, lat, lon, timestamp) VALUES (?, 0, ?, ?, ?)",
+                (bus_id, first["lat"], first["lon"], iso_now()),
+            )
+    _bus_states.pop(bus_id, None)
 
 
-def get_bus_state(bus_id: str) -> Optional[sqlite3.Row]:
-    conn = get_conn()
+BUS_STATE_FIELDS = (
+    'bus_id', 'stop_index', 'lat', 'lon', 'timestamp', 'status', 'location_source',
+    'location_accuracy', 'sample_size', 'last_arrival_time', 'last_departure_time', 'trip_id',
+)
+
+
+class BusState:
+    """Immutable in-memory copy of a bus_state row; reads like a sqlite3.Row"""
+    __slots__ = BUS_STATE_FIELDS
+
+    def __init__(self, row) -> None:
+        for field in BUS_STATE_FIELDS:
+            object.__setattr__(self, field, row[field])
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("BusState is read-only; write through the db helpers")
+
+    def keys(self) -> Tuple[str, ...]:
+        return BUS_STATE_FIELDS
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, key)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in BUS_STATE_FIELDS}
+
+
+def _read_bus_state(bus_id: str) -> Optional[sqlite3.Row]:
+    conn = get_conn(bus_id)
     row = conn.execute(
         "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
     ).fetchone()
@@ -159,288 +228,516 @@ def get_bus_state(bus_id: str) -> Optional[sqlite3.Row]:
     return row
 
 
-def update_bus_location(bus_id: str, lat: float, lon: float) -> Dict[str, Any]:
-    ts = iso_now()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE bus_state SET lat = ?, lon = ?, timestamp = ? WHERE bus_id = ?",
-        (lat, lon, ts, bus_id),
-    )
-    conn.commit()
-    row = cur.execute(
-        "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
-    ).fetchone()
-    conn.close()
-    return dict(row) if row else {}
+def defer_mirror() -> List[Callable[[], None]]:
+    """Hold this thread's mirror updates until publish_mirror()/discard_mirror().
 
+    The writer wraps each batch in this: helpers called with its connection
+    have not committed when they return. The returned list can be truncated
+    to drop the updates of an intent rolled back to its savepoint.
+    """
+    _deferred.pending = []
+    return _deferred.pending
 
-def move_bus_to_next_stop(bus_id: str) -> Dict[str, Any]:
-    conn = get_conn()
-    cur = conn.cursor()
-    bus = cur.execute(
-        "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
-    ).fetchone()
-    stops = cur.execute("SELECT * FROM stops ORDER BY seq").fetchall()
-    if not bus or not stops:
-        conn.close()
-        return {}
 
-    current_index = bus["stop_index"]
-    next_index = current_index + 1
-    if next_index >= len(stops):
-        # Stay at last stop by default
-        next_index = current_index
-    target_stop = stops[next_index]
+def publish_mirror() -> None:
+    """Apply the held mirror updates (call after COMMIT) and stop deferring"""
+    pending = getattr(_deferred, 'pending', None)
+    _deferred.pending = None
+    for update in pending or ():
+        update()
+
 
+def discard_mirror() -> None:
+    """Drop the held mirror updates (the transaction rolled back) and stop deferring"""
+    _deferred.pending = None
+
+
+def _after_commit(update: Callable[[], None]) -> None:
+    pending = getattr(_deferred, 'pending', None)
+    if pending is None:
+        update()
+    else:
+        pending.append(update)
+
+
+def _remember_state(row: Optional[sqlite3.Row]) -> Dict[str, Any]:
+    """Mirror a bus_state row just written (once committed) and return it as a dict"""
+    if row is None:
+        return {}
+    state = BusState(row)
+
+    def publish() -> None:
+        current = _bus_states.get(state.bus_id)
+        # Concurrent inline writers may finish out of order; keep the newest row
+        if current is None or (current.timestamp or '') <= (state.timestamp or ''):
+            _bus_states[state.bus_id] = state
+
+    _after_commit(publish)
+    return state.as_dict()
+
+
+def get_bus_state(bus_id: str) -> Optional[BusState]:
+    """Current state of a bus, served from the in-memory mirror"""
+    state = _bus_states.get(bus_id)
+    if state is None:
+        row = _read_bus_state(bus_id)
+        if row is None:
+            return None
+        state = _bus_states.setdefault(bus_id, BusState(row))
+    elif STATE_CHECK:
+        row = _read_bus_state(bus_id)
+        on_disk = BusState(row).as_dict() if row else None
+        if on_disk != state.as_dict():
+            raise AssertionError(f"bus_state mirror for {bus_id} is {state.as_dict()}, disk has {on_disk}")
+    return state
+
+
+def invalidate_bus_state(bus_id: Optional[str] = None) -> None:
+    """Forget the mirrored state of one bus (or all) so the next read reloads it"""
+    if bus_id is None:
+        _bus_states.clear()
+    else:
+        _bus_states.pop(bus_id, None)
+
+
+def refresh_bus_states() -> int:
+    """Reload every mirrored bus from disk (one query per shard).
+
+    Picks up writes made by other worker processes; returns how many
+    mirrored states changed.
+    """
+    changed = 0
+    for row in get_all_bus_states():
+        state = BusState(row)
+        current = _bus_states.get(state.bus_id)
+        if current is not None and current.as_dict() != state.as_dict():
+            _bus_states[state.bus_id] = state
+            changed += 1
+    return changed
+
+
+def update_bus_location(bus_id: str, lat: float, lon: float,
+                        conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
     ts = iso_now()
-    cur.execute(
-        "UPDATE bus_state SET stop_index = ?, lat = ?, lon = ?, timestamp = ? WHERE bus_id = ?",
-        (next_index, target_stop["lat"], target_stop["lon"], ts, bus_id),
-    )
-    conn.commit()
-    new_state = cur.execute(
-        "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
-    ).fetchone()
-    conn.close()
-    return dict(new_state) if new_state else {}
+    with connection(bus_id, conn) as conn:
+        conn.execute(
+            "UPDATE bus_state SET lat = ?, lon = ?, timestamp = ? WHERE bus_id = ?",
+            (lat, lon, ts, bus_id),
+        )
+        row = conn.execute(
+            "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
+        ).fetchone()
+    return _remember_state(row)
+
+
+def move_bus_to_next_stop(bus_id: str, conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
+    with connection(bus_id, conn) as conn:
+        bus = conn.execute(
+            "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
+        ).fetchone()
+        stops = conn.execute("SELECT * FROM stops ORDER BY seq").fetchall()
+        if not bus or not stops:
+            return {}
+
+        current_index = bus["stop_index"]
+        next_index = current_index + 1
+        if next_index >= len(stops):
+            # Stay at last stop by default
+            next_index = current_index
+        target_stop = stops[next_index]
+
+        ts = iso_now()
+        conn.execute(
+            "UPDATE bus_state SET stop_index = ?, lat = ?, lon = ?, timestamp = ? WHERE bus_id = ?",
+            (next_index, target_stop["lat"], target_stop["lon"], ts, bus_id),
+        )
+        new_state = conn.execute(
+            "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
+        ).fetchone()
+    return _remember_state(new_state)
 
 
-def insert_confirmation(bus_id: str, stop_id: int, user_type: str, user_id: str) -> None:
-    conn = get_conn()
-    conn.execute(
-        "INSERT INTO confirmations(bus_id, stop_id, user_type, user_id, timestamp) VALUES (?, ?, ?, ?, ?)",
-        (bus_id, stop_id, user_type, user_id, iso_now()),
-    )
-    conn.commit()
-    conn.close()
+def _trip_id(conn: sqlite3.Connection, bus_id: str) -> int:
+    row = conn.execute("SELECT trip_id FROM bus_state WHERE bus_id = ?", (bus_id,)).fetchone()
+    return int(row["trip_id"] or 0) if row else 0
+
+
+def get_trip_id(bus_id: str) -> int:
+    """The bus's committed trip id, read from disk (it changes on every reset)"""
+    conn = get_conn(bus_id)
+    try:
+        return _trip_id(conn, bus_id)
+    finally:
+        conn.close()
+
+
+def insert_confirmation(bus_id: str, stop_id: int, user_type: str, user_id: str,
+                        conn: Optional[sqlite3.Connection] = None) -> int:
+    """Record a confirmation and return the number of distinct confirming users.
+
+    Every tap is kept in the confirmations table for auditing, but the
+    counter for the bus/stop/trip only moves the first time a user confirms.
+    """
+    with connection(bus_id, conn) as conn:
+        trip_id = _trip_id(conn, bus_id)
+        seen = conn.execute(
+            """SELECT 1 FROM confirmations
+               WHERE bus_id = ? AND stop_id = ? AND trip_id = ? AND user_id = ? LIMIT 1""",
+            (bus_id, stop_id, trip_id, user_id),
+        ).fetchone()
+        conn.execute(
+            "INSERT INTO confirmations(bus_id, stop_id, user_type, user_id, timestamp, trip_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (bus_id, stop_id, user_type, user_id, iso_now(), trip_id),
+        )
+        if not seen:
+            conn.execute(
+                """INSERT INTO confirmation_counts(bus_id, stop_id, trip_id, count) VALUES (?, ?, ?, 1)
+                   ON CONFLICT(bus_id, stop_id, trip_id) DO UPDATE SET count = count + 1""",
+                (bus_id, stop_id, trip_id),
+            )
+        row = conn.execute(
+            "SELECT count FROM confirmation_counts WHERE bus_id = ? AND stop_id = ? AND trip_id = ?",
+            (bus_id, stop_id, trip_id),
+        ).fetchone()
+    count = int(row["count"]) if row else 0
+    _after_commit(lambda: _remember_count(bus_id, stop_id, trip_id, count))
+    return count
 
 
 def count_confirmations(bus_id: str, stop_id: int) -> int:
-    conn = get_conn()
+    """Distinct confirmations for the bus's current trip, served from memory while fresh"""
+    trip_id = _current_trips.get(bus_id)
+    if trip_id is not None:
+        cached = _confirmation_counts.get((bus_id, stop_id, trip_id))
+        if cached is not None and time_module.monotonic() - cached[1] < CONFIRMATION_TTL:
+            return cached[0]
+    conn = get_conn(bus_id)
+    trip_id = _trip_id(conn, bus_id)
     row = conn.execute(
-        "SELECT COUNT(*) AS c FROM confirmations WHERE bus_id = ? AND stop_id = ?",
-        (bus_id, stop_id),
+        "SELECT count FROM confirmation_counts WHERE bus_id = ? AND stop_id = ? AND trip_id = ?",
+        (bus_id, stop_id, trip_id),
     ).fetchone()
     conn.close()
-    return int(row[0]) if row else 0
+    count = int(row["count"]) if row else 0
+    _remember_count(bus_id, stop_id, trip_id, count)
+    return count
+
+
+def _start_trip(bus_id: str, trip_id: int) -> None:
+    """Drop the in-memory counters of the bus's previous trip"""
+    for key in [k for k in _confirmation_counts if k[0] == bus_id]:
+        del _confirmation_counts[key]
+    _current_trips[bus_id] = trip_id
+
+
+def _remember_count(bus_id: str, stop_id: int, trip_id: int, count: int) -> None:
+    if _current_trips.get(bus_id) != trip_id:
+        _start_trip(bus_id, trip_id)
+    key = (bus_id, stop_id, trip_id)
+    # Counts only grow within a trip, so a racing read can't lower them
+    previous = _confirmation_counts.get(key, (0, 0.0))[0]
+    _confirmation_counts[key] = (max(count, previous), time_module.monotonic())
 
 
 def current_stop_for_index(stop_index: int) -> Optional[sqlite3.Row]:
-    conn = get_conn()
-    row = conn.execute(
-        "SELECT * FROM stops WHERE seq = ?", (stop_index,)
-    ).fetchone()
-    conn.close()
-    return row
+    get_stops()
+    return _stops_by_seq.get(stop_index)
 
-def reset_bus_to_starting_stop(bus_id: str) -> Dict[str, Any]:
+def reset_bus_to_starting_stop(bus_id: str, conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
     """Reset bus to the first stop (stop_index = 0)"""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Get first stop
-    first_stop = cur.execute(
-        "SELECT * FROM stops ORDER BY seq LIMIT 1"
-    ).fetchone()
-    
-    if not first_stop:
-        conn.close()
-        return {}
-    
-    ts = iso_now()
-    cur.execute(
-        """UPDATE bus_state 
-           SET stop_index = 0, lat = ?, lon = ?, timestamp = ?, 
-               status = NULL, location_source = NULL
-           WHERE bus_id = ?""",
-        (first_stop["lat"], first_stop["lon"], ts, bus_id)
-    )
-    conn.commit()
-    
-    # Clear confirmations
-    cur.execute("DELETE FROM confirmations WHERE bus_id = ?", (bus_id,))
-    conn.commit()
-    
-    # Get updated state
-    new_state = cur.execute(
-        "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
-    ).fetchone()
-    conn.close()
-    
-    return dict(new_state) if new_state else {}
+    with connection(bus_id, conn) as conn:
+        # Get first stop
+        first_stop = conn.execute(
+            "SELECT * FROM stops ORDER BY seq LIMIT 1"
+        ).fetchone()
 
-def set_bus_to_stop(bus_id: str, stop_index: int) -> Dict[str, Any]:
+        if not first_stop:
+            return {}
+
+        ts = iso_now()
+        conn.execute(
+            """UPDATE bus_state 
+               SET stop_index = 0, lat = ?, lon = ?, timestamp = ?, 
+                   status = NULL, location_source = NULL
+               WHERE bus_id = ?""",
+            (first_stop["lat"], first_stop["lon"], ts, bus_id)
+        )
+
+        # Start a new trip: confirmation counters restart from zero while the
+        # raw confirmations are kept for auditing
+        conn.execute("UPDATE bus_state SET trip_id = COALESCE(trip_id, 0) + 1 WHERE bus_id = ?", (bus_id,))
+        conn.execute(
+            "DELETE FROM confirmation_counts WHERE bus_id = ? AND trip_id < ?",
+            (bus_id, _trip_id(conn, bus_id)),
+        )
+
+        # Get updated state
+        new_state = conn.execute(
+            "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
+        ).fetchone()
+
+    if new_state:
+        trip_id = new_state["trip_id"]
+        _after_commit(lambda: _start_trip(bus_id, trip_id))
+    return _remember_state(new_state)
+
+def set_bus_to_stop(bus_id: str, stop_index: int, conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
     """Set bus to a specific stop index"""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Get target stop
-    stop = cur.execute(
-        "SELECT * FROM stops WHERE seq = ?", (stop_index,)
-    ).fetchone()
-    
-    if not stop:
-        conn.close()
-        return {}
-    
+    with connection(bus_id, conn) as conn:
+        # Get target stop
+        stop = conn.execute(
+            "SELECT * FROM stops WHERE seq = ?", (stop_index,)
+        ).fetchone()
+
+        if not stop:
+            return {}
+
+        ts = iso_now()
+        conn.execute(
+            """UPDATE bus_state 
+               SET stop_index = ?, lat = ?, lon = ?, timestamp = ?
+               WHERE bus_id = ?""",
+            (stop_index, stop["lat"], stop["lon"], ts, bus_id)
+        )
+
+        # Get updated state
+        new_state = conn.execute(
+            "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
+        ).fetchone()
+
+    return _remember_state(new_state)
+
+def update_user_location(bus_id: str, user_id: str, user_type: str, lat: float, lon: float, accuracy: float,
+                         conn: Optional[sqlite3.Connection] = None) -> None:
+    """Update a user's location in the database"""
     ts = iso_now()
-    cur.execute(
-        """UPDATE bus_state 
-           SET stop_index = ?, lat = ?, lon = ?, timestamp = ?
-           WHERE bus_id = ?""",
-        (stop_index, stop["lat"], stop["lon"], ts, bus_id)
-    )
-    conn.commit()
-    
-    # Get updated state
-    new_state = cur.execute(
-        "SELECT * FROM bus_state WHERE bus_id = ?", (bus_id,)
-    ).fetchone()
-    conn.close()
-    
-    return dict(new_state) if new_state else {} 
+    with connection(bus_id, conn) as conn:
+        conn.execute(
+            """
+            INSERT INTO user_locations(bus_id, user_id, user_type, lat, lon, accuracy, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (bus_id, user_id, user_type, lat, lon, accuracy, ts)
+        )
+        conn.execute(
+            """
+            INSERT INTO location_history(bus_id, user_id, user_type, lat, lon, accuracy, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (bus_id, user_id, user_type, lat, lon, accuracy, ts)
+        )
+
+def record_stop_event(bus_id: str, stop_index: int, event: str, source: Optional[str],
+                      conn: Optional[sqlite3.Connection] = None) -> None:
+    """Append an arrival/departure to the bus's stop-event history"""
+    with connection(bus_id, conn) as conn:
+        conn.execute(
+            "INSERT INTO stop_events(bus_id, stop_index, event, source, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (bus_id, stop_index, event, source, iso_now()),
+        )
+
+def get_all_bus_states() -> List[sqlite3.Row]:
+    """Read bus_state rows of the whole fleet, across all shards"""
+    rows: List[sqlite3.Row] = []
+    for conn in iter_shard_conns():
+        rows.extend(conn.execute("SELECT * FROM bus_state").fetchall())
+    rows.sort(key=lambda r: r["bus_id"])
+    return rows
 
-def check_stop_proximity(bus_id: str, lat: float, lon: float) -> Dict[str, Any]:
+def get_fleet_overview(route: Optional[str] = None, after: Optional[str] = None,
+                       limit: int = 100) -> List[sqlite3.Row]:
+    """Bus states joined with their current and next stop, one query per shard.
+
+    Rows are ordered by bus_id; ``after`` is a keyset cursor (the last
+    bus_id of the previous page) and ``route`` keeps only that route's buses.
     """
-    Check proximity to stops using dual-radius system
-    Returns dict with:
-    - arrived: bool - whether bus has arrived at a stop
-    - departed: bool - whether bus has departed from current stop
-    - next_stop: bool - whether near next stop
-    - stop_id: int - ID of relevant stop if any
+    query = """
+        SELECT b.*,
+               s.id AS stop_id, s.name AS stop_name,
+               n.name AS next_stop_name, n.lat AS next_lat, n.lon AS next_lon
+        FROM bus_state b
+        LEFT JOIN stops s ON s.id = (SELECT id FROM stops WHERE seq = b.stop_index ORDER BY id LIMIT 1)
+        LEFT JOIN stops n ON n.id = (SELECT id FROM stops WHERE seq = b.stop_index + 1 ORDER BY id LIMIT 1)
+        WHERE b.bus_id > ?
+          AND (? IS NULL OR b.bus_id = ? OR substr(b.bus_id, 1, length(?) + 1) = ? || '/')
+        ORDER BY b.bus_id
+        LIMIT ?
     """
-    ARRIVAL_RADIUS = 40  # meters
-    DEPARTURE_RADIUS = 80  # meters
-    
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Get current bus state
-    state = cur.execute("""
-        SELECT stop_index, status, last_arrival_time, last_departure_time
-        FROM bus_state WHERE bus_id = ?
-    """, (bus_id,)).fetchone()
-    
-    if not state:
+    params = (after or '', route, route, route, route, limit)
+    rows: List[sqlite3.Row] = []
+    for conn in iter_shard_conns():
+        rows.extend(conn.execute(query, params).fetchall())
+    rows.sort(key=lambda r: r["bus_id"])
+    return rows[:limit]
+
+def get_fleet_recent_locations(max_age_seconds: int = 60) -> List[sqlite3.Row]:
+    """Recent user locations of every bus, across all shards"""
+    cutoff_time = (datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)).isoformat()
+    rows: List[sqlite3.Row] = []
+    for conn in iter_shard_conns():
+        rows.extend(conn.execute(
+            "SELECT * FROM user_locations WHERE timestamp > ?", (cutoff_time,)
+        ).fetchall())
+    rows.sort(key=lambda r: r["timestamp"], reverse=True)
+    return rows
+
+DOWNSAMPLE_SLICE = timedelta(hours=1)  # history thinned per write intent
+
+def thin_history_slice(path: str, start: str, end: str, bucket_seconds: int = 60,
+                       conn: Optional[sqlite3.Connection] = None) -> int:
+    """Keep one fix per user per bucket of one shard's history in [start, end)"""
+    with connection(path=path, conn=conn) as conn:
+        return conn.execute(
+            """
+            DELETE FROM location_history
+            WHERE timestamp >= ? AND timestamp < ? AND id NOT IN (
+                SELECT MIN(id) FROM location_history
+                WHERE timestamp >= ? AND timestamp < ?
+                GROUP BY bus_id, user_id, CAST(strftime('%s', timestamp) AS INTEGER) / ?
+            )
+            """,
+            (start, end, start, end, bucket_seconds),
+        ).rowcount
+
+def _first_history_at(path: str, start: str, end: str) -> Optional[str]:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT MIN(timestamp) FROM location_history WHERE timestamp >= ? AND timestamp < ?",
+                            (start, end)).fetchone()[0]
+    finally:
         conn.close()
-        return {'arrived': False, 'departed': False, 'next_stop': False}
-    
-    current_stop = cur.execute("""
-        SELECT * FROM stops WHERE seq = ?
-    """, (state['stop_index'],)).fetchone()
-    
-    next_stop = cur.execute("""
-        SELECT * FROM stops WHERE seq = ?
-    """, (state['stop_index'] + 1,)).fetchone()
-    
-    result = {
-        'arrived': False,
-        'departed': False,
-        'next_stop': False,
-        'stop_id': None
-    }
-    
-    # Check current stop
-    if current_stop:
-        dist = calculate_distance(lat, lon, current_stop['lat'], current_stop['lon'])
-        if dist <= ARRIVAL_RADIUS and state['status'] != 'arrived':
-            result['arrived'] = True
-            result['stop_id'] = current_stop['id']
-        elif dist > DEPARTURE_RADIUS and state['status'] == 'arrived':
-            # Only mark as departed if we've been at the stop for at least 10 seconds
-            if state['last_arrival_time']:
-                arrival_time = datetime.fromisoformat(state['last_arrival_time'])
-                if datetime.now(timezone.utc) - arrival_time > timedelta(seconds=10):
-                    result['departed'] = True
-                    result['stop_id'] = current_stop['id']
-    
-    # Check next stop
-    if next_stop and not result['arrived'] and not result['departed']:
-        dist = calculate_distance(lat, lon, next_stop['lat'], next_stop['lon'])
-        if dist <= ARRIVAL_RADIUS:
-            result['next_stop'] = True
-            result['stop_id'] = next_stop['id']
-    
-    conn.close()
-    return result
 
-def update_bus_state_with_location(bus_id: str, location: Dict[str, Any]) -> Dict[str, Any]:
-    """Update bus state with new location data and handle stop proximity"""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Update location and basic state
-    now = iso_now()
-    cur.execute("""
-        UPDATE bus_state 
-        SET lat = ?, lon = ?, location_accuracy = ?, 
-            location_source = ?, sample_size = ?,
-            timestamp = ?
-        WHERE bus_id = ?
-    """, (
-        location['center_lat'], location['center_lon'],
-        location.get('accuracy', None),
-        location['source'],
-        len(location['points']) if 'points' in location else None,
-        now, bus_id
-    ))
-    
-    # Check stop proximity
-    proximity = check_stop_proximity(
-        bus_id, location['center_lat'], location['center_lon']
-    )
-    
-    if proximity['arrived']:
-        # Mark as arrived at current stop
-        cur.execute("""
-            UPDATE bus_state 
-            SET status = 'arrived', last_arrival_time = ?
-            WHERE bus_id = ?
-        """, (now, bus_id))
-    elif proximity['departed']:
-        # Mark as departed from current stop
-        cur.execute("""
-            UPDATE bus_state 
-            SET status = 'departing', last_departure_time = ?
-            WHERE bus_id = ?
-        """, (now, bus_id))
-    elif proximity['next_stop']:
-        # Move to next stop
-        cur.execute("""
-            UPDATE bus_state 
-            SET stop_index = stop_index + 1,
-                status = 'arrived',
-                last_arrival_time = ?
-            WHERE bus_id = ?
-        """, (now, bus_id))
-    
-    conn.commit()
-    
-    # Get updated state
-    state = cur.execute("""
-        SELECT * FROM bus_state WHERE bus_id = ?
-    """, (bus_id,)).fetchone()
-    
-    conn.close()
-    return dict(state) if state else {}
+def downsample_location_history(keep_hours: float = 24.0, bucket_seconds: int = 60) -> int:
+    """Thin history older than keep_hours to one fix per user per bucket.
 
-def update_user_location(bus_id: str, user_id: str, user_type: str, lat: float, lon: float, accuracy: float) -> None:
-    """Update a user's location in the database"""
-    conn = get_conn()
-    conn.execute(
-        """
-        INSERT INTO user_locations(bus_id, user_id, user_type, lat, lon, accuracy, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (bus_id, user_id, user_type, lat, lon, accuracy, iso_now())
-    )
-    conn.commit()
-    conn.close()
+    The deletes go through the write queue one hour of one shard at a time
+    (hours are whole buckets), so request writes wait for at most one slice.
+    Returns the number of rows deleted across all shards.
+    """
+    from writer import writes
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=keep_hours)
+    deleted = 0
+    for path in all_shard_paths():
+        first = _first_history_at(path, '', cutoff.isoformat())
+        while first is not None:
+            start = datetime.fromisoformat(first).astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+            end = min(start + DOWNSAMPLE_SLICE, cutoff)
+            deleted += writes.call_shard(path, thin_history_slice, path, start.isoformat(), end.isoformat(),
+                                         bucket_seconds)
+            first = _first_history_at(path, end.isoformat(), cutoff.isoformat())
+    return deleted
+
+def optimize_databases(vacuum: bool = False) -> None:
+    """Refresh query planner statistics (and optionally VACUUM) on every file"""
+    paths = [DB_PATH] + [p for p in all_shard_paths() if p != DB_PATH]
+    for path in paths:
+        # VACUUM refuses to run inside a transaction, so use autocommit
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.execute("ANALYZE")
+            if vacuum:
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+def revoke_token(token_id: str, expires: float) -> None:
+    with connection() as conn:
+        conn.execute("INSERT OR REPLACE INTO revoked_tokens(token_id, expires) VALUES (?, ?)",
+                     (token_id, expires))
+
+def get_revoked_tokens(now: float) -> Dict[str, float]:
+    """Revoked token ids that have not expired yet -> expiry"""
+    with connection() as conn:
+        rows = conn.execute("SELECT token_id, expires FROM revoked_tokens WHERE expires > ?", (now,)).fetchall()
+    return {row['token_id']: row['expires'] for row in rows}
+
+def prune_revoked_tokens(now: float) -> int:
+    with connection() as conn:
+        return conn.execute("DELETE FROM revoked_tokens WHERE expires <= ?", (now,)).rowcount
+
+def insert_alert_subscription(user_id: str, bus_id: str, stop_seq: int, stop_name: str,
+                              stops_before: Optional[int], minutes_before: Optional[float], created: float,
+                              conn: Optional[sqlite3.Connection] = None) -> int:
+    with connection(conn=conn) as conn:
+        return conn.execute(
+            """
+            INSERT INTO alert_subscriptions(user_id, bus_id, stop_seq, stop_name, stops_before, minutes_before, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, bus_id, stop_seq, stop_name, stops_before, minutes_before, created)
+        ).lastrowid
+
+def delete_alert_subscription(sub_id: int, user_id: Optional[str] = None,
+                              conn: Optional[sqlite3.Connection] = None) -> bool:
+    with connection(conn=conn) as conn:
+        if user_id is None:
+            return conn.execute("DELETE FROM alert_subscriptions WHERE id = ?", (sub_id,)).rowcount > 0
+        return conn.execute("DELETE FROM alert_subscriptions WHERE id = ? AND user_id = ?",
+                            (sub_id, user_id)).rowcount > 0
+
+def get_alert_subscriptions(user_id: Optional[str] = None) -> Tuple[List[sqlite3.Row], int]:
+    """Open subscriptions (all, or one user's), and the highest id ever handed out before reading them"""
+    with connection() as conn:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'alert_subscriptions'").fetchone()
+        if user_id is None:
+            rows = conn.execute("SELECT * FROM alert_subscriptions ORDER BY id").fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM alert_subscriptions WHERE user_id = ? ORDER BY id",
+                                (user_id,)).fetchall()
+    return rows, row['seq'] if row else 0
+
+def fire_alert(sub_id: int, user_id: str, payload: str, created: float,
+               conn: Optional[sqlite3.Connection] = None) -> bool:
+    """Retire a subscription and queue its alert; False if another worker fired or cancelled it first"""
+    with connection(conn=conn) as conn:
+        if conn.execute("DELETE FROM alert_subscriptions WHERE id = ?", (sub_id,)).rowcount == 0:
+            return False
+        conn.execute("INSERT INTO alert_deliveries(user_id, payload, created) VALUES (?, ?, ?)",
+                     (user_id, payload, created))
+        return True
+
+def last_alert_delivery_id() -> int:
+    with connection() as conn:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'alert_deliveries'").fetchone()
+    return row['seq'] if row else 0
+
+def get_alert_deliveries(after_id: int) -> List[sqlite3.Row]:
+    """Alerts fired since ``after_id``, oldest first"""
+    with connection() as conn:
+        return conn.execute("SELECT id, user_id, payload FROM alert_deliveries WHERE id > ? ORDER BY id",
+                            (after_id,)).fetchall()
+
+def get_undelivered_alerts(user_id: str, up_to: int, limit: int) -> List[sqlite3.Row]:
+    """The user's newest ``limit`` alerts no stream has received yet, oldest first"""
+    with connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT id, payload FROM alert_deliveries
+            WHERE user_id = ? AND delivered = 0 AND id <= ?
+            ORDER BY id DESC LIMIT ?
+            """,
+            (user_id, up_to, limit)
+        ).fetchall()
+    return rows[::-1]
+
+def count_undelivered_alerts(user_id: str) -> int:
+    with connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM alert_deliveries WHERE user_id = ? AND delivered = 0",
+                            (user_id,)).fetchone()[0]
+
+def mark_alerts_delivered(ids: List[int], conn: Optional[sqlite3.Connection] = None) -> None:
+    with connection(conn=conn) as conn:
+        conn.executemany("UPDATE alert_deliveries SET delivered = 1 WHERE id = ?", [(i,) for i in ids])
+
+def prune_alerts(cutoff: float, conn: Optional[sqlite3.Connection] = None) -> int:
+    """Drop subscriptions that never fired and alerts created before ``cutoff``"""
+    with connection(conn=conn) as conn:
+        deleted = conn.execute("DELETE FROM alert_subscriptions WHERE created < ?", (cutoff,)).rowcount
+        return deleted + conn.execute("DELETE FROM alert_deliveries WHERE created < ?", (cutoff,)).rowcount
 
 def get_recent_locations(bus_id: str, max_age_seconds: int = 60) -> List[sqlite3.Row]:
     """Get all locations reported within the last max_age_seconds"""
-    conn = get_conn()
+    conn = get_conn(bus_id)
     cutoff_time = (datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)).isoformat()
     rows = conn.execute(
         """
@@ -466,189 +763,3 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
     c = 2 * atan2(sqrt(a), sqrt(1-a))
     return R * c
-
-def find_location_clusters(bus_id: str, max_radius: float = 80.0, min_points: int = 2) -> List[Dict[str, Any]]:
-    """Find clusters of location points using a simple distance-based approach"""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Get recent locations (last 30 seconds)
-    cutoff_time = (datetime.now(timezone.utc) - timedelta(seconds=30)).isoformat()
-    locations = cur.execute("""
-        SELECT id, lat, lon, accuracy, user_type
-        FROM user_locations
-        WHERE bus_id = ? AND timestamp > ?
-        ORDER BY timestamp DESC
-    """, (bus_id, cutoff_time)).fetchall()
-    
-    if not locations:
-        return []
-    
-    # Initialize clusters
-    clusters = []
-    used_points = set()
-    
-    # Process driver locations first
-    driver_locations = [loc for loc in locations if loc['user_type'] == 'driver']
-    if driver_locations:
-        driver_loc = driver_locations[0]  # Most recent driver location
-        # Create a cluster centered on driver
-        near_points = []
-        for loc in locations:
-            if calculate_distance(driver_loc['lat'], driver_loc['lon'], 
-                               loc['lat'], loc['lon']) <= max_radius:
-                near_points.append(loc)
-        
-        if len(near_points) >= min_points:
-            clusters.append({
-                'center_lat': driver_loc['lat'],
-                'center_lon': driver_loc['lon'],
-                'radius': max_radius,
-                'points': near_points,
-                'source': 'driver'
-            })
-            used_points.update(p['id'] for p in near_points)
-    
-    # Process remaining points
-    for loc in locations:
-        if loc['id'] in used_points:
-            continue
-            
-        # Find all points within radius
-        near_points = []
-        for other in locations:
-            if other['id'] not in used_points:
-                dist = calculate_distance(loc['lat'], loc['lon'], 
-                                       other['lat'], other['lon'])
-                if dist <= max_radius:
-                    near_points.append(other)
-        
-        if len(near_points) >= min_points:
-            # Calculate weighted centroid
-            total_weight = 0
-            weighted_lat = 0
-            weighted_lon = 0
-            
-            for p in near_points:
-                # Weight by inverse square of accuracy (capped at 5m)
-                weight = 1 / max(p['accuracy'], 5.0)**2
-                total_weight += weight
-                weighted_lat += p['lat'] * weight
-                weighted_lon += p['lon'] * weight
-            
-            center_lat = weighted_lat / total_weight
-            center_lon = weighted_lon / total_weight
-            
-            # Verify all points are within radius of centroid
-            max_dist = 0
-            valid_points = []
-            for p in near_points:
-                dist = calculate_distance(center_lat, center_lon, p['lat'], p['lon'])
-                if dist <= max_radius:
-                    valid_points.append(p)
-                    max_dist = max(max_dist, dist)
-            
-            if len(valid_points) >= min_points:
-                clusters.append({
-                    'center_lat': center_lat,
-                    'center_lon': center_lon,
-                    'radius': max_dist,
-                    'points': valid_points,
-                    'source': 'students'
-                })
-                used_points.update(p['id'] for p in valid_points)
-    
-    # Sort clusters by number of points
-    clusters.sort(key=lambda c: len(c['points']), reverse=True)
-    
-    # Store clusters in database
-    cur.execute("DELETE FROM location_clusters WHERE bus_id = ?", (bus_id,))
-    for i, cluster in enumerate(clusters):
-        is_majority = (len(cluster['points']) > len(locations) / 2)
-        cur.execute("""
-            INSERT INTO location_clusters (
-                bus_id, lat, lon, radius, point_count, 
-                total_points, timestamp, is_majority
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            bus_id, cluster['center_lat'], cluster['center_lon'],
-            cluster['radius'], len(cluster['points']),
-            len(locations), iso_now(), is_majority
-        ))
-        
-        # Update cluster_id for points
-        point_ids = ','.join(str(p['id']) for p in cluster['points'])
-        cur.execute(f"""
-            UPDATE user_locations 
-            SET cluster_id = ?
-            WHERE id IN ({point_ids})
-        """, (i + 1,))
-    
-    conn.commit()
-    conn.close()
-    
-    return clusters
-
-def check_stop_proximity(bus_id: str, lat: float, lon: float, radius_meters: float = 40) -> Optional[Dict[str, Any]]:
-    """
-    Check if the given location is near any stop within radius_meters.
-    Returns the nearest stop if within radius, None otherwise.
-    """
-    conn = get_conn()
-    stops = conn.execute("SELECT * FROM stops ORDER BY seq").fetchall()
-    conn.close()
-    
-    nearest_stop = None
-    min_distance = float('inf')
-    
-    for stop in stops:
-        distance = calculate_distance(lat, lon, stop['lat'], stop['lon'])
-        if distance <= radius_meters and distance < min_distance:
-            min_distance = distance
-            nearest_stop = dict(stop)
-    
-    return nearest_stop
-
-def get_aggregated_location(bus_id: str) -> Optional[Dict[str, Any]]:
-    """
-    Get the aggregated location for a bus based on recent user locations.
-    Driver location takes priority if available.
-    """
-    # Get recent locations (last 60 seconds)
-    locations = get_recent_locations(bus_id, 60)
-    if not locations:
-        return None
-        
-    # Check for driver location first
-    driver_locations = [loc for loc in locations if loc['user_type'] == 'driver']
-    if driver_locations:
-        # Use most recent driver location
-        driver_loc = driver_locations[0]
-        return {
-            'lat': driver_loc['lat'],
-            'lon': driver_loc['lon'],
-            'accuracy': driver_loc['accuracy'],
-            'source': 'driver'
-        }
-    
-    # Filter to student locations only
-    student_locations = [loc for loc in locations if loc['user_type'] == 'student']
-    if not student_locations:
-        return None
-        
-    # Find clusters of locations (simplified - using average)
-    total_lat = sum(loc['lat'] for loc in student_locations)
-    total_lon = sum(loc['lon'] for loc in student_locations)
-    avg_lat = total_lat / len(student_locations)
-    avg_lon = total_lon / len(student_locations)
-    
-    # Calculate average accuracy
-    avg_accuracy = sum(loc['accuracy'] for loc in student_locations) / len(student_locations)
-    
-    return {
-        'lat': avg_lat,
-        'lon': avg_lon,
-        'accuracy': avg_accuracy,
-        'source': 'students',
-        'sample_size': len(student_locations)
-    }
\ No newline at end of file
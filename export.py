@@ -0,0 +1,223 @@
+"""Streaming bulk export of GPS history, stop events and trips.
+
+Three datasets can be exported for a date range, as CSV or newline-delimited
+JSON, optionally gzipped on the fly:
+
+    locations    every stored fix (``location_history``)
+    stop_events  arrivals and departures (``stop_events``)
+    trips        stop events grouped per bus into trips; a bus going back to
+                 an earlier stop (a reset) starts a new one, so trips cut by
+                 the range edges come out partial
+
+Rows come from ``history.scan()``, which streams the archived days in the
+range and then the live shards (in short keyset pages, so a slow download
+never holds a shard's read lock). Memory stays flat whatever the range size:
+one page per partition being read plus one output chunk (and, for trips, one
+open trip per bus).
+
+Usage:
+    python export.py locations --from 2026-10-01 --to 2026-10-07 -o week.csv
+    python export.py trips --from 2026-10-01 --format ndjson --gzip -o trips.ndjson.gz
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+import time as time_module
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import db as dbm
+import history
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 64 * 1024  # size of the pieces the body is streamed in
+
+COLUMNS: Dict[str, Tuple[str, ...]] = {
+    'locations': ('timestamp', 'bus_id', 'user_id', 'user_type', 'lat', 'lon', 'accuracy'),
+    'stop_events': ('timestamp', 'bus_id', 'stop_index', 'event', 'source'),
+    'trips': ('bus_id', 'started', 'ended', 'first_stop', 'last_stop', 'arrivals', 'departures'),
+}
+TABLES = {'locations': 'location_history', 'stop_events': 'stop_events'}
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_bound(value: Optional[str], end: bool = False) -> Optional[str]:
+    """An ISO date or timestamp as a UTC string comparable with stored timestamps.
+
+    A bare end date includes that whole day; timestamps without an offset
+    are taken as UTC.
+    """
+    if not value:
+        return None
+    try:
+        ts = datetime.fromisoformat(value)
+    except ValueError:
+        raise ExportError(f"Invalid date {value!r}, expected YYYY-MM-DD or an ISO 8601 timestamp")
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    if end and len(value) == 10:
+        ts += timedelta(days=1)
+    return ts.astimezone(timezone.utc).isoformat()
+
+
+def _trips(events: Iterator[tuple]) -> Iterator[tuple]:
+    """Group (timestamp, bus_id, stop_index, event, source) rows into trips"""
+    open_trips: Dict[str, list] = {}
+    for ts, bus_id, stop_index, event, _source in events:
+        trip = open_trips.get(bus_id)
+        if trip is not None and stop_index < trip[4]:
+            yield tuple(trip)
+            trip = None
+        if trip is None:
+            trip = open_trips[bus_id] = [bus_id, ts, ts, stop_index, stop_index, 0, 0]
+        trip[2] = ts
+        trip[4] = stop_index
+        trip[5 if event == 'arrived' else 6] += 1
+    for trip in open_trips.values():
+        yield tuple(trip)
+
+
+class Export:
+    """One export run; iterating it yields the encoded body chunk by chunk"""
+
+    def __init__(self, dataset: str, start: Optional[str] = None, end: Optional[str] = None,
+                 fmt: str = 'csv', bus_id: Optional[str] = None, compress: bool = False) -> None:
+        if dataset not in COLUMNS:
+            raise ExportError(f"Unknown dataset {dataset!r}, expected one of {', '.join(COLUMNS)}")
+        if fmt not in MIMETYPES:
+            raise ExportError(f"Unknown format {fmt!r}, expected csv or ndjson")
+        self.dataset = dataset
+        self.requested = (start, end)
+        self.start = parse_bound(start)
+        self.end = parse_bound(end, end=True)
+        self.fmt = fmt
+        self.bus_id = bus_id
+        self.compress = compress
+        self.columns = COLUMNS[dataset]
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def mimetype(self) -> str:
+        return 'application/gzip' if self.compress else MIMETYPES[self.fmt]
+
+    @property
+    def filename(self) -> str:
+        span = '-'.join(b[:10] for b in self.requested if b) or 'all'
+        return f"{self.dataset}-{span}.{self.fmt}{'.gz' if self.compress else ''}"
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def records(self) -> Iterator[tuple]:
+        """The dataset's rows as tuples in ``self.columns`` order"""
+        table = TABLES.get(self.dataset, 'stop_events')
+        source = COLUMNS['stop_events'] if self.dataset == 'trips' else self.columns
+        rows = history.scan(table, source, self.start, self.end, self.bus_id)
+        return _trips(rows) if self.dataset == 'trips' else rows
+
+    def _text(self) -> Iterator[bytes]:
+        """The uncompressed body in roughly CHUNK_BYTES pieces"""
+        if self.fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(self.columns)
+            for row in self.records():
+                writer.writerow(row)
+                self.rows += 1
+                if buffer.tell() >= CHUNK_BYTES:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue().encode('utf-8')
+        else:
+            lines: List[str] = []
+            size = 0
+            for row in self.records():
+                line = json.dumps(dict(zip(self.columns, row)), separators=(',', ':'))
+                lines.append(line)
+                size += len(line) + 1
+                self.rows += 1
+                if size >= CHUNK_BYTES:
+                    yield ('\n'.join(lines) + '\n').encode('utf-8')
+                    lines, size = [], 0
+            if lines:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def __iter__(self) -> Iterator[bytes]:
+        started = time_module.perf_counter()
+        # wbits=31: a gzip container rather than a raw zlib stream
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None
+        complete = False
+        try:
+            for chunk in self._text():
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    self.bytes += len(chunk)
+                    yield chunk
+            if compressor is not None:
+                chunk = compressor.flush()
+                self.bytes += len(chunk)
+                yield chunk
+            complete = True
+        finally:
+            # Also runs when the client disconnects mid-stream
+            self.seconds = time_module.perf_counter() - started
+            metrics.incr('export.rows', self.rows)
+            metrics.incr('export.bytes', self.bytes)
+            metrics.incr('export.completed' if complete else 'export.aborted')
+            metrics.observe('export.rows_per_second', self.rows_per_second)
+            logger.info(f"Export of {self.dataset} {'finished' if complete else 'aborted'}: "
+                        f"{self.rows} rows, {self.bytes} bytes in {self.seconds:.2f} s "
+                        f"({self.rows_per_second:.0f} rows/s)")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export GPS history, stop events or trips")
+    parser.add_argument('dataset', choices=list(COLUMNS))
+    parser.add_argument('--from', dest='start', default=None, help="first day (YYYY-MM-DD) or timestamp")
+    parser.add_argument('--to', dest='end', default=None, help="last day (inclusive) or timestamp (exclusive)")
+    parser.add_argument('--format', default='csv', choices=list(MIMETYPES))
+    parser.add_argument('--bus', default=None, help="only this bus")
+    parser.add_argument('--gzip', action='store_true', help="gzip the output")
+    parser.add_argument('--db', default=None, help=f"database file (default: {dbm.DB_PATH})")
+    parser.add_argument('--archive-dir', default=None,
+                        help=f"day archives to read too (default: {history.ARCHIVE_DIR})")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        dbm.DB_PATH = args.db
+    if args.archive_dir is not None:
+        history.ARCHIVE_DIR = args.archive_dir
+    try:
+        job = Export(args.dataset, args.start, args.end, args.format, args.bus, args.gzip)
+    except ExportError as e:
+        parser.error(str(e))
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in job:
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    print(json.dumps({'rows': job.rows, 'bytes': job.bytes, 'seconds': round(job.seconds, 3),
+                      'rows_per_second': round(job.rows_per_second, 1)}), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
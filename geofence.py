@@ -0,0 +1,314 @@
+"""Geofences for stops, depots and route corridors.
+
+Every fence is a shape - a circle, a polygon or a corridor (a polyline
+with a half-width) - with entry/exit hysteresis: a bus enters when it is
+inside the shape and only exits once it is more than ``exit_margin``
+meters outside it, so GPS jitter at the boundary doesn't flap. A fence
+with ``dwell`` seconds also emits one ``dwell`` event once a bus has stayed
+inside that long.
+
+Fences are bucketed in a grid over a local metric projection, so each fix
+only measures the fences near it (plus those the bus is currently inside).
+Per-bus occupancy is kept in memory and every change is emitted as a
+``GeofenceEvent`` to the engine's subscribers.
+
+Stop fences are built from the ``stops`` table on first use. Depots and
+corridors can be added from a JSON file named by ``BUS_GEOFENCES``::
+
+    [{"id": "depot", "kind": "depot", "name": "Depot",
+      "circle": {"lat": 17.49, "lon": 78.33, "radius": 150}},
+     {"id": "route-S1", "kind": "corridor", "name": "S1 corridor",
+      "corridor": {"points": [[17.49, 78.33], [17.54, 78.38]], "width": 300},
+      "exit_margin": 100}]
+"""
+import json
+import os
+import threading
+from math import cos, hypot, radians
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import db as dbm
+import metrics
+
+METERS_PER_DEGREE = 111320.0
+CELL_SIZE = 250.0  # meters
+
+STOP_RADIUS = 50.0       # arrive within this distance of a stop
+STOP_EXIT_MARGIN = 20.0  # ...and depart only beyond STOP_RADIUS + this
+STOP_DWELL = 10.0        # seconds at a stop before a 'dwell' event
+
+Point = Tuple[float, float]  # projected (x, y) meters
+
+
+class Projection:
+    """Equirectangular projection around a reference latitude, in meters"""
+
+    def __init__(self, ref_lat: float) -> None:
+        self.kx = METERS_PER_DEGREE * cos(radians(ref_lat))
+
+    def __call__(self, lat: float, lon: float) -> Point:
+        return lon * self.kx, lat * METERS_PER_DEGREE
+
+
+def _segment_distance(p: Point, a: Point, b: Point) -> float:
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    seg = dx * dx + dy * dy
+    t = 0.0 if seg == 0 else max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / seg))
+    return hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+class Circle:
+    def __init__(self, lat: float, lon: float, radius: float) -> None:
+        self.lat, self.lon, self.radius = lat, lon, radius
+
+    def project(self, proj: Projection) -> None:
+        self.center = proj(self.lat, self.lon)
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        x, y = self.center
+        return x - self.radius, y - self.radius, x + self.radius, y + self.radius
+
+    def outside(self, p: Point) -> float:
+        """Meters outside the shape (<= 0 when inside)"""
+        return hypot(p[0] - self.center[0], p[1] - self.center[1]) - self.radius
+
+
+class Polygon:
+    def __init__(self, vertices: Sequence[Sequence[float]]) -> None:
+        self.vertices = [(float(lat), float(lon)) for lat, lon in vertices]
+
+    def project(self, proj: Projection) -> None:
+        self.points = [proj(lat, lon) for lat, lon in self.vertices]
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        xs = [x for x, _ in self.points]
+        ys = [y for _, y in self.points]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def outside(self, p: Point) -> float:
+        inside = False
+        edge = float('inf')
+        pts = self.points
+        for a, b in zip(pts, pts[1:] + pts[:1]):
+            if (a[1] > p[1]) != (b[1] > p[1]) and \
+                    p[0] < (b[0] - a[0]) * (p[1] - a[1]) / (b[1] - a[1]) + a[0]:
+                inside = not inside
+            edge = min(edge, _segment_distance(p, a, b))
+        return -edge if inside else edge
+
+
+class Corridor:
+    def __init__(self, points: Sequence[Sequence[float]], width: float) -> None:
+        self.vertices = [(float(lat), float(lon)) for lat, lon in points]
+        self.half_width = width / 2
+
+    def project(self, proj: Projection) -> None:
+        self.points = [proj(lat, lon) for lat, lon in self.vertices]
+
+    def bounds(self) -> Tuple[float, float, float, float]:
+        xs = [x for x, _ in self.points]
+        ys = [y for _, y in self.points]
+        w = self.half_width
+        return min(xs) - w, min(ys) - w, max(xs) + w, max(ys) + w
+
+    def outside(self, p: Point) -> float:
+        pts = self.points
+        if len(pts) == 1:
+            return hypot(p[0] - pts[0][0], p[1] - pts[0][1]) - self.half_width
+        return min(_segment_distance(p, a, b) for a, b in zip(pts, pts[1:])) - self.half_width
+
+
+class Fence:
+    def __init__(self, fence_id: str, kind: str, name: str, shape, exit_margin: float = 0.0,
+                 dwell: Optional[float] = None, **attrs: Any) -> None:
+        self.id = fence_id
+        self.kind = kind  # 'stop', 'depot' or 'corridor'
+        self.name = name
+        self.shape = shape
+        self.exit_margin = exit_margin
+        self.dwell = dwell
+        self.attrs = attrs  # e.g. seq / stop_id for stops
+
+    def __repr__(self) -> str:
+        return f"Fence({self.id!r}, {self.kind!r})"
+
+
+class GeofenceEvent:
+    __slots__ = ('bus_id', 'fence', 'kind', 't')
+
+    def __init__(self, bus_id: str, fence: Fence, kind: str, t: float) -> None:
+        self.bus_id = bus_id
+        self.fence = fence
+        self.kind = kind  # 'enter', 'exit' or 'dwell'
+        self.t = t
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'bus_id': self.bus_id, 'fence': self.fence.id, 'fence_kind': self.fence.kind,
+                'event': self.kind, 't': self.t}
+
+
+class GeofenceEngine:
+    def __init__(self, fences: Optional[Iterable[Fence]] = None) -> None:
+        self._fences: Optional[Dict[str, Fence]] = None
+        self._grid: Dict[Tuple[int, int], List[Fence]] = {}
+        self._proj: Optional[Projection] = None
+        self._inside: Dict[str, Dict[str, float]] = {}  # bus -> fence id -> entered at
+        self._dwelled: Dict[str, Set[str]] = {}
+        self._listeners: List[Callable[[GeofenceEvent], None]] = []
+        self._lock = threading.Lock()
+        if fences is not None:
+            self.load(fences)
+
+    # --- configuration --------------------------------------------------
+    def load(self, fences: Iterable[Fence]) -> None:
+        """Replace the fence set and rebuild the spatial index"""
+        fences = list(fences)
+        with self._lock:
+            self._fences = {f.id: f for f in fences}
+            self._grid = {}
+            self._proj = None
+            if fences:
+                first = fences[0].shape
+                ref_lat = first.lat if isinstance(first, Circle) else first.vertices[0][0]
+                self._proj = Projection(ref_lat)
+            for fence in fences:
+                fence.shape.project(self._proj)
+                x0, y0, x1, y1 = fence.shape.bounds()
+                m = fence.exit_margin
+                for cx in range(int((x0 - m) // CELL_SIZE), int((x1 + m) // CELL_SIZE) + 1):
+                    for cy in range(int((y0 - m) // CELL_SIZE), int((y1 + m) // CELL_SIZE) + 1):
+                        self._grid.setdefault((cx, cy), []).append(fence)
+            # Occupancy of fences that no longer exist is meaningless
+            for inside in self._inside.values():
+                for fid in [f for f in inside if f not in self._fences]:
+                    del inside[fid]
+
+    def _ensure_loaded(self) -> None:
+        if self._fences is None:
+            self.load(stop_fences(dbm.get_stops()) + extra_fences())
+
+    def subscribe(self, listener: Callable[[GeofenceEvent], None]) -> None:
+        self._listeners.append(listener)
+
+    # --- evaluation -----------------------------------------------------
+    def evaluate(self, bus_id: str, lat: float, lon: float, now: float) -> List[GeofenceEvent]:
+        """Update the bus's occupancy from one fix and return the resulting events"""
+        self._ensure_loaded()
+        events: List[GeofenceEvent] = []
+        with self._lock:
+            inside = self._inside.setdefault(bus_id, {})
+            dwelled = self._dwelled.setdefault(bus_id, set())
+            if self._proj is None:
+                return events
+            p = self._proj(lat, lon)
+            cell = (int(p[0] // CELL_SIZE), int(p[1] // CELL_SIZE))
+            candidates = {f.id: f for f in self._grid.get(cell, ())}
+            for fid in inside:
+                candidates[fid] = self._fences[fid]
+
+            for fence in candidates.values():
+                outside = fence.shape.outside(p)
+                if fence.id in inside:
+                    if outside > fence.exit_margin:
+                        del inside[fence.id]
+                        dwelled.discard(fence.id)
+                        events.append(GeofenceEvent(bus_id, fence, 'exit', now))
+                    elif fence.dwell is not None and fence.id not in dwelled \
+                            and now - inside[fence.id] >= fence.dwell:
+                        dwelled.add(fence.id)
+                        events.append(GeofenceEvent(bus_id, fence, 'dwell', now))
+                elif outside <= 0:
+                    inside[fence.id] = now
+                    events.append(GeofenceEvent(bus_id, fence, 'enter', now))
+
+        for event in events:
+            metrics.incr(f'geofence.{event.fence.kind}.{event.kind}')
+            for listener in self._listeners:
+                listener(event)
+        return events
+
+    def occupied(self, bus_id: str, kind: Optional[str] = None) -> List[Fence]:
+        with self._lock:
+            fences = [self._fences[fid] for fid in self._inside.get(bus_id, {})]
+        return [f for f in fences if kind is None or f.kind == kind]
+
+    def nearest(self, bus_id: str, lat: float, lon: float, kind: str = 'stop') -> Optional[Fence]:
+        """The closest fence of this kind the bus is currently inside"""
+        fences = self.occupied(bus_id, kind)
+        if not fences:
+            return None
+        p = self._proj(lat, lon)
+        return min(fences, key=lambda f: f.shape.outside(p))
+
+    def forget(self, bus_id: str) -> None:
+        """Drop a bus's occupancy, e.g. after it was moved by hand"""
+        with self._lock:
+            self._inside.pop(bus_id, None)
+            self._dwelled.pop(bus_id, None)
+
+    def export(self) -> Dict[str, Dict[str, Any]]:
+        """Per-bus occupancy, for snapshots (see snapshot.py)"""
+        with self._lock:
+            return {bus: {'inside': dict(inside), 'dwelled': sorted(self._dwelled.get(bus, ()))}
+                    for bus, inside in self._inside.items() if inside}
+
+    def restore(self, occupancy: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock:
+            for bus, entry in occupancy.items():
+                self._inside[bus] = dict(entry['inside'])
+                self._dwelled[bus] = set(entry.get('dwelled', ()))
+
+    def apply(self, bus_id: str, fence_id: str, kind: str, t: float) -> None:
+        """Re-apply one journaled event to the occupancy"""
+        with self._lock:
+            inside = self._inside.setdefault(bus_id, {})
+            dwelled = self._dwelled.setdefault(bus_id, set())
+            if kind == 'enter':
+                inside[fence_id] = t
+            elif kind == 'exit':
+                inside.pop(fence_id, None)
+                dwelled.discard(fence_id)
+            elif kind == 'dwell':
+                dwelled.add(fence_id)
+
+    def clear(self) -> None:
+        """Forget all occupancy and reload fences on next use"""
+        with self._lock:
+            self._inside.clear()
+            self._dwelled.clear()
+            self._fences = None
+            self._grid = {}
+            self._proj = None
+
+
+def stop_fences(stops: Iterable[Any]) -> List[Fence]:
+    return [
+        Fence(f"stop:{s['id']}", 'stop', s['name'], Circle(s['lat'], s['lon'], STOP_RADIUS),
+              exit_margin=STOP_EXIT_MARGIN, dwell=STOP_DWELL, seq=s['seq'], stop_id=s['id'])
+        for s in stops
+    ]
+
+
+def extra_fences(path: Optional[str] = None) -> List[Fence]:
+    """Depot and corridor fences from the JSON file named by BUS_GEOFENCES"""
+    path = path or os.environ.get("BUS_GEOFENCES")
+    if not path:
+        return []
+    with open(path) as f:
+        specs = json.load(f)
+    fences = []
+    for spec in specs:
+        if 'circle' in spec:
+            c = spec['circle']
+            shape = Circle(c['lat'], c['lon'], c['radius'])
+        elif 'polygon' in spec:
+            shape = Polygon(spec['polygon'])
+        else:
+            c = spec['corridor']
+            shape = Corridor(c['points'], c['width'])
+        fences.append(Fence(spec['id'], spec.get('kind', 'depot'), spec.get('name', spec['id']), shape,
+                            exit_margin=spec.get('exit_margin', 0.0), dwell=spec.get('dwell')))
+    return fences
+
+
+geofences = GeofenceEngine()
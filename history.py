@@ -0,0 +1,280 @@
+"""GPS history partitioned by day: a small live database plus read-only archives.
+
+Closed days are rolled out of the live shards into one SQLite file per UTC
+day, ``<BUS_ARCHIVE_DIR>/history-YYYY-MM-DD.db`` (default directory
+``archive``), holding that day's ``location_history`` and ``stop_events``
+from every shard. A day is rolled once it ended more than
+``BUS_ARCHIVE_AFTER_HOURS`` (default 24, the downsampling horizon) ago, so
+archives keep the thinned history. The file is built under a temporary name,
+fsynced and renamed, and only then are the day's rows deleted from the live
+shards; rolling again after a crash in between just repeats the delete.
+
+Archive files never change once written, so readers open them with
+``immutable=1`` - no locking, no change detection - and memory-map them
+(``BUS_ARCHIVE_MMAP_BYTES``, default 256 MB), so SQLite reads pages straight
+from the OS page cache instead of copying them into its own. A whole
+partition streams through one cursor with ``fetchmany``. The live shards are
+read in short keyset pages instead: an open statement there would hold the
+shard's read lock and stall the writer.
+
+``scan()`` fans a time range out over the archived days it overlaps, in
+order, followed by the live shards merged by timestamp.
+"""
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import time as time_module
+from datetime import date, datetime, timedelta, timezone
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import db as dbm
+import metrics
+from writer import writes
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.environ.get("BUS_ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_HOURS = float(os.environ.get("BUS_ARCHIVE_AFTER_HOURS", "24"))
+MMAP_BYTES = int(os.environ.get("BUS_ARCHIVE_MMAP_BYTES", str(256 * 1024 * 1024)))
+PAGE_ROWS = 2000  # rows per keyset query / fetchmany call
+DELETE_BATCH = 5000  # live rows deleted per transaction after archiving
+DELETE_PAUSE = 0.05  # seconds between those batches, for other processes' writers
+
+# Archived tables and the columns copied (ids are renumbered per archive)
+ARCHIVED: Dict[str, Tuple[str, ...]] = {
+    'location_history': ('timestamp', 'bus_id', 'user_id', 'user_type', 'lat', 'lon', 'accuracy'),
+    'stop_events': ('timestamp', 'bus_id', 'stop_index', 'event', 'source'),
+}
+ARCHIVE_SCHEMA = """
+CREATE TABLE location_history(
+    id INTEGER PRIMARY KEY,
+    bus_id TEXT,
+    user_id TEXT,
+    user_type TEXT,
+    lat REAL,
+    lon REAL,
+    accuracy REAL,
+    timestamp TEXT
+);
+CREATE TABLE stop_events(
+    id INTEGER PRIMARY KEY,
+    bus_id TEXT,
+    stop_index INTEGER,
+    event TEXT,
+    source TEXT,
+    timestamp TEXT
+);
+CREATE INDEX idx_location_history_ts ON location_history(timestamp);
+CREATE INDEX idx_location_history_bus_ts ON location_history(bus_id, timestamp);
+CREATE INDEX idx_stop_events_ts ON stop_events(timestamp);
+CREATE INDEX idx_stop_events_bus_ts ON stop_events(bus_id, timestamp);
+"""
+_ARCHIVE_NAME = re.compile(r'^history-(\d{4}-\d{2}-\d{2})\.db$')
+
+
+def day_start(day: str) -> str:
+    """The first stored-timestamp value of a UTC day ('2026-10-19')"""
+    return datetime.fromisoformat(day).replace(tzinfo=timezone.utc).isoformat()
+
+
+def next_day(day: str) -> str:
+    return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
+def archive_path(day: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"history-{day}.db")
+
+
+def archived_days() -> List[str]:
+    """Days with an archive file, oldest first"""
+    if not ARCHIVE_DIR or not os.path.isdir(ARCHIVE_DIR):
+        return []
+    days = []
+    for name in os.listdir(ARCHIVE_DIR):
+        match = _ARCHIVE_NAME.match(name)
+        if match:
+            days.append(match.group(1))
+    return sorted(days)
+
+
+def open_archive(day: str) -> sqlite3.Connection:
+    """A read-only, memory-mapped connection to one day's archive"""
+    uri = f"file:{quote(os.path.abspath(archive_path(day)))}?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+    return conn
+
+
+# --- rolling ---------------------------------------------------------------
+def roll(day: str) -> Dict[str, int]:
+    """Move one closed day from the live shards into its archive file.
+
+    Returns the number of rows archived per table (empty days get no file).
+    """
+    start, end = day_start(day), day_start(next_day(day))
+    path = archive_path(day)
+    counts = {table: 0 for table in ARCHIVED}
+    if not os.path.exists(path):
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        tmp = f"{path}.tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)  # left over from a crash mid-roll
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.executescript(ARCHIVE_SCHEMA)
+            for table, columns in ARCHIVED.items():
+                # Read in keyset pages like any live scan, so the shards'
+                # writers are never held up by the copy
+                conn.executemany(
+                    f"INSERT INTO {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    _live(table, columns, start, end),
+                )
+                counts[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            conn.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+        if not any(counts.values()):
+            os.remove(tmp)
+            return counts
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+        logger.info(f"Archived {day}: {counts['location_history']} fixes, "
+                    f"{counts['stop_events']} stop events")
+
+    # The archive is complete and durable; the live copies can go, in small
+    # batches through the write queue so request writes are never held up long
+    for shard in dbm.all_shard_paths():
+        for table in ARCHIVED:
+            while writes.call_shard(shard, delete_batch, shard, table, start, end):
+                # Other processes' writers may be in SQLite's busy backoff and
+                # would never win the lock back from an immediate next batch
+                time_module.sleep(DELETE_PAUSE)
+    for table, count in counts.items():
+        metrics.incr(f'history.archived.{table}', count)
+    return counts
+
+
+def delete_batch(path: str, table: str, start: str, end: str,
+                 conn: Optional[sqlite3.Connection] = None) -> int:
+    """Delete up to DELETE_BATCH rows of [start, end) from one live shard"""
+    with dbm.connection(path=path, conn=conn) as conn:
+        return conn.execute(
+            f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} "
+            f"WHERE timestamp >= ? AND timestamp < ? LIMIT {DELETE_BATCH})",
+            (start, end),
+        ).rowcount
+
+
+def live_days() -> List[str]:
+    """Days that still have history in the live shards, oldest first"""
+    days = set()
+    for conn in dbm.iter_shard_conns():
+        for table in ARCHIVED:
+            first = conn.execute(f"SELECT MIN(timestamp) FROM {table}").fetchone()[0]
+            while first is not None:
+                day = first[:10]
+                days.add(day)
+                first = conn.execute(f"SELECT MIN(timestamp) FROM {table} WHERE timestamp >= ?",
+                                     (day_start(next_day(day)),)).fetchone()[0]
+    return sorted(days)
+
+
+def roll_closed_days(now: Optional[datetime] = None,
+                     after_hours: float = ARCHIVE_AFTER_HOURS) -> List[str]:
+    """Archive every day that ended more than ``after_hours`` ago; returns those days"""
+    if not ARCHIVE_DIR:
+        return []
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(hours=after_hours)
+    cutoff_iso = cutoff.astimezone(timezone.utc).isoformat()
+    rolled = [day for day in live_days() if day_start(next_day(day)) <= cutoff_iso]
+    for day in rolled:
+        roll(day)
+    metrics.set_gauge('history.archived_days', len(archived_days()))
+    return rolled
+
+
+# --- queries ---------------------------------------------------------------
+def _archive_rows(day: str, table: str, columns: Tuple[str, ...], start: Optional[str],
+                  end: Optional[str], bus_id: Optional[str]) -> Iterator[tuple]:
+    """One archived day through a single cursor: the file is immutable, nothing waits on it"""
+    where, params = ["1"], []
+    for clause, value in (("timestamp >= ?", start), ("timestamp < ?", end), ("bus_id = ?", bus_id)):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    conn = open_archive(day)
+    try:
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE {' AND '.join(where)} "
+                              f"ORDER BY timestamp, id", params)
+        while True:
+            rows = cursor.fetchmany(PAGE_ROWS)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+def _live_rows(path: str, table: str, columns: Tuple[str, ...], start: Optional[str],
+               end: Optional[str], bus_id: Optional[str]) -> Iterator[tuple]:
+    """One live shard in (timestamp, id) order, one short query per page"""
+    where = ["(timestamp, id) > (?, ?)"]
+    params: List[object] = []
+    if end is not None:
+        where.append("timestamp < ?")
+        params.append(end)
+    if bus_id is not None:
+        where.append("bus_id = ?")
+        params.append(bus_id)
+    query = (f"SELECT id, {', '.join(columns)} FROM {table} WHERE {' AND '.join(where)} "
+             f"ORDER BY timestamp, id LIMIT {PAGE_ROWS}")
+    conn = sqlite3.connect(path)
+    try:
+        # Ids are positive, so (start, 0) makes the first page start at `start`
+        after: Tuple[str, int] = (start or '', 0)
+        while True:
+            rows = conn.execute(query, (*after, *params)).fetchall()
+            for row in rows:
+                yield row[1:]
+            if len(rows) < PAGE_ROWS:
+                return
+            after = (rows[-1][1], rows[-1][0])
+    finally:
+        conn.close()
+
+
+def _live(table: str, columns: Tuple[str, ...], start: Optional[str], end: Optional[str],
+          bus_id: Optional[str] = None) -> Iterator[tuple]:
+    """Live rows of every shard (or just bus_id's) merged by timestamp"""
+    if bus_id is not None:
+        paths = [dbm.shard_path(dbm.shard_index(bus_id))]
+    else:
+        paths = dbm.all_shard_paths()
+    scans = [_live_rows(path, table, columns, start, end, bus_id) for path in paths]
+    return scans[0] if len(scans) == 1 else heapq.merge(*scans, key=itemgetter(0))
+
+
+def partitions(start: Optional[str] = None, end: Optional[str] = None) -> List[str]:
+    """Archived days overlapping [start, end) (UTC ISO bounds, either may be None)"""
+    return [day for day in archived_days()
+            if (start is None or start < day_start(next_day(day)))
+            and (end is None or end > day_start(day))]
+
+
+def scan(table: str, columns: Tuple[str, ...], start: Optional[str] = None, end: Optional[str] = None,
+         bus_id: Optional[str] = None) -> Iterator[tuple]:
+    """Rows of ``table`` in [start, end), oldest first, across archives and live shards.
+
+    ``columns`` must start with 'timestamp'; rows are tuples in that order.
+    """
+    for day in partitions(start, end):
+        metrics.incr('history.partitions_read')
+        yield from _archive_rows(day, table, columns, start, end, bus_id)
+    yield from _live(table, columns, start, end, bus_id)
@@ -0,0 +1,50 @@
+"""Process-local counters, gauges and summaries exposed at GET /metrics"""
+import threading
+from typing import Any, Dict, List
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_summaries: Dict[str, List[float]] = {}  # name -> [count, total, max]
+
+
+def incr(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """Record one sample of a distribution (count, mean and max are kept)"""
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'summaries': {
+                name: {'count': int(c), 'mean': t / c if c else 0.0, 'max': m}
+                for name, (c, t, m) in _summaries.items()
+            },
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
@@ -0,0 +1,292 @@
+"""Versioned, forward-only schema migrations.
+
+Each database file (the main one and every shard) records the migrations
+it has applied in ``schema_version``. ``migrate_all()`` runs once at
+startup (see wsgi.py): when every file is up to date it costs one query
+per file, otherwise the pending migrations for a file are applied in a
+single ``BEGIN IMMEDIATE`` transaction, so workers starting together
+don't race each other.
+
+Migrations never delete data. Reseeding the stops and resetting the fleet
+is an explicit admin command (``flask --app app seed``).
+
+To change the schema, append a new ``(version, description, function)``
+entry to ``MIGRATIONS``; never edit one that has shipped.
+"""
+import sqlite3
+import sys
+import time as time_module
+from typing import Callable, Dict, List, Tuple
+
+import db as dbm
+
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+    """Add a column to a table created before it existed"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _m001_base(conn: sqlite3.Connection) -> None:
+    # IF NOT EXISTS: databases created before schema_version already have these
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stops(
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            lat REAL,
+            lon REAL,
+            seq INTEGER
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bus_state(
+            bus_id TEXT PRIMARY KEY,
+            stop_index INTEGER,
+            lat REAL,
+            lon REAL,
+            timestamp TEXT,
+            status TEXT,  -- 'arrived', 'departing', etc
+            location_source TEXT,  -- 'driver', 'students', 'last_known'
+            location_accuracy REAL,
+            sample_size INTEGER,
+            last_arrival_time TEXT,
+            last_departure_time TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS confirmations(
+            id INTEGER PRIMARY KEY,
+            bus_id TEXT,
+            stop_id INTEGER,
+            user_type TEXT,
+            user_id TEXT,
+            timestamp TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_locations(
+            id INTEGER PRIMARY KEY,
+            bus_id TEXT,
+            user_id TEXT,
+            user_type TEXT,
+            lat REAL,
+            lon REAL,
+            accuracy REAL,
+            speed REAL,
+            heading REAL,
+            timestamp TEXT,
+            cluster_id INTEGER,  -- For tracking which cluster this point belongs to
+            weight REAL,         -- For weighted aggregation
+            UNIQUE(bus_id, user_id) ON CONFLICT REPLACE
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS location_clusters(
+            id INTEGER PRIMARY KEY,
+            bus_id TEXT,
+            lat REAL,
+            lon REAL,
+            radius REAL,
+            point_count INTEGER,
+            total_points INTEGER,
+            timestamp TEXT,
+            is_majority BOOLEAN
+        )
+        """
+    )
+
+
+def _m002_trips(conn: sqlite3.Connection) -> None:
+    # trip_id is bumped on every reset to the first stop
+    _ensure_column(conn, "bus_state", "trip_id", "INTEGER DEFAULT 0")
+    _ensure_column(conn, "confirmations", "trip_id", "INTEGER DEFAULT 0")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_confirmations_bus_stop_trip_user "
+        "ON confirmations(bus_id, stop_id, trip_id, user_id)"
+    )
+    # Distinct confirming users per bus/stop/trip, kept up to date on insert
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS confirmation_counts(
+            bus_id TEXT,
+            stop_id INTEGER,
+            trip_id INTEGER,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(bus_id, stop_id, trip_id)
+        )
+        """
+    )
+
+
+def _m003_history(conn: sqlite3.Connection) -> None:
+    # Append-only GPS history (user_locations only keeps the latest fix)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS location_history(
+            id INTEGER PRIMARY KEY,
+            bus_id TEXT,
+            user_id TEXT,
+            user_type TEXT,
+            lat REAL,
+            lon REAL,
+            accuracy REAL,
+            timestamp TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_location_history_bus_ts ON location_history(bus_id, timestamp)"
+    )
+    # Arrival/departure timeline per bus
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stop_events(
+            id INTEGER PRIMARY KEY,
+            bus_id TEXT,
+            stop_index INTEGER,
+            event TEXT,  -- 'arrived' or 'departing'
+            source TEXT,
+            timestamp TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stop_events_bus_ts ON stop_events(bus_id, timestamp)"
+    )
+
+
+def _m004_seed_stops(conn: sqlite3.Connection) -> None:
+    # Only a brand-new database gets the configured stops; existing ones keep theirs
+    if conn.execute("SELECT 1 FROM stops LIMIT 1").fetchone() is None:
+        conn.executemany("INSERT INTO stops(name, lat, lon, seq) VALUES (?, ?, ?, ?)", dbm.SEED_STOPS)
+
+
+def _m005_revoked_tokens(conn: sqlite3.Connection) -> None:
+    # Logged-out token ids (AUTH_MODE=token), kept until the token expires
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens(
+            token_id TEXT PRIMARY KEY,
+            expires REAL
+        )
+        """
+    )
+
+
+def _m006_history_time_indexes(conn: sqlite3.Connection) -> None:
+    # Date-range scans over the whole fleet (export.py, history downsampling)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_location_history_ts ON location_history(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stop_events_ts ON stop_events(timestamp)")
+
+
+def _m007_alerts(conn: sqlite3.Connection) -> None:
+    # Arrival alerts shared by every worker: open subscriptions, and fired
+    # alerts waiting for (or already pushed to) the subscriber's stream.
+    # AUTOINCREMENT keeps ids increasing after deletes; the workers' sync
+    # and delivery cursors rely on it.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS alert_subscriptions(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            bus_id TEXT,
+            stop_seq INTEGER,
+            stop_name TEXT,
+            stops_before INTEGER,
+            minutes_before REAL,
+            created REAL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_alert_subscriptions_user ON alert_subscriptions(user_id)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS alert_deliveries(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            payload TEXT,
+            created REAL,
+            delivered INTEGER DEFAULT 0
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_alert_deliveries_user ON alert_deliveries(user_id, delivered)")
+
+
+def _m008_drop_location_clusters(conn: sqlite3.Connection) -> None:
+    # Clusters live in memory (clustering.py); nothing reads or writes this
+    # table since the periodic recompute job was removed
+    conn.execute("DROP TABLE IF EXISTS location_clusters")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base tables", _m001_base),
+    (2, "trip ids and confirmation counters", _m002_trips),
+    (3, "location history and stop events", _m003_history),
+    (4, "seed stops into an empty database", _m004_seed_stops),
+    (5, "revoked session tokens", _m005_revoked_tokens),
+    (6, "timestamp indexes for history range scans", _m006_history_time_indexes),
+    (7, "shared arrival alert subscriptions and deliveries", _m007_alerts),
+    (8, "drop the unused location_clusters table", _m008_drop_location_clusters),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)"
+    )
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(path: str) -> int:
+    """Bring one database file up to LATEST; returns the number of migrations applied"""
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30.0)
+    try:
+        if current_version(conn) >= LATEST:
+            return 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another worker may have migrated while we waited for the lock
+            version = current_version(conn)
+            applied = 0
+            for number, description, fn in MIGRATIONS:
+                if number > version:
+                    fn(conn)
+                    conn.execute(
+                        "INSERT INTO schema_version(version, description, applied_at) VALUES (?, ?, ?)",
+                        (number, description, dbm.iso_now()),
+                    )
+                    applied += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return applied
+    finally:
+        conn.close()
+
+
+def migrate_all() -> Dict[str, int]:
+    """Migrate the main database and every shard, then make sure the default bus exists"""
+    paths = [dbm.DB_PATH] + [p for p in dbm.all_shard_paths() if p != dbm.DB_PATH]
+    applied = {path: migrate(path) for path in paths}
+    dbm.ensure_bus(dbm.DEFAULT_BUS_ID)
+    return applied
+
+
+if __name__ == "__main__":
+    started = time_module.perf_counter()
+    for path, count in migrate_all().items():
+        print(f"{path}: {count} migration(s) applied, now at version {LATEST}")
+    print(f"done in {(time_module.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
@@ -0,0 +1,125 @@
+"""Reject implausible GPS fixes at ingest, before they are stored or clustered.
+
+Every check is constant time per fix and uses only small in-memory state:
+
+* accuracy: fixes reporting worse than ``MAX_ACCURACY`` meters are dropped.
+* speed: the jump from the user's previous accepted fix, minus both fixes'
+  accuracy, must be coverable at ``MAX_SPEED``. Previous fixes are kept for
+  the ``BUS_PLAUSIBILITY_MAX_USERS`` most recently seen users (LRU).
+* corridor (students): the fix must lie within ``CORRIDOR_METERS`` of the
+  route polyline through the stops.
+* MAD (students): the fix must lie within ``MAD_THRESHOLD`` scaled median
+  absolute deviations of the median of the bus's recent student fixes, so a
+  student who got off the bus stops dragging the position along.
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from math import cos, radians
+from statistics import median
+from typing import Deque, Dict, List, Optional, Tuple
+
+import db as dbm
+import metrics
+
+MAX_ACCURACY = 100.0      # meters
+MAX_SPEED = 30.0          # m/s (108 km/h)
+CORRIDOR_METERS = 500.0
+MAD_WINDOW = 15           # recent student fixes kept per bus
+MAD_WINDOW_SECONDS = 30.0
+MAD_MIN_SAMPLES = 5
+MAD_THRESHOLD = 3.5       # scaled MADs
+MAD_FLOOR_METERS = 50.0   # never reject closer than this to the median
+
+MAX_USERS = int(os.environ.get("BUS_PLAUSIBILITY_MAX_USERS", "10000"))
+
+METERS_PER_DEGREE = 111320.0
+
+Fix = Tuple[float, float, float, float]  # lat, lon, accuracy, t
+
+
+class PlausibilityFilter:
+    def __init__(self, max_users: int = MAX_USERS) -> None:
+        self.max_users = max_users
+        self._last_fix: "OrderedDict[str, Fix]" = OrderedDict()
+        self._recent: Dict[str, Deque[Fix]] = {}
+        self._route: Optional[List[Tuple[float, float]]] = None
+        self._lock = threading.Lock()
+
+    def check(self, bus_id: str, user_id: str, user_type: str, lat: float, lon: float,
+              accuracy: float, now: float) -> Optional[str]:
+        """Return the reason a fix is rejected, or None if it is accepted"""
+        with self._lock:
+            reason = self._reason(bus_id, user_id, user_type, lat, lon, accuracy, now)
+            if reason is None:
+                self._last_fix[user_id] = (lat, lon, accuracy, now)
+                self._last_fix.move_to_end(user_id)
+                if len(self._last_fix) > self.max_users:
+                    self._last_fix.popitem(last=False)
+                if user_type == 'student':
+                    self._recent.setdefault(bus_id, deque(maxlen=MAD_WINDOW)).append((lat, lon, accuracy, now))
+        metrics.incr(f'plausibility.rejected.{reason}' if reason else 'plausibility.accepted')
+        return reason
+
+    def _reason(self, bus_id: str, user_id: str, user_type: str, lat: float, lon: float,
+                accuracy: float, now: float) -> Optional[str]:
+        if accuracy > MAX_ACCURACY:
+            return 'accuracy'
+
+        prev = self._last_fix.get(user_id)
+        if prev is not None:
+            p_lat, p_lon, p_acc, p_t = prev
+            dt = now - p_t
+            moved = dbm.calculate_distance(p_lat, p_lon, lat, lon) - p_acc - accuracy
+            if dt > 0 and moved > MAX_SPEED * dt:
+                return 'speed'
+
+        if user_type != 'student':
+            return None
+
+        if self._distance_to_route(lat, lon) > CORRIDOR_METERS:
+            return 'corridor'
+
+        recent = self._recent.get(bus_id)
+        if recent:
+            while recent and now - recent[0][3] > MAD_WINDOW_SECONDS:
+                recent.popleft()
+            if len(recent) >= MAD_MIN_SAMPLES:
+                m_lat = median(f[0] for f in recent)
+                m_lon = median(f[1] for f in recent)
+                spread = median(dbm.calculate_distance(m_lat, m_lon, f[0], f[1]) for f in recent)
+                limit = max(MAD_THRESHOLD * 1.4826 * spread, MAD_FLOOR_METERS)
+                if dbm.calculate_distance(m_lat, m_lon, lat, lon) > limit:
+                    return 'outlier'
+        return None
+
+    def _distance_to_route(self, lat: float, lon: float) -> float:
+        if self._route is None:
+            self._route = [(s['lat'], s['lon']) for s in dbm.get_stops()]
+        route = self._route
+        if not route:
+            return 0.0
+        if len(route) == 1:
+            return dbm.calculate_distance(lat, lon, *route[0])
+        # Local equirectangular projection is plenty at corridor scale
+        kx = METERS_PER_DEGREE * cos(radians(lat))
+        ky = METERS_PER_DEGREE
+        best = float('inf')
+        for (a_lat, a_lon), (b_lat, b_lon) in zip(route, route[1:]):
+            ax, ay = (a_lon - lon) * kx, (a_lat - lat) * ky
+            bx, by = (b_lon - lon) * kx, (b_lat - lat) * ky
+            dx, dy = bx - ax, by - ay
+            seg = dx * dx + dy * dy
+            t = 0.0 if seg == 0 else max(0.0, min(1.0, -(ax * dx + ay * dy) / seg))
+            px, py = ax + t * dx, ay + t * dy
+            best = min(best, (px * px + py * py) ** 0.5)
+        return best
+
+    def clear(self) -> None:
+        with self._lock:
+            self._last_fix.clear()
+            self._recent.clear()
+            self._route = None
+
+
+plausibility = PlausibilityFilter()
@@ -0,0 +1,169 @@
+"""Token-bucket rate limiting for write endpoints.
+
+Each user gets a bucket sized by their role, and student writes also draw
+from an aggregate bucket per bus so a crowd of phones on one bus can't
+flood ingest. Buckets refill lazily when they are next consulted, so idle
+keys cost nothing.
+
+Two stores are available:
+
+* ``MemoryBucketStore`` (default): per-process, LRU-bounded to
+  ``BUS_RATELIMIT_MAX_KEYS`` entries.
+* ``SqliteBucketStore``: buckets live in a small SQLite file shared by all
+  gunicorn workers on the host (``BUS_RATELIMIT_STORE=sqlite``).
+
+Limits are ``rate`` tokens per second with a ``burst`` capacity and can be
+overridden with ``BUS_RATELIMIT_<NAME>=rate:burst``, e.g.
+``BUS_RATELIMIT_STUDENT=0.5:3``.
+"""
+import os
+import sqlite3
+import threading
+import time as time_module
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+
+def _limit(name: str, rate: float, burst: float) -> Tuple[float, float]:
+    value = os.environ.get(f"BUS_RATELIMIT_{name.upper()}")
+    if value:
+        rate_s, burst_s = value.split(':')
+        return float(rate_s), float(burst_s)
+    return rate, burst
+
+
+# name -> (tokens per second, bucket capacity)
+LIMITS: Dict[str, Tuple[float, float]] = {
+    'driver': _limit('driver', 2.0, 10.0),
+    'student': _limit('student', 1.0, 5.0),
+    'bus': _limit('bus', 20.0, 40.0),  # aggregate of student writes per bus
+}
+BUS_SCOPED_ROLES = ('student',)
+MAX_KEYS = int(os.environ.get("BUS_RATELIMIT_MAX_KEYS", "10000"))
+
+
+class MemoryBucketStore:
+    def __init__(self, max_keys: int = MAX_KEYS) -> None:
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float, cost: float = 1.0) -> Tuple[bool, float]:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return _spend(bucket, rate, burst, now, cost)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class SqliteBucketStore:
+    """Buckets shared across worker processes through a SQLite file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets(key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=1.0)
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rate: float, burst: float, now: float, cost: float = 1.0) -> Tuple[bool, float]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            bucket = list(row) if row else [burst, now]
+            allowed, retry_after = _spend(bucket, rate, burst, now, cost)
+            conn.execute("REPLACE INTO rate_buckets(key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, bucket[0], bucket[1]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+    def prune(self, max_idle: float = 3600.0) -> None:
+        """Delete buckets untouched for max_idle seconds (they would be full again)"""
+        self._conn().execute("DELETE FROM rate_buckets WHERE updated < ?", (time_module.time() - max_idle,))
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM rate_buckets")
+
+
+def _spend(bucket: list, rate: float, burst: float, now: float, cost: float) -> Tuple[bool, float]:
+    """Refill a [tokens, updated] bucket up to now, then try to take cost tokens"""
+    tokens = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= cost:
+        bucket[0] = tokens - cost
+        return True, 0.0
+    bucket[0] = tokens
+    return False, (cost - tokens) / rate if rate > 0 else float('inf')
+
+
+class RateLimiter:
+    def __init__(self, store=None, limits: Optional[Dict[str, Tuple[float, float]]] = None) -> None:
+        self.store = store if store is not None else MemoryBucketStore()
+        self.limits = limits if limits is not None else LIMITS
+
+    def check(self, user_id: str, role: str, bus_id: Optional[str],
+              now: Optional[float] = None) -> Tuple[bool, float, Optional[str]]:
+        """Charge one write to the user's bucket (and the bus's, for students).
+
+        Returns (allowed, retry_after_seconds, scope that rejected).
+        """
+        if now is None:
+            now = time_module.time()
+        rate, burst = self.limits.get(role, self.limits['student'])
+        allowed, retry_after = self.store.take(f"user:{user_id}", rate, burst, now)
+        if not allowed:
+            return self._decide(False, retry_after, 'user')
+        if bus_id is not None and role in BUS_SCOPED_ROLES:
+            rate, burst = self.limits['bus']
+            allowed, retry_after = self.store.take(f"bus:{bus_id}", rate, burst, now)
+            if not allowed:
+                return self._decide(False, retry_after, 'bus')
+        return self._decide(True, 0.0, None)
+
+    def _decide(self, allowed: bool, retry_after: float, scope: Optional[str]) -> Tuple[bool, float, Optional[str]]:
+        if allowed:
+            metrics.incr('ratelimit.allowed')
+        else:
+            metrics.incr(f'ratelimit.rejected.{scope}')
+        return allowed, retry_after, scope
+
+    def reset(self) -> None:
+        self.store.clear()
+
+
+def _default_store():
+    if os.environ.get("BUS_RATELIMIT_STORE") == "sqlite":
+        return SqliteBucketStore(os.environ.get("BUS_RATELIMIT_DB", "bus.ratelimit.db"))
+    return MemoryBucketStore()
+
+
+limiter = RateLimiter(_default_store())
@@ -0,0 +1,489 @@
+"""Offline replay of recorded or synthesized GPS traces.
+
+Streams a trace through ``app.process_location_fix`` - the same code path
+behind POST /location/share - against a scratch database, and reports the
+resulting stop-event timeline together with throughput numbers.
+
+Trace rows (CSV with a header, or one JSON object per line) use the fields:
+
+    t          seconds since the start of the trace (or ``timestamp`` as ISO 8601)
+    bus_id     bus the fix belongs to
+    user_id    reporting user
+    user_type  'driver' or 'student'
+    lat, lon   coordinates
+    accuracy   reported accuracy in meters (optional)
+
+Usage:
+    python replay.py trace.jsonl --speed 100 --events timeline.jsonl
+    python replay.py trace.csv --expect timeline.jsonl   # regression check
+    python replay.py trace.jsonl --expect timeline.jsonl --restart-at 600
+        # crash and warm-start the app 600 s into the trace; the timeline
+        # must come out the same as without the restart
+    python replay.py trace.jsonl --expect timeline.jsonl --workers 4
+        # buses partitioned across 4 processes; same timeline, more cores
+    python replay.py trace.jsonl --expect timeline.jsonl --workers 3 --kill-at 600
+        # 3 processes sharing one database and snapshot path, SIGKILLed
+        # 600 s in and restarted from what they left on disk
+"""
+import argparse
+import csv
+import json
+import os
+import signal
+import sys
+import tempfile
+import time as time_module
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import app as appm
+import db as dbm
+import workers
+from snapshot import snapshots
+from writer import writes
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield trace rows one at a time from a CSV or JSONL file"""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def row_offset(row: Dict[str, Any], origin: Optional[datetime]) -> float:
+    """Seconds since the start of the trace for a single row"""
+    if row.get('t') not in (None, ''):
+        return float(row['t'])
+    ts = datetime.fromisoformat(row['timestamp']).replace(tzinfo=None)
+    return (ts - origin).total_seconds() if origin else 0.0
+
+
+def bus_snapshot(bus_id: str) -> Optional[Dict[str, Any]]:
+    state = dbm.get_bus_state(bus_id)
+    if not state:
+        return None
+    return {'stop_index': state['stop_index'], 'status': appm.bus_status.get(bus_id)}
+
+
+def stop_event(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Classify the transition caused by one fix, if it is a stop event"""
+    if not after or after == before:
+        return None
+    if after['status'] == 'arrived':
+        if not before or before['status'] != 'arrived' or before['stop_index'] != after['stop_index']:
+            return 'arrived'
+    elif after['status'] == 'departing' and (not before or before['status'] != 'departing'):
+        return 'departing'
+    return None
+
+
+class ReplayResult:
+    def __init__(self) -> None:
+        self.events: List[Dict[str, Any]] = []
+        self.fixes = 0
+        self.status_counts: Dict[int, int] = {}
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.trace_seconds = 0.0
+        self.restarted_at: Optional[float] = None
+        self.event_rows: List[int] = []  # trace row index of each event
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'fixes': self.fixes,
+            'stop_events': len(self.events),
+            'responses': {str(k): v for k, v in sorted(self.status_counts.items())},
+            'trace_seconds': round(self.trace_seconds, 3),
+            'wall_seconds': round(self.wall_seconds, 3),
+            'speedup': round(self.trace_seconds / self.wall_seconds, 1) if self.wall_seconds else None,
+            'fixes_per_second': round(self.fixes / self.wall_seconds, 1) if self.wall_seconds else None,
+            'fixes_per_cpu_second': round(self.fixes / self.cpu_seconds, 1) if self.cpu_seconds else None,
+            'restarted_at': self.restarted_at,
+        }
+
+
+def simulate_restart(now: float) -> bool:
+    """Drop every piece of in-memory state, as a killed worker would, and warm-start"""
+    appm.reset_tracking_state()
+    dbm.invalidate_bus_state()
+    dbm.invalidate_stops()
+    snapshots.close()
+    return appm.warm_start(now)
+
+
+def replay(rows: Iterator[Dict[str, Any]], speed: Optional[float] = None,
+           db_path: Optional[str] = None, enable_students: bool = True,
+           restart_at: Optional[float] = None, snapshot_every: float = 10.0) -> ReplayResult:
+    """Feed trace rows through the ingest path and collect stop events.
+
+    ``speed`` is the acceleration factor relative to real time (e.g. 100 plays
+    a 100 s trace in one second); ``None`` runs as fast as possible. With
+    ``restart_at``, the app takes a snapshot every ``snapshot_every`` trace
+    seconds and is crashed and warm-started at that offset. Without
+    ``db_path`` the replay runs in a temporary database that is removed
+    afterwards, together with its snapshot files.
+    """
+    if db_path is not None:
+        return _replay(rows, speed, db_path, enable_students, restart_at, snapshot_every)
+    fd, db_path = tempfile.mkstemp(prefix='replay-', suffix='.db')
+    os.close(fd)
+    try:
+        return _replay(rows, speed, db_path, enable_students, restart_at, snapshot_every)
+    finally:
+        remove_scratch(db_path)
+
+
+def remove_scratch(db_path: str) -> None:
+    """Delete a scratch database, its shard files and any snapshot files next to it"""
+    snapshots.path = f"{db_path}.snapshot"
+    snapshots.remove()
+    snapshots.path = None
+    paths = set(dbm.all_shard_paths()) | {db_path}
+    for path in sorted(paths):
+        for name in (path, f"{path}-journal"):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def _replay(rows: Iterator[Dict[str, Any]], speed: Optional[float], db_path: str,
+            enable_students: bool, restart_at: Optional[float], snapshot_every: float,
+            kill_at: Optional[float] = None, resume_at: Optional[float] = None,
+            base_time: Optional[float] = None, events_path: Optional[str] = None) -> ReplayResult:
+    dbm.DB_PATH = db_path
+    # Apply writes inline so every fix sees the effects of the previous one
+    writes.threaded = False
+    # Snapshots only when testing a restart, next to the scratch database
+    snapshots.close()
+    crash_test = restart_at is not None or kill_at is not None or resume_at is not None
+    snapshots.path = f"{db_path}.snapshot" if crash_test else None
+    # Rows arrive much faster than real time: write every journal line at
+    # once so a killed run loses nothing an uninterrupted one would have kept
+    snapshots.flush_every = 0
+    if kill_at is None and resume_at is None:
+        # A killed or resumed run shares its database and snapshot path with
+        # the other partitions' processes; replay_killed() sets them up
+        dbm.init_db()
+        appm.reset_tracking_state()
+        snapshots.remove()
+    next_snapshot = snapshot_every
+
+    result = ReplayResult()
+    known_buses = set()
+    stops = {s['seq']: s['name'] for s in dbm.get_stops()}
+    base = datetime.now() if base_time is None else datetime.fromtimestamp(base_time)
+    origin: Optional[datetime] = None
+    events_log = open(events_path, 'a') if events_path else None
+
+    wall_start = time_module.perf_counter()
+    cpu_start = time_module.process_time()
+    for index, row in enumerate(rows):
+        if origin is None and row.get('t') in (None, '') and row.get('timestamp'):
+            origin = datetime.fromisoformat(row['timestamp']).replace(tzinfo=None)
+        offset = row_offset(row, origin)
+        bus_id = row.get('bus_id') or appm.BUS_ID
+        if snapshots.path:
+            sim_now = (base + timedelta(seconds=offset)).timestamp()
+            if resume_at is not None:
+                if offset < resume_at:
+                    continue  # replayed by the process that was killed
+                if not appm.warm_start(sim_now):
+                    raise RuntimeError("warm start found no snapshot")
+                result.restarted_at = offset
+                resume_at = None
+            elif restart_at is not None and offset >= restart_at:
+                if not simulate_restart(sim_now):
+                    raise RuntimeError("warm start found no snapshot")
+                result.restarted_at = offset
+                restart_at = None
+            elif kill_at is not None and offset >= kill_at:
+                if events_log is not None:
+                    # The replay's own counters (not app state): what was
+                    # replayed so far, for replay_killed() to add up
+                    events_log.write(json.dumps({'stats': {
+                        'fixes': result.fixes,
+                        'responses': result.status_counts,
+                        'trace_seconds': result.trace_seconds,
+                        'cpu_seconds': time_module.process_time() - cpu_start,
+                    }}) + '\n')
+                    events_log.flush()
+                # Die as a SIGKILLed worker does: no final snapshot, no cleanup
+                os.kill(os.getpid(), signal.SIGKILL)
+            elif offset >= next_snapshot:
+                appm.take_snapshot(sim_now)
+                next_snapshot = offset + snapshot_every
+        if bus_id not in known_buses:
+            dbm.ensure_bus(bus_id)
+            if enable_students:
+                appm.student_location_enabled[bus_id] = True
+            known_buses.add(bus_id)
+
+        if speed:
+            delay = offset / speed - (time_module.perf_counter() - wall_start)
+            if delay > 0:
+                time_module.sleep(delay)
+
+        data = {'bus_id': bus_id, 'lat': row['lat'], 'lon': row['lon']}
+        if row.get('accuracy') not in (None, ''):
+            data['accuracy'] = row['accuracy']
+
+        before = bus_snapshot(bus_id)
+        _, status_code = appm.process_location_fix(
+            row.get('user_id') or 'replay', row.get('user_type') or 'driver', data,
+            now=base + timedelta(seconds=offset)
+        )
+        after = bus_snapshot(bus_id)
+
+        result.fixes += 1
+        result.status_counts[status_code] = result.status_counts.get(status_code, 0) + 1
+        result.trace_seconds = offset
+        event = stop_event(before, after)
+        if event:
+            result.events.append({
+                't': round(offset, 3),
+                'bus_id': bus_id,
+                'event': event,
+                'stop_index': after['stop_index'],
+                'stop_name': stops.get(after['stop_index']),
+            })
+            result.event_rows.append(index)
+            if events_log is not None:
+                # Flushed per event so a killed process's events survive it
+                events_log.write(json.dumps(dict(result.events[-1], row=index)) + '\n')
+                events_log.flush()
+
+    if events_log is not None:
+        events_log.close()
+    result.wall_seconds = time_module.perf_counter() - wall_start
+    result.cpu_seconds = time_module.process_time() - cpu_start
+    return result
+
+
+def _replay_partition(rows: List[Dict[str, Any]], db_path: Optional[str], check_state: bool,
+                      kwargs: Dict[str, Any]) -> ReplayResult:
+    """Worker-process task: replay one partition's buses into their own database"""
+    appm.app.logger.disabled = True
+    dbm.STATE_CHECK = check_state
+    return replay(iter(rows), db_path=db_path, **kwargs)
+
+
+def replay_partitioned(rows: Iterator[Dict[str, Any]], processes: int, db_path: Optional[str] = None,
+                       **kwargs: Any) -> ReplayResult:
+    """Replay with buses partitioned across worker processes (see workers.py).
+
+    Buses don't share tracking state, so each partition replays its buses
+    independently; the events are merged back into trace order. ``db_path``
+    gets a ``.part<N>`` suffix per partition.
+    """
+    partitions: List[List[Dict[str, Any]]] = [[] for _ in range(processes)]
+    positions: List[List[int]] = [[] for _ in range(processes)]
+    for index, row in enumerate(rows):
+        part = workers.partition(row.get('bus_id') or appm.BUS_ID, processes)
+        partitions[part].append(row)
+        positions[part].append(index)
+
+    pool = workers.WorkerPool(processes)
+    wall_start = time_module.perf_counter()
+    try:
+        futures = [pool.submit_to(i, 'replay:_replay_partition', partitions[i],
+                                  f"{db_path}.part{i}" if db_path else None, dbm.STATE_CHECK, kwargs)
+                   for i in range(processes) if partitions[i]]
+        parts = [(i, f.result()) for i, f in zip([i for i in range(processes) if partitions[i]], futures)]
+    finally:
+        pool.close()
+
+    result = ReplayResult()
+    result.wall_seconds = time_module.perf_counter() - wall_start
+    merged = []
+    for i, part in parts:
+        result.fixes += part.fixes
+        for code, n in part.status_counts.items():
+            result.status_counts[code] = result.status_counts.get(code, 0) + n
+        result.trace_seconds = max(result.trace_seconds, part.trace_seconds)
+        result.cpu_seconds += part.cpu_seconds
+        if part.restarted_at is not None:
+            result.restarted_at = min(part.restarted_at, result.restarted_at or part.restarted_at)
+        merged.extend((positions[i][row], event) for row, event in zip(part.event_rows, part.events))
+    merged.sort(key=lambda pair: pair[0])
+    result.event_rows = [row for row, _ in merged]
+    result.events = [event for _, event in merged]
+    return result
+
+
+def _replay_phase(rows: List[Dict[str, Any]], db_path: str, events_path: str, base_time: float,
+                  kill_at: float, resumed: bool, check_state: bool, speed: Optional[float],
+                  enable_students: bool, snapshot_every: float) -> ReplayResult:
+    """Worker-process task: one partition's trace up to the kill, or the rest of it after a restart"""
+    appm.app.logger.disabled = True
+    dbm.STATE_CHECK = check_state
+    return _replay(iter(rows), speed, db_path, enable_students, None, snapshot_every,
+                   kill_at=None if resumed else kill_at, resume_at=kill_at if resumed else None,
+                   base_time=base_time, events_path=events_path)
+
+
+def _add_counts(result: ReplayResult, fixes: int, status_counts: Dict[int, int],
+                trace_seconds: float, cpu_seconds: float) -> None:
+    result.fixes += fixes
+    for code, n in status_counts.items():
+        result.status_counts[code] = result.status_counts.get(code, 0) + n
+    result.trace_seconds = max(result.trace_seconds, trace_seconds)
+    result.cpu_seconds += cpu_seconds
+
+
+def replay_killed(rows: Iterator[Dict[str, Any]], kill_at: float, processes: int = 1,
+                  db_path: Optional[str] = None, speed: Optional[float] = None,
+                  enable_students: bool = True, snapshot_every: float = 10.0) -> ReplayResult:
+    """Replay in worker processes that are SIGKILLed ``kill_at`` trace seconds in, then restarted.
+
+    As gunicorn workers do, the processes share one database and one
+    snapshot path, each replaying its partition of the buses. The pool
+    restarts the killed processes under new pids; they warm-start from the
+    snapshot sections and journals left on disk and replay the rest of the
+    trace. Events are logged as they happen, so those from before the kill
+    survive it, and the merged timeline must match an uninterrupted run.
+    Each killed process also logs its fix and response counts just before
+    dying, so the totals cover the whole trace.
+    """
+    partitions: List[List[Dict[str, Any]]] = [[] for _ in range(processes)]
+    positions: List[List[int]] = [[] for _ in range(processes)]
+    for index, row in enumerate(rows):
+        part = workers.partition(row.get('bus_id') or appm.BUS_ID, processes)
+        partitions[part].append(row)
+        positions[part].append(index)
+
+    scratch = db_path is None
+    if scratch:
+        fd, db_path = tempfile.mkstemp(prefix='replay-', suffix='.db')
+        os.close(fd)
+    dbm.DB_PATH = db_path
+    dbm.init_db()
+    snapshots.path = f"{db_path}.snapshot"
+    snapshots.remove()
+    snapshots.path = None
+    events_paths = [f"{db_path}.events{i}" for i in range(processes)]
+    for path in events_paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    result = ReplayResult()
+    base_time = time_module.time()
+    pool = workers.WorkerPool(processes)
+    wall_start = time_module.perf_counter()
+    try:
+        for resumed in (False, True):
+            futures = [(i, pool.submit_to(i, 'replay:_replay_phase', partitions[i], db_path, events_paths[i],
+                                          base_time, kill_at, resumed, dbm.STATE_CHECK, speed,
+                                          enable_students, snapshot_every))
+                       for i in range(processes) if partitions[i]]
+            for i, future in futures:
+                try:
+                    part = future.result()
+                except workers.TaskError as e:
+                    if resumed or str(e) != f"worker {i} died":
+                        raise
+                    continue  # killed, as intended
+                _add_counts(result, part.fixes, part.status_counts, part.trace_seconds, part.cpu_seconds)
+                if part.restarted_at is not None:
+                    result.restarted_at = min(part.restarted_at, result.restarted_at or part.restarted_at)
+        result.wall_seconds = time_module.perf_counter() - wall_start
+
+        merged = []
+        for i, path in enumerate(events_paths):
+            if not os.path.exists(path):
+                continue
+            for entry in read_trace(path):
+                if 'stats' in entry:
+                    stats = entry['stats']
+                    _add_counts(result, stats['fixes'], {int(code): n for code, n in stats['responses'].items()},
+                                stats['trace_seconds'], stats['cpu_seconds'])
+                else:
+                    merged.append((positions[i][entry.pop('row')], entry))
+        merged.sort(key=lambda pair: pair[0])
+        result.event_rows = [row for row, _ in merged]
+        result.events = [event for _, event in merged]
+        return result
+    finally:
+        pool.close()
+        for path in events_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if scratch:
+            remove_scratch(db_path)
+
+
+def compare_timelines(actual: List[Dict[str, Any]], expected_path: str) -> List[str]:
+    """Return human-readable differences between a timeline and a saved one"""
+    keys = ('bus_id', 'event', 'stop_index')
+    expected = [{k: e.get(k) for k in keys} for e in read_trace(expected_path)]
+    got = [{k: e.get(k) for k in keys} for e in actual]
+    diffs = []
+    for i in range(max(len(expected), len(got))):
+        exp = expected[i] if i < len(expected) else None
+        act = got[i] if i < len(got) else None
+        if exp != act:
+            diffs.append(f"event {i}: expected {exp}, got {act}")
+    return diffs
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a GPS trace through the ingest path")
+    parser.add_argument('trace', help="CSV or JSONL trace file")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="acceleration relative to real time, e.g. 10-1000 (default: unthrottled)")
+    parser.add_argument('--db', default=None, help="database file to replay into (default: temporary)")
+    parser.add_argument('--events', default=None, help="write the stop-event timeline to this JSONL file")
+    parser.add_argument('--expect', default=None, help="compare the timeline against this JSONL file")
+    parser.add_argument('--no-students', action='store_true',
+                        help="leave student location sharing disabled")
+    parser.add_argument('--restart-at', type=float, default=None,
+                        help="crash and warm-start the app this many trace seconds in")
+    parser.add_argument('--kill-at', type=float, default=None,
+                        help="SIGKILL the replaying processes (--workers, default 1) this many trace seconds "
+                             "in, restart them and finish from their snapshots")
+    parser.add_argument('--snapshot-every', type=float, default=10.0,
+                        help="trace seconds between snapshots when testing a restart")
+    parser.add_argument('--check-state', action='store_true',
+                        help="verify the in-memory bus_state mirror against SQLite on every read")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="replay buses in this many processes, partitioned by bus (default: inline)")
+    args = parser.parse_args(argv)
+
+    appm.app.logger.disabled = True
+    dbm.STATE_CHECK = args.check_state
+    options = dict(speed=args.speed, enable_students=not args.no_students,
+                   restart_at=args.restart_at, snapshot_every=args.snapshot_every)
+    if args.kill_at is not None:
+        if args.restart_at is not None:
+            parser.error("--kill-at and --restart-at are alternatives")
+        result = replay_killed(read_trace(args.trace), args.kill_at, max(args.workers, 1), db_path=args.db,
+                               speed=args.speed, enable_students=not args.no_students,
+                               snapshot_every=args.snapshot_every)
+    elif args.workers > 1:
+        result = replay_partitioned(read_trace(args.trace), args.workers, db_path=args.db, **options)
+    else:
+        result = replay(read_trace(args.trace), db_path=args.db, **options)
+
+    if args.events:
+        with open(args.events, 'w') as f:
+            for event in result.events:
+                f.write(json.dumps(event) + '\n')
+    else:
+        for event in result.events:
+            print(json.dumps(event))
+    print(json.dumps(result.summary()), file=sys.stderr)
+
+    if args.expect:
+        diffs = compare_timelines(result.events, args.expect)
+        for d in diffs:
+            print(d, file=sys.stderr)
+        return 1 if diffs else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Pre-encoded response bodies for hot polling endpoints.
+
+``GET /bus/<id>`` and ``GET /stops`` are polled by every open page but only
+change when the bus state (or the stop list) does. Each entry keeps the
+encoded bytes for an ``(endpoint, bus_id, mimetype)`` key together with the
+version it was built from - the mirrored ``BusState`` record, the bus's
+in-memory status and the cached stop list (see db.py). Every write replaces
+those objects, so a write invalidates the entry implicitly: a lookup whose
+version differs misses and the caller rebuilds the body.
+
+JSON is encoded with ``orjson`` when it is installed (keys sorted, like
+Flask's ``jsonify``) and the standard library otherwise.
+"""
+import json
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+JSON_MIMETYPE = 'application/json'
+
+Key = Tuple[str, str, Optional[str]]  # (endpoint, bus_id, mimetype)
+
+
+def dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+class ResponseCache:
+    def __init__(self) -> None:
+        self._entries: Dict[Key, Tuple[Tuple[Any, ...], bytes, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Key, version: Tuple[Any, ...]) -> Optional[Tuple[bytes, str]]:
+        """The cached (body, mimetype) if it was built from this version"""
+        entry = self._entries.get(key)
+        # Versions hold the source objects, so == is an identity check
+        if entry is not None and entry[0] == version:
+            metrics.incr('respcache.hit')
+            return entry[1], entry[2]
+        metrics.incr('respcache.miss')
+        return None
+
+    def put(self, key: Key, version: Tuple[Any, ...], body: bytes, mimetype: str) -> Tuple[bytes, str]:
+        with self._lock:
+            self._entries[key] = (version, body, mimetype)
+        return body, mimetype
+
+    def invalidate(self, bus_id: Optional[str] = None) -> None:
+        """Drop the entries of one bus (or all)"""
+        with self._lock:
+            if bus_id is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[1] == bus_id]:
+                    del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+responses = ResponseCache()
@@ -0,0 +1,145 @@
+"""Cap how many students report GPS for each bus.
+
+Beyond ~10 agreeing reporters extra student fixes cost storage and
+clustering time without improving the position. The sampler keeps a
+rotating quorum of reporters per bus, picked by weighted sampling that
+favours good recent accuracy and agreement with the consensus position:
+the centre of the bus's majority cluster (see clustering.py), or the
+median of the quorum while no cluster holds a majority.
+Everyone else is told to pause until the next rotation; their fixes only
+refresh their candidate stats in memory and are never stored.
+"""
+import os
+import random
+import threading
+from math import exp
+from statistics import median
+from typing import Dict, Optional, Tuple
+
+import clustering
+import db as dbm
+import metrics
+
+QUORUM_SIZE = int(os.environ.get("BUS_SAMPLER_QUORUM", "10"))
+ROTATE_SECONDS = float(os.environ.get("BUS_SAMPLER_ROTATE_SECONDS", "60"))
+STALE_SECONDS = 30.0       # a selected reporter silent this long frees its slot
+AGREEMENT_SCALE = 100.0    # meters; weight halves roughly every 70 m off consensus
+ACCURACY_ALPHA = 0.3       # EMA factor for reported accuracy
+
+
+class Reporter:
+    __slots__ = ('lat', 'lon', 'accuracy', 'last_seen')
+
+    def __init__(self, lat: float, lon: float, accuracy: float, now: float) -> None:
+        self.lat = lat
+        self.lon = lon
+        self.accuracy = accuracy
+        self.last_seen = now
+
+
+class BusSample:
+    def __init__(self) -> None:
+        self.candidates: Dict[str, Reporter] = {}
+        self.selected: set = set()
+        self.epoch = -1
+        self.rotated_at = 0.0
+
+
+class ReporterSampler:
+    def __init__(self, quorum: int = QUORUM_SIZE, rotate_seconds: float = ROTATE_SECONDS) -> None:
+        self.quorum = quorum
+        self.rotate_seconds = rotate_seconds
+        self._buses: Dict[str, BusSample] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, bus_id: str, user_id: str, lat: float, lon: float,
+                accuracy: float, now: float) -> bool:
+        """Record a student fix; True if the sender is in the bus's quorum"""
+        with self._lock:
+            bus = self._buses.setdefault(bus_id, BusSample())
+            reporter = bus.candidates.get(user_id)
+            if reporter is None:
+                bus.candidates[user_id] = Reporter(lat, lon, accuracy, now)
+            else:
+                reporter.lat, reporter.lon, reporter.last_seen = lat, lon, now
+                reporter.accuracy += ACCURACY_ALPHA * (accuracy - reporter.accuracy)
+
+            epoch = int(now // self.rotate_seconds)
+            if epoch != bus.epoch:
+                self._rotate(bus_id, bus, epoch, now)
+            elif user_id not in bus.selected:
+                self._fill_free_slot(bus, user_id, now)
+
+            selected = user_id in bus.selected
+            consensus = self._consensus(bus_id, bus)
+
+        metrics.incr('sampler.accepted' if selected else 'sampler.paused')
+        metrics.observe('sampler.selected_accuracy_m' if selected else 'sampler.paused_accuracy_m', accuracy)
+        if consensus and selected:
+            metrics.observe('sampler.agreement_m', dbm.calculate_distance(lat, lon, *consensus))
+        return selected
+
+    def pause_ms(self, now: float) -> int:
+        """Milliseconds until the next rotation, when a paused reporter may be picked"""
+        next_epoch = (int(now // self.rotate_seconds) + 1) * self.rotate_seconds
+        return int((next_epoch - now) * 1000) + 500
+
+    def _rotate(self, bus_id: str, bus: BusSample, epoch: int, now: float) -> None:
+        # Forget candidates that stopped reporting across a whole rotation
+        cutoff = now - 2 * self.rotate_seconds
+        for uid in [u for u, r in bus.candidates.items() if r.last_seen < cutoff]:
+            del bus.candidates[uid]
+        bus.epoch = epoch
+        bus.rotated_at = now
+        if len(bus.candidates) <= self.quorum:
+            bus.selected = set(bus.candidates)
+            return
+
+        consensus = self._consensus(bus_id, bus) or self._median(bus.candidates.values())
+        # Weighted sampling without replacement (Efraimidis-Spirakis), seeded
+        # per rotation so the quorum changes from one epoch to the next
+        rng = random.Random(f"{bus_id}:{epoch}")
+        keyed = []
+        for uid, r in sorted(bus.candidates.items()):
+            weight = self._weight(r, consensus)
+            keyed.append((rng.random() ** (1.0 / weight), uid))
+        keyed.sort(reverse=True)
+        bus.selected = {uid for _, uid in keyed[:self.quorum]}
+
+    def _fill_free_slot(self, bus: BusSample, user_id: str, now: float) -> None:
+        # Reporters picked at a rotation were paused until then, so their
+        # silence only counts from the rotation onwards
+        fresh = {u for u in bus.selected
+                 if u in bus.candidates
+                 and now - max(bus.candidates[u].last_seen, bus.rotated_at) <= STALE_SECONDS}
+        if len(fresh) < self.quorum:
+            fresh.add(user_id)
+        bus.selected = fresh
+
+    def _weight(self, r: Reporter, consensus: Optional[Tuple[float, float]]) -> float:
+        weight = 1.0 / max(r.accuracy, 5.0) ** 2
+        if consensus:
+            weight *= exp(-dbm.calculate_distance(r.lat, r.lon, *consensus) / AGREEMENT_SCALE)
+        return max(weight, 1e-12)
+
+    def _consensus(self, bus_id: str, bus: BusSample) -> Optional[Tuple[float, float]]:
+        # An outlier group outside the majority cluster doesn't move its centre
+        majority = clustering.for_bus(bus_id).majority()
+        if majority:
+            return majority['center_lat'], majority['center_lon']
+        members = [bus.candidates[u] for u in bus.selected if u in bus.candidates]
+        return self._median(members) if members else None
+
+    @staticmethod
+    def _median(reporters) -> Optional[Tuple[float, float]]:
+        reporters = list(reporters)
+        if not reporters:
+            return None
+        return median(r.lat for r in reporters), median(r.lon for r in reporters)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buses.clear()
+
+
+sampler = ReporterSampler()
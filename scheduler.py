@@ -0,0 +1,166 @@
+"""In-process scheduler for periodic maintenance jobs.
+
+Jobs sit in heaps ordered by their next due time. Each lane has its own
+daemon thread per process: the frequent jobs of a few milliseconds run on
+the ``default`` lane, and jobs that can take minutes (vacuum, history
+downsampling and archiving) are given ``lane="long"``, so they never delay
+the others. Jobs on one lane run one at a time. Every worker computes the same due times from the wall
+clock, so an exclusive job claims its slot in a SQLite lock row
+(``scheduler_runs``) before running: the first worker to claim a slot runs
+the job and the others skip it. Non-exclusive jobs (e.g. cleaning up this
+process's in-memory sessions) run in every worker.
+
+Each run records ``scheduler.<job>.ms`` and ``scheduler.<job>.runs`` /
+``.skipped`` / ``.errors`` in metrics.
+"""
+import heapq
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time as time_module
+from datetime import datetime, time, timedelta
+from itertools import count
+from typing import Callable, Dict, List, Optional, Tuple
+
+import db as dbm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LANES = ("default", "long")
+
+
+class Job:
+    def __init__(self, name: str, fn: Callable[[], object], every: Optional[float] = None,
+                 daily: Optional[time] = None, exclusive: bool = True, lane: str = "default") -> None:
+        if (every is None) == (daily is None):
+            raise ValueError("Job needs exactly one of every= or daily=")
+        if lane not in LANES:
+            raise ValueError(f"Unknown scheduler lane {lane!r}")
+        self.name = name
+        self.fn = fn
+        self.every = every
+        self.daily = daily
+        self.exclusive = exclusive
+        self.lane = lane
+
+    def next_due(self, now: float) -> float:
+        """Next slot strictly after now; identical in every worker"""
+        if self.every is not None:
+            return (now // self.every + 1) * self.every
+        current = datetime.fromtimestamp(now)
+        due = datetime.combine(current.date(), self.daily)
+        if due.timestamp() <= now:
+            due = datetime.combine(current.date() + timedelta(days=1), self.daily)
+        return due.timestamp()
+
+
+class Scheduler:
+    def __init__(self, lock_path: Optional[str] = None, owner: Optional[str] = None) -> None:
+        self.lock_path = lock_path
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._heaps: Dict[str, List[Tuple[float, int, Job]]] = {lane: [] for lane in LANES}
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    def add(self, job: Job, now: Optional[float] = None) -> Job:
+        if now is None:
+            now = time_module.time()
+        with self._cond:
+            heapq.heappush(self._heaps[job.lane], (job.next_due(now), next(self._seq), job))
+            self._cond.notify_all()
+        return job
+
+    def start(self) -> None:
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for lane in LANES:
+                name = "scheduler" if lane == "default" else f"scheduler-{lane}"
+                thread = threading.Thread(target=self._loop, args=(lane,), name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _loop(self, lane: str) -> None:
+        heap = self._heaps[lane]
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if heap:
+                        delay = heap[0][0] - time_module.time()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                due, _, job = heapq.heappop(heap)
+            self._run(job, due)
+            with self._cond:
+                heapq.heappush(heap, (job.next_due(max(due, time_module.time())), next(self._seq), job))
+
+    def run_pending(self, now: Optional[float] = None) -> None:
+        """Run every job due by now, on every lane, on the calling thread (no background threads)"""
+        if now is None:
+            now = time_module.time()
+        while True:
+            with self._cond:
+                due_heaps = [heap for heap in self._heaps.values() if heap and heap[0][0] <= now]
+                if not due_heaps:
+                    return
+                heap = min(due_heaps, key=lambda h: h[0][:2])
+                due, _, job = heapq.heappop(heap)
+            self._run(job, due)
+            with self._cond:
+                heapq.heappush(heap, (job.next_due(max(due, now)), next(self._seq), job))
+
+    def _run(self, job: Job, due: float) -> None:
+        if job.exclusive and not self._claim(job.name, due):
+            metrics.incr(f'scheduler.{job.name}.skipped')
+            return
+        started = time_module.perf_counter()
+        try:
+            job.fn()
+            metrics.incr(f'scheduler.{job.name}.runs')
+        except Exception:
+            metrics.incr(f'scheduler.{job.name}.errors')
+            logger.exception(f"Scheduled job {job.name} failed")
+        finally:
+            metrics.observe(f'scheduler.{job.name}.ms', (time_module.perf_counter() - started) * 1000)
+
+    def _claim(self, name: str, due: float) -> bool:
+        """Take the job's slot in the lock row; False if another worker has it"""
+        conn = sqlite3.connect(self.lock_path or dbm.DB_PATH, timeout=5.0)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scheduler_runs(job TEXT PRIMARY KEY, slot REAL, owner TEXT, claimed_at TEXT)"
+            )
+            conn.execute("INSERT OR IGNORE INTO scheduler_runs(job, slot) VALUES (?, 0)", (name,))
+            cur = conn.execute(
+                "UPDATE scheduler_runs SET slot = ?, owner = ?, claimed_at = ? WHERE job = ? AND slot < ?",
+                (due, self.owner, dbm.iso_now(), name, due),
+            )
+            conn.commit()
+            return cur.rowcount == 1
+        except sqlite3.Error:
+            logger.exception(f"Could not claim scheduler slot for {name}")
+            return False
+        finally:
+            conn.close()
+
+
+scheduler = Scheduler()
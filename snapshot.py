@@ -0,0 +1,295 @@
+"""Crash-safe snapshots of in-memory tracking state, with a journal in between.
+
+Snapshots are off unless ``BUS_SNAPSHOT_PATH`` is set. Every worker process
+then owns one section of that path: ``<path>.<pid>`` and
+``<path>.<pid>.journal``, both created readable by the owner only (0600). A
+snapshot is one compact JSON document written to ``<path>.<pid>.tmp``,
+fsynced and renamed over the section, so a crash leaves either the old
+snapshot or the new one, and workers never write each other's files.
+Changes made between snapshots are buffered as one JSON line each and
+written to the section's journal at most every ``BUS_JOURNAL_FLUSH_SECONDS``
+(default 1; 0 writes every change at once), by the next change or by the
+``journal_flush`` job. Written lines survive the process being killed
+(though not the host losing power); a kill loses at most that last
+interval of changes. Taking a snapshot truncates the worker's own journal.
+
+Journal entries carry absolute values ("bus_status of S1/A is now
+arrived"), so replaying one that the snapshot already contains - after a
+crash between the rename and the truncate - is harmless.
+
+A restarted worker has a new pid, so ``load()`` returns every section it
+finds, least recently written first, for the caller to merge. Sections
+whose worker is gone are deleted once this worker's first snapshot has
+absorbed them. What goes into the state, and how sections are merged, is
+up to the caller (see ``capture_tracking_state`` / ``warm_start`` in app.py).
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time as time_module
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, separators=(',', ':'), default=str)
+
+
+def _private(path: str, flags: int) -> int:
+    """``open()`` opener creating files readable and writable by the owner only"""
+    fd = os.open(path, flags, 0o600)
+    os.fchmod(fd, 0o600)  # also for a file left by an older version
+    return fd
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's process
+    return True
+
+
+class Snapshotter:
+    def __init__(self, path: Optional[str], flush_every: float = 1.0) -> None:
+        self.path = path
+        self.flush_every = flush_every
+        self._journal = None
+        self._journal_pid: Optional[int] = None
+        self._pending: List[str] = []  # journal lines not written yet
+        self._pending_pid: Optional[int] = None
+        self._flushed_at = 0.0
+        self._orphans: List[str] = []  # dead workers' sections, deleted after the next take()
+        self._lock = threading.Lock()
+
+    @property
+    def section_path(self) -> str:
+        # Looked up on every use: gunicorn may fork after the app is imported
+        return f"{self.path}.{os.getpid()}"
+
+    @property
+    def journal_path(self) -> str:
+        return f"{self.section_path}.journal"
+
+    def journal(self, entry: Dict[str, Any]) -> None:
+        """Append one change; a no-op when snapshots are disabled"""
+        if not self.path:
+            return
+        line = _dumps(entry) + '\n'
+        with self._lock:
+            if self._pending_pid != os.getpid():
+                # Lines buffered before a fork are the parent's to write
+                self._pending = []
+                self._pending_pid = os.getpid()
+            self._pending.append(line)
+            if time_module.monotonic() - self._flushed_at >= self.flush_every:
+                self._flush()
+        metrics.incr('snapshot.journal_entries')
+
+    def flush(self) -> None:
+        """Write out the buffered journal lines (run every flush interval by the app)"""
+        if not self.path:
+            return
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._flushed_at = time_module.monotonic()
+        if not self._pending or self._pending_pid != os.getpid():
+            return
+        if self._journal is None or self._journal_pid != os.getpid():
+            # A forked child must not write through its parent's handle
+            self._journal = open(self.journal_path, 'a', encoding='utf-8', opener=_private)
+            self._journal_pid = os.getpid()
+        self._journal.write(''.join(self._pending))
+        self._journal.flush()
+        metrics.observe('snapshot.journal_batch', len(self._pending))
+        self._pending = []
+
+    def take(self, capture: Callable[[], Dict[str, Any]]) -> int:
+        """Atomically replace this worker's section with ``capture()``; returns its size in bytes"""
+        if not self.path:
+            return 0
+        section = self.section_path
+        tmp = f"{section}.tmp"
+        with self._lock:
+            # Captured under the journal lock: a change that lands after the
+            # capture is journaled only once the journal has been truncated
+            body = _dumps({'version': SNAPSHOT_VERSION, 'state': capture()}).encode('utf-8')
+            with open(tmp, 'wb', opener=_private) as f:
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, section)
+            # Everything journaled so far, written or not, is in the snapshot now
+            if self._journal is not None and self._journal_pid == os.getpid():
+                self._journal.close()
+            self._journal = open(self.journal_path, 'w', encoding='utf-8', opener=_private)
+            self._journal_pid = os.getpid()
+            self._pending = []
+            self._flushed_at = time_module.monotonic()
+            orphans, self._orphans = self._orphans, []
+        # What the dead workers left is part of this section now
+        for name in orphans:
+            self._remove_section(name)
+        metrics.set_gauge('snapshot.bytes', len(body))
+        return len(body)
+
+    def load(self) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """Every section's last snapshot state and the journal written after it, least recently written first"""
+        if not self.path:
+            return []
+        loaded: Dict[str, Optional[Tuple[float, Dict[str, Any], List[Dict[str, Any]]]]] = {}
+        # A worker that started first may absorb and delete a section while
+        # we read it; its own section, written before the delete, turns up
+        # on the next pass
+        while True:
+            fresh = [name for name in self._sections() if name not in loaded]
+            if not fresh:
+                break
+            for name in fresh:
+                loaded[name] = self._read_section(name)
+        own = self.section_path
+        self._orphans = [name for name in loaded if name != own and not self._owned_by_live_worker(name)]
+        sections = sorted((section for section in loaded.values() if section is not None),
+                          key=lambda section: section[0])
+        return [(state, journal) for _, state, journal in sections]
+
+    def _sections(self) -> List[str]:
+        prefix = f"{self.path}."
+        names = [name for name in glob.glob(f"{glob.escape(prefix)}*") if name[len(prefix):].isdigit()]
+        if os.path.exists(self.path):
+            names.append(self.path)  # the single file written before sections
+        return names
+
+    def _owned_by_live_worker(self, name: str) -> bool:
+        suffix = name[len(self.path) + 1:]
+        return suffix.isdigit() and _alive(int(suffix))
+
+    def _read_section(self, name: str) -> Optional[Tuple[float, Dict[str, Any], List[Dict[str, Any]]]]:
+        """(last written, state, journal) of one section, or None if it is gone or unusable"""
+        try:
+            with open(name, 'rb') as f:
+                written = os.fstat(f.fileno()).st_mtime
+                document = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable snapshot {name}: {e}")
+            return None
+        if document.get('version') != SNAPSHOT_VERSION:
+            logger.warning(f"Ignoring snapshot version {document.get('version')} in {name}")
+            return None
+        journal_path = f"{name}.journal"
+        try:
+            written = max(written, os.path.getmtime(journal_path))
+        except OSError:
+            pass
+        return written, document['state'], list(self._read_journal(journal_path))
+
+    def _read_journal(self, path: str) -> Iterator[Dict[str, Any]]:
+        try:
+            f = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    break
+
+    def _remove_section(self, name: str) -> None:
+        for path in (f"{name}.journal", name):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self) -> None:
+        """Delete every worker's snapshot, journal and temporary file for this path"""
+        if not self.path:
+            return
+        self.close()
+        prefix = f"{self.path}."
+        names = [name for name in glob.glob(f"{glob.escape(prefix)}*")
+                 if name[len(prefix):].split('.')[0].isdigit()]
+        for name in names + [self.path, f"{self.path}.journal", f"{self.path}.tmp"]:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self._journal is not None and self._journal_pid == os.getpid():
+                self._journal.close()
+            self._journal = None
+
+
+class JournaledDict(dict):
+    """A dict whose set/delete/clear operations are journaled under ``name``.
+
+    Only writes that change a value are journaled, so ``d[k] = v`` on every
+    GPS fix costs a comparison when nothing changed. In-place mutation of a
+    value (``d[k].update(...)``) is not seen; the next snapshot picks it up.
+    """
+
+    def __init__(self, name: str, snapshots: Snapshotter) -> None:
+        super().__init__()
+        self.name = name
+        self.snapshots = snapshots
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self and dict.__getitem__(self, key) == value:
+            return
+        dict.__setitem__(self, key, value)
+        self.snapshots.journal({'d': self.name, 'op': 'set', 'k': key, 'v': value})
+
+    def __delitem__(self, key: str) -> None:
+        dict.__delitem__(self, key)
+        self.snapshots.journal({'d': self.name, 'op': 'del', 'k': key})
+
+    def pop(self, key: str, *default: Any) -> Any:
+        if key in self:
+            self.snapshots.journal({'d': self.name, 'op': 'del', 'k': key})
+        return dict.pop(self, key, *default)
+
+    def clear(self) -> None:
+        if self:
+            self.snapshots.journal({'d': self.name, 'op': 'clear'})
+        dict.clear(self)
+
+    def load(self, values: Dict[str, Any]) -> None:
+        """Replace the contents without journaling (warm start)"""
+        dict.clear(self)
+        dict.update(self, values)
+
+    def merge(self, values: Dict[str, Any]) -> None:
+        """Add values over the current contents without journaling (another section)"""
+        dict.update(self, values)
+
+    def apply(self, entry: Dict[str, Any]) -> None:
+        """Re-apply one journaled operation without journaling it again"""
+        if entry['op'] == 'set':
+            dict.__setitem__(self, entry['k'], entry['v'])
+        elif entry['op'] == 'del':
+            dict.pop(self, entry['k'], None)
+        elif entry['op'] == 'clear':
+            dict.clear(self)
+
+
+# Snapshots and the journal are off unless BUS_SNAPSHOT_PATH is set
+snapshots = Snapshotter(os.environ.get("BUS_SNAPSHOT_PATH") or None,
+                        float(os.environ.get("BUS_JOURNAL_FLUSH_SECONDS", "1")))
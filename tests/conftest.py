@@ -0,0 +1,31 @@
+"""Shared fixtures: the repository on sys.path, a scratch database, a small fleet trace"""
+import os
+import sys
+from typing import Any, Dict, List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as dbm  # noqa: E402
+import tracegen  # noqa: E402
+from snapshot import snapshots  # noqa: E402
+from writer import writes  # noqa: E402
+
+
+def small_trace(seed: int = 3) -> List[Dict[str, Any]]:
+    """Two buses with two students each over the seed route (~1500 fixes)"""
+    return list(tracegen.fleet_trace(tracegen.load_route(), buses=2, seed=seed, stagger=60,
+                                     students=2, driver_interval=4, student_interval=12))
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    """Run in a temporary directory and put back the module globals replay.py changes"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dbm, 'DB_PATH', dbm.DB_PATH)
+    monkeypatch.setattr(dbm, 'STATE_CHECK', dbm.STATE_CHECK)
+    monkeypatch.setattr(writes, 'threaded', writes.threaded)
+    monkeypatch.setattr(snapshots, 'path', snapshots.path)
+    monkeypatch.setattr(snapshots, 'flush_every', snapshots.flush_every)
+    return tmp_path
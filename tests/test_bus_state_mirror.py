@@ -0,0 +1,57 @@
+"""The in-memory bus_state mirror never diverges from SQLite (BUS_STATE_CHECK)"""
+import pytest
+
+import db as dbm
+import replay
+import tracegen
+from conftest import small_trace
+from test_replay import TIMELINE
+from writer import WriteQueue
+
+BUS = 'S1/A'
+
+
+@pytest.fixture
+def checked_db(scratch):
+    dbm.DB_PATH = str(scratch / 'bus.db')
+    dbm.STATE_CHECK = True
+    dbm.init_db()
+    dbm.ensure_bus(BUS)
+    return scratch
+
+
+@pytest.mark.parametrize('workers', [[], ['--workers', '2']])
+def test_replay_with_state_check_never_diverges(scratch, workers):
+    # --check-state compares every mirrored read with disk and raises on a difference
+    trace = str(scratch / 'trace.jsonl')
+    with open(trace, 'w') as f:
+        tracegen.write_jsonl(iter(small_trace(seed=3)), f)
+
+    assert replay.main([trace, '--check-state', '--expect', TIMELINE] + workers) == 0
+
+
+def test_state_check_catches_a_write_that_bypasses_the_mirror(checked_db):
+    dbm.get_bus_state(BUS)
+    conn = dbm.get_conn(BUS)
+    conn.execute("UPDATE bus_state SET stop_index = 3 WHERE bus_id = ?", (BUS,))
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(AssertionError, match='mirror'):
+        dbm.get_bus_state(BUS)
+
+
+def test_rolled_back_intent_is_not_mirrored(checked_db):
+    writes = WriteQueue(threaded=True)
+    before = dbm.get_bus_state(BUS).as_dict()
+
+    def move_then_fail(bus_id, conn):
+        dbm.set_bus_to_stop(bus_id, 2, conn=conn)
+        raise RuntimeError('rejected')
+
+    with pytest.raises(RuntimeError):
+        writes.call(BUS, move_then_fail, BUS)
+    assert dbm.get_bus_state(BUS).as_dict() == before
+
+    writes.call(BUS, dbm.set_bus_to_stop, BUS, 2)
+    assert dbm.get_bus_state(BUS).stop_index == 2
@@ -0,0 +1,43 @@
+"""Stop-detection regression checks: a seeded trace replays to a recorded timeline"""
+import json
+import os
+
+import replay
+import tracegen
+from conftest import small_trace
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TIMELINE = os.path.join(DATA, 'timeline_seed3.jsonl')
+
+
+def write_trace(path) -> str:
+    with open(path, 'w') as f:
+        tracegen.write_jsonl(iter(small_trace(seed=3)), f)
+    return str(path)
+
+
+def test_seeded_trace_matches_recorded_timeline(scratch):
+    trace = write_trace(scratch / 'trace.jsonl')
+    events = scratch / 'events.jsonl'
+
+    assert replay.main([trace, '--expect', TIMELINE, '--events', str(events)]) == 0
+
+    # Every bus arrives at each stop of the route in order and leaves all but the last
+    timeline = list(replay.read_trace(str(events)))
+    seqs = [stop[3] for stop in tracegen.load_route()]
+    for bus_id in ('S1/A', 'S2/A'):
+        arrivals = [e['stop_index'] for e in timeline if e['bus_id'] == bus_id and e['event'] == 'arrived']
+        departures = [e['stop_index'] for e in timeline if e['bus_id'] == bus_id and e['event'] == 'departing']
+        assert arrivals == seqs
+        assert departures == seqs[:-1]
+
+
+def test_expect_fails_on_a_changed_timeline(scratch):
+    trace = write_trace(scratch / 'trace.jsonl')
+    with open(TIMELINE) as f:
+        expected = [json.loads(line) for line in f]
+    expected[5]['stop_index'] += 1
+    changed = scratch / 'changed.jsonl'
+    changed.write_text(''.join(json.dumps(e) + '\n' for e in expected))
+
+    assert replay.main([trace, '--expect', str(changed)]) == 1
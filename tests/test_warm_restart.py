@@ -0,0 +1,48 @@
+"""Workers SIGKILLed mid-trace must carry on from their snapshots as if never killed"""
+from typing import Any, Dict, List
+
+import pytest
+
+import db as dbm
+import replay
+from conftest import small_trace
+
+TIMELINE_KEYS = ('t', 'bus_id', 'event', 'stop_index')
+STATE_KEYS = ('bus_id', 'stop_index', 'lat', 'lon', 'status', 'location_source', 'trip_id')
+
+
+def timeline(result: replay.ReplayResult) -> List[Dict[str, Any]]:
+    return [{k: event[k] for k in TIMELINE_KEYS} for event in result.events]
+
+
+def bus_states(db_path: str) -> List[Dict[str, Any]]:
+    """Every bus's committed state in a replayed database (timestamps differ run to run)"""
+    dbm.DB_PATH = db_path
+    dbm.invalidate_bus_state()
+    return sorted(({k: row[k] for k in STATE_KEYS} for row in dbm.get_all_bus_states()),
+                  key=lambda state: state['bus_id'])
+
+
+@pytest.mark.parametrize('snapshot_every', [10.0, 300.0])
+def test_killed_workers_match_uninterrupted_run(scratch, snapshot_every):
+    # Snapshots every 300 s leave minutes of changes to the journal alone
+    rows = small_trace()
+    kill_at = rows[len(rows) // 2]['t']
+
+    baseline = replay.replay(iter(rows), db_path=str(scratch / 'baseline.db'))
+    expected_state = bus_states(str(scratch / 'baseline.db'))
+    killed = replay.replay_killed(iter(rows), kill_at, processes=2, db_path=str(scratch / 'killed.db'),
+                                  snapshot_every=snapshot_every)
+
+    assert killed.restarted_at is not None and killed.restarted_at >= kill_at
+    assert timeline(killed) == timeline(baseline)
+    assert bus_states(str(scratch / 'killed.db')) == expected_state
+
+
+def test_killed_run_counts_every_response(scratch):
+    rows = small_trace()
+    killed = replay.replay_killed(iter(rows), rows[len(rows) // 3]['t'], processes=1)
+
+    assert killed.fixes == len(rows)
+    assert sum(killed.status_counts.values()) == len(rows)
+    assert killed.cpu_seconds > 0
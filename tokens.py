@@ -0,0 +1,130 @@
+"""Stateless signed session tokens (``AUTH_MODE=token``).
+
+A token carries everything a request needs to authorize itself - username,
+role, bus id and expiry - so any worker can verify it without a lookup in
+``active_sessions`` and without rewriting the cookie::
+
+    <payload>.<signature>
+
+``payload`` is the base64url (unpadded) compact JSON
+``{"u": username, "r": role, "b": bus_id, "x": expires, "j": token id}``
+and ``signature`` the first 16 bytes of its HMAC-SHA256, also base64url.
+The key is derived from the Flask secret key, so rotating that secret logs
+everyone out. Signatures are compared with ``hmac.compare_digest``.
+
+Logging out revokes the token id until its expiry: the id is added to this
+process's revocation set and to the ``revoked_tokens`` table, which every
+worker reloads periodically (``AUTH_REVOCATION_SYNC_SECONDS``). With
+``AUTH_REVOCATION=0`` nothing is looked up at all and logout only drops the
+cookie.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time as time_module
+from typing import Any, Dict, Optional
+
+import db as dbm
+import metrics
+
+TOKEN_TTL = float(os.environ.get("AUTH_TOKEN_TTL", str(7 * 24 * 3600)))  # seconds
+SIGNATURE_BYTES = 16
+REVOCATION_ENABLED = os.environ.get("AUTH_REVOCATION", "1") == "1"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class RevocationList:
+    """Ids of logged-out tokens that have not expired yet"""
+
+    def __init__(self) -> None:
+        self._revoked: Dict[str, float] = {}  # token id -> expires
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def revoke(self, token_id: str, expires: float) -> None:
+        with self._lock:
+            self._revoked[token_id] = expires
+        dbm.revoke_token(token_id, expires)
+
+    def refresh(self, now: Optional[float] = None) -> int:
+        """Reload revocations from the database (other workers' logouts)"""
+        now = time_module.time() if now is None else now
+        revoked = dbm.get_revoked_tokens(now)
+        with self._lock:
+            self._revoked = revoked
+            self._loaded = True
+        return len(revoked)
+
+    def prune(self, now: Optional[float] = None) -> int:
+        return dbm.prune_revoked_tokens(time_module.time() if now is None else now)
+
+    def __contains__(self, token_id: str) -> bool:
+        if not self._loaded:
+            self.refresh()
+        return token_id in self._revoked
+
+    def clear(self) -> None:
+        with self._lock:
+            self._revoked.clear()
+            self._loaded = False
+
+
+class TokenSigner:
+    def __init__(self, secret: str, ttl: float = TOKEN_TTL,
+                 revocations: Optional[RevocationList] = None) -> None:
+        # A key of its own, so a token can never pass as a Flask session cookie
+        self._key = hmac.new(secret.encode('utf-8'), b'bus-tracker-token', hashlib.sha256).digest()
+        self.ttl = ttl
+        self.revocations = revocations
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+    def issue(self, username: str, role: str, bus_id: Optional[str] = None,
+              now: Optional[float] = None) -> str:
+        now = time_module.time() if now is None else now
+        claims = {'u': username, 'r': role, 'x': int(now + self.ttl), 'j': secrets.token_urlsafe(9)}
+        if bus_id is not None:
+            claims['b'] = bus_id
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        return f"{payload}.{_b64encode(self._sign(payload.encode('ascii')))}"
+
+    def verify(self, token: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """The token's user (username, role, bus_id, expires, token_id), or None"""
+        payload, _, signature = token.partition('.')
+        try:
+            expected = self._sign(payload.encode('ascii'))
+            valid = hmac.compare_digest(expected, _b64decode(signature))
+        except (ValueError, UnicodeEncodeError):
+            valid = False
+        if not valid:
+            metrics.incr('auth.token.invalid')
+            return None
+        claims = json.loads(_b64decode(payload))
+        now = time_module.time() if now is None else now
+        if claims['x'] <= now:
+            metrics.incr('auth.token.expired')
+            return None
+        if self.revocations is not None and claims['j'] in self.revocations:
+            metrics.incr('auth.token.revoked')
+            return None
+        return {'username': claims['u'], 'role': claims['r'], 'bus_id': claims.get('b'),
+                'expires': claims['x'], 'token_id': claims['j']}
+
+    def revoke(self, user: Dict[str, Any]) -> None:
+        if self.revocations is not None:
+            self.revocations.revoke(user['token_id'], user['expires'])
+
+
+revocations = RevocationList()
@@ -0,0 +1,204 @@
+"""Deterministic synthetic GPS traces for a fleet of buses.
+
+Given a route (ordered stops) this produces seeded fixes for many buses and
+their students, with configurable GPS noise, accuracy distribution, dropouts,
+dwell at stops and speed profiles. Rows are written as JSONL in the format
+read by ``replay.py`` and are streamed in time order: only one pending row
+per bus is held in memory, regardless of fleet size or trace length.
+
+Usage:
+    python tracegen.py --buses 200 --students-per-bus 20 --seed 7 -o fleet.jsonl
+"""
+import argparse
+import heapq
+import json
+import random
+import sys
+from math import cos, radians
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import db as dbm
+
+METERS_PER_DEGREE = 111320.0
+
+Stop = Tuple[str, float, float, int]
+
+
+def load_route(path: Optional[str] = None) -> List[Stop]:
+    """Load stops from a JSON file (list of [name, lat, lon, seq]) or use SEED_STOPS"""
+    if path is None:
+        stops = list(dbm.SEED_STOPS)
+    else:
+        with open(path) as f:
+            stops = [tuple(s) if isinstance(s, list) else (s['name'], s['lat'], s['lon'], s['seq'])
+                     for s in json.load(f)]
+    # Stable sort keeps the listed order for stops sharing a seq value
+    return sorted(stops, key=lambda s: s[3])
+
+
+def offset_point(lat: float, lon: float, north_m: float, east_m: float) -> Tuple[float, float]:
+    """Move a point by a number of meters north and east"""
+    dlat = north_m / METERS_PER_DEGREE
+    dlon = east_m / (METERS_PER_DEGREE * cos(radians(lat)))
+    return lat + dlat, lon + dlon
+
+
+class BusMotion:
+    """Position of one bus along the route over time.
+
+    The bus dwells at each stop, accelerates away from it and slows down
+    approaching the next one (a trapezoidal speed profile), then finishes
+    at the last stop.
+    """
+
+    def __init__(self, route: Sequence[Stop], rng: random.Random, speed_kmh: float,
+                 speed_jitter: float, dwell_range: Tuple[float, float], ramp_m: float) -> None:
+        self.route = route
+        self.rng = rng
+        self.cruise = max(1.0, rng.gauss(speed_kmh, speed_kmh * speed_jitter)) / 3.6
+        self.dwell_range = dwell_range
+        self.ramp_m = ramp_m
+        self.segment = 0
+        self.travelled = 0.0
+        self.dwell_left = rng.uniform(*dwell_range)
+        self.lengths = [
+            dbm.calculate_distance(a[1], a[2], b[1], b[2]) for a, b in zip(route, route[1:])
+        ]
+
+    @property
+    def finished(self) -> bool:
+        return self.segment >= len(self.lengths)
+
+    def position(self) -> Tuple[float, float]:
+        if self.finished:
+            last = self.route[-1]
+            return last[1], last[2]
+        a, b = self.route[self.segment], self.route[self.segment + 1]
+        frac = self.travelled / self.lengths[self.segment] if self.lengths[self.segment] else 1.0
+        return a[1] + (b[1] - a[1]) * frac, a[2] + (b[2] - a[2]) * frac
+
+    def advance(self, dt: float) -> None:
+        while dt > 0 and not self.finished:
+            if self.dwell_left > 0:
+                used = min(dt, self.dwell_left)
+                self.dwell_left -= used
+                dt -= used
+                continue
+            length = self.lengths[self.segment]
+            remaining = length - self.travelled
+            edge = min(self.travelled, remaining)
+            speed = self.cruise * max(0.2, min(1.0, edge / self.ramp_m)) if self.ramp_m else self.cruise
+            step = speed * dt
+            if step >= remaining:
+                dt -= remaining / speed
+                self.segment += 1
+                self.travelled = 0.0
+                self.dwell_left = self.rng.uniform(*self.dwell_range)
+            else:
+                self.travelled += step
+                dt = 0
+
+
+def bus_trace(bus_id: str, route: Sequence[Stop], seed: int, start: float,
+              students: int = 10, driver_interval: float = 1.0, student_interval: float = 3.0,
+              speed_kmh: float = 30.0, speed_jitter: float = 0.15,
+              dwell_range: Tuple[float, float] = (15.0, 45.0), ramp_m: float = 150.0,
+              accuracy_median: float = 8.0, accuracy_spread: float = 0.5,
+              dropout: float = 0.05, noise_scale: float = 0.5) -> Iterator[Dict[str, Any]]:
+    """Yield the fixes of one bus (driver plus students) in time order"""
+    rng = random.Random(f"{seed}:{bus_id}")
+    motion = BusMotion(route, rng, speed_kmh, speed_jitter, dwell_range, ramp_m)
+
+    # (next report time, user_id, user_type, interval, rng)
+    reporters = [(start, f"{bus_id}:driver", 'driver', driver_interval,
+                  random.Random(f"{seed}:{bus_id}:driver"))]
+    for n in range(students):
+        user_rng = random.Random(f"{seed}:{bus_id}:student{n}")
+        reporters.append((start + user_rng.uniform(0, student_interval),
+                          f"{bus_id}:student{n}", 'student', student_interval, user_rng))
+    heapq.heapify(reporters)
+
+    now = start
+    while reporters:
+        t, user_id, user_type, interval, user_rng = heapq.heappop(reporters)
+        motion.advance(t - now)
+        now = t
+        if user_rng.random() >= dropout:
+            accuracy = accuracy_median * user_rng.lognormvariate(0, accuracy_spread)
+            sigma = accuracy * noise_scale
+            lat, lon = offset_point(*motion.position(), user_rng.gauss(0, sigma), user_rng.gauss(0, sigma))
+            yield {
+                't': round(t, 3),
+                'bus_id': bus_id,
+                'user_id': user_id,
+                'user_type': user_type,
+                'lat': round(lat, 7),
+                'lon': round(lon, 7),
+                'accuracy': round(accuracy, 1),
+            }
+        if not motion.finished:
+            heapq.heappush(reporters, (t + interval, user_id, user_type, interval, user_rng))
+
+
+def fleet_trace(route: Sequence[Stop], buses: int = 10, seed: int = 0,
+                stagger: float = 600.0, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+    """Merge per-bus traces into a single time-ordered stream.
+
+    Bus ids follow the ``S<n>/A`` pattern, so bus 1 is the default bus.
+    ``stagger`` spreads the departure of buses over that many seconds.
+    """
+    rng = random.Random(seed)
+    streams = [
+        bus_trace(f"S{i + 1}/A", route, seed, rng.uniform(0, stagger), **kwargs)
+        for i in range(buses)
+    ]
+    return heapq.merge(*streams, key=lambda row: row['t'])
+
+
+def write_jsonl(rows: Iterator[Dict[str, Any]], out) -> int:
+    count = 0
+    for row in rows:
+        out.write(json.dumps(row, separators=(',', ':')) + '\n')
+        count += 1
+    return count
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic fleet GPS trace (JSONL)")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: stdout)")
+    parser.add_argument('--route', default=None, help="JSON list of [name, lat, lon, seq] stops")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--buses', type=int, default=10)
+    parser.add_argument('--students-per-bus', type=int, default=10)
+    parser.add_argument('--stagger', type=float, default=600.0, help="seconds over which buses depart")
+    parser.add_argument('--driver-interval', type=float, default=1.0)
+    parser.add_argument('--student-interval', type=float, default=3.0)
+    parser.add_argument('--speed-kmh', type=float, default=30.0, help="median cruise speed")
+    parser.add_argument('--speed-jitter', type=float, default=0.15, help="relative spread of cruise speed")
+    parser.add_argument('--dwell', type=float, nargs=2, default=(15.0, 45.0), metavar=('MIN', 'MAX'))
+    parser.add_argument('--ramp', type=float, default=150.0, help="meters to accelerate/brake")
+    parser.add_argument('--accuracy', type=float, default=8.0, help="median reported accuracy (m)")
+    parser.add_argument('--accuracy-spread', type=float, default=0.5, help="lognormal sigma of accuracy")
+    parser.add_argument('--noise', type=float, default=0.5, help="position noise as a fraction of accuracy")
+    parser.add_argument('--dropout', type=float, default=0.05, help="probability a fix is lost")
+    args = parser.parse_args(argv)
+
+    rows = fleet_trace(
+        load_route(args.route), buses=args.buses, seed=args.seed, stagger=args.stagger,
+        students=args.students_per_bus, driver_interval=args.driver_interval,
+        student_interval=args.student_interval, speed_kmh=args.speed_kmh,
+        speed_jitter=args.speed_jitter, dwell_range=tuple(args.dwell), ramp_m=args.ramp,
+        accuracy_median=args.accuracy, accuracy_spread=args.accuracy_spread,
+        dropout=args.dropout, noise_scale=args.noise,
+    )
+    if args.output == '-':
+        count = write_jsonl(rows, sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            count = write_jsonl(rows, f)
+    print(f"wrote {count} fixes", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
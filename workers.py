@@ -0,0 +1,235 @@
+"""Process pool for CPU-bound per-bus work (partitioned replays, cluster rebuilds).
+
+Python code holding the GIL - rebuilding a bus's clusters from scratch,
+replaying a trace - doesn't get faster with threads. ``WorkerPool(n)`` runs
+such tasks in n separate processes (0: run inline in the caller). Buses are
+partitioned across the processes by the same stable crc32 hash the database
+shards use, so one bus's tasks always land on the same process, in
+submission order.
+
+A task is named ``"module:function"`` and imported inside the worker, so
+only the name and plain arguments cross the process boundary. Fix batches
+travel as ``pack_fixes()`` blobs - a few packed arrays rather than a list
+of dicts - which keeps pickling cheap. ``submit()`` returns a Future that a
+collector thread resolves when the worker answers; if a worker dies, its
+pending futures fail and it is restarted.
+"""
+import importlib
+import logging
+import multiprocessing
+import queue
+import struct
+import threading
+import zlib
+from array import array
+from concurrent.futures import Future
+from itertools import count
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TASK_TIMEOUT = 30.0  # seconds callers wait for a task's result
+
+# One fix as packed by pack_fixes(): (id, lat, lon, accuracy, is_driver)
+Fix = Tuple[int, float, float, float, bool]
+
+
+def partition(bus_id: str, partitions: int) -> int:
+    """Stable partition of a bus (crc32, as for the database shards)"""
+    if partitions <= 1:
+        return 0
+    return zlib.crc32(bus_id.encode('utf-8')) % partitions
+
+
+def pack_fixes(fixes: Iterable[Fix]) -> bytes:
+    """Encode fixes as a count followed by packed id, lat, lon, accuracy and driver-flag arrays"""
+    ids, lats, lons, accs = array('q'), array('d'), array('d'), array('d')
+    drivers = bytearray()
+    for fix_id, lat, lon, accuracy, is_driver in fixes:
+        ids.append(fix_id)
+        lats.append(lat)
+        lons.append(lon)
+        accs.append(accuracy)
+        drivers.append(1 if is_driver else 0)
+    return b''.join((struct.pack('<I', len(ids)), ids.tobytes(), lats.tobytes(),
+                     lons.tobytes(), accs.tobytes(), bytes(drivers)))
+
+
+def unpack_fixes(blob: bytes) -> Tuple[array, array, array, array, bytes]:
+    """The (ids, lats, lons, accuracies, driver flags) arrays of a pack_fixes() blob"""
+    n = struct.unpack_from('<I', blob)[0]
+    offset = 4
+    columns = []
+    for typecode in 'qddd':
+        column = array(typecode)
+        column.frombytes(blob[offset:offset + 8 * n])
+        columns.append(column)
+        offset += 8 * n
+    return columns[0], columns[1], columns[2], columns[3], blob[offset:offset + n]
+
+
+_resolved: Dict[str, Callable[..., Any]] = {}
+
+
+def resolve(task: str) -> Callable[..., Any]:
+    fn = _resolved.get(task)
+    if fn is None:
+        module, _, name = task.partition(':')
+        fn = _resolved[task] = getattr(importlib.import_module(module), name)
+    return fn
+
+
+def run_batch(task: str, items: List[Tuple[str, tuple]]) -> List[Tuple[str, bool, Any]]:
+    """Run one task over many buses' arguments; failures are returned, not raised"""
+    fn = resolve(task)
+    results = []
+    for key, args in items:
+        try:
+            results.append((key, True, fn(*args)))
+        except Exception as e:
+            results.append((key, False, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _serve(inbox: "multiprocessing.Queue", outbox: "multiprocessing.Queue") -> None:
+    """Worker process main loop: run tasks until a None arrives"""
+    while True:
+        job = inbox.get()
+        if job is None:
+            return
+        seq, task, args = job
+        try:
+            outbox.put((seq, True, resolve(task)(*args)))
+        except Exception as e:
+            outbox.put((seq, False, f"{type(e).__name__}: {e}"))
+
+
+class TaskError(Exception):
+    """A task raised in its worker process (the message carries the original error)"""
+
+
+class WorkerPool:
+    def __init__(self, processes: int, start_method: str = 'spawn') -> None:
+        self.processes = processes
+        # spawn: forking a process with live threads (writer, scheduler) is unsafe
+        self._context = multiprocessing.get_context(start_method)
+        self._inboxes: List[Any] = []
+        self._procs: List[Any] = []
+        self._outbox: Any = None
+        self._pending: Dict[int, Tuple[int, Future]] = {}  # seq -> (worker, future)
+        self._seq = count()
+        self._collector: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return max(self.processes, 0)
+
+    def _start_worker(self, index: int) -> None:
+        proc = self._context.Process(target=_serve, args=(self._inboxes[index], self._outbox),
+                                     name=f"bus-worker-{index}", daemon=True)
+        proc.start()
+        self._procs[index] = proc
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._collector is not None:
+                return
+            self._outbox = self._context.Queue()
+            self._inboxes = [self._context.Queue() for _ in range(self.processes)]
+            self._procs = [None] * self.processes
+            for index in range(self.processes):
+                self._start_worker(index)
+            self._collector = threading.Thread(target=self._collect, name="worker-results", daemon=True)
+            self._collector.start()
+        logger.info(f"Started {self.processes} worker processes")
+
+    # --- submitting ---------------------------------------------------------
+    def submit(self, bus_id: str, task: str, *args: Any) -> Future:
+        """Run ``task(*args)`` on the process that owns bus_id"""
+        return self.submit_to(partition(bus_id, self.size), task, *args)
+
+    def submit_to(self, index: int, task: str, *args: Any) -> Future:
+        """Run ``task(*args)`` on worker ``index`` (a whole partition's work)"""
+        future: Future = Future()
+        if self.size == 0:
+            # Inline mode: run in the caller, as without a pool
+            try:
+                future.set_result(resolve(task)(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._ensure_started()
+        seq = next(self._seq)
+        with self._lock:
+            self._pending[seq] = (index, future)
+        self._inboxes[index].put((seq, task, args))
+        metrics.incr('workers.submitted')
+        return future
+
+    def map_buses(self, task: str, args_by_bus: Dict[str, tuple],
+                  timeout: float = TASK_TIMEOUT) -> Dict[str, Any]:
+        """Run ``task`` for every bus, one message per partition; bus -> result or TaskError"""
+        parts: Dict[int, List[Tuple[str, tuple]]] = {}
+        for bus_id, args in args_by_bus.items():
+            parts.setdefault(partition(bus_id, self.size), []).append((bus_id, args))
+        futures = [self.submit_to(index, 'workers:run_batch', task, items) for index, items in parts.items()]
+        results: Dict[str, Any] = {}
+        for future in futures:
+            for bus_id, ok, value in future.result(timeout):
+                results[bus_id] = value if ok else TaskError(value)
+        return results
+
+    # --- results --------------------------------------------------------------
+    def _collect(self) -> None:
+        while not self._closed:
+            try:
+                seq, ok, value = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                return  # queue torn down by close()
+            with self._lock:
+                _, future = self._pending.pop(seq, (None, None))
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                metrics.incr('workers.failed')
+                future.set_exception(TaskError(value))
+
+    def _check_workers(self) -> None:
+        """Fail the pending tasks of dead workers and restart them"""
+        for index, proc in enumerate(self._procs):
+            if proc is None or proc.is_alive() or self._closed:
+                continue
+            logger.error(f"Worker process {index} exited with {proc.exitcode}; restarting")
+            metrics.incr('workers.restarted')
+            with self._lock:
+                lost = [seq for seq, (owner, _) in self._pending.items() if owner == index]
+                futures = [self._pending.pop(seq)[1] for seq in lost]
+            for future in futures:
+                future.set_exception(TaskError(f"worker {index} died"))
+            try:
+                self._start_worker(index)
+            except Exception as e:
+                # Keep collecting for the other workers; retried on the next check
+                logger.error(f"Could not restart worker process {index}: {e}")
+
+    def close(self) -> None:
+        if self._collector is None:
+            return
+        self._closed = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._collector.join(timeout=2)
+        self._collector = None
+        self._closed = False
+
@@ -0,0 +1,175 @@
+"""Write-behind queue drained by a single writer thread.
+
+Request handlers submit write intents - a db write helper plus its
+arguments - instead of opening their own connection and committing. One
+writer thread per process drains the bounded queue, runs each batch in a
+single transaction per shard (a savepoint per intent keeps one bad write
+from failing the rest) and resolves a Future per intent once committed.
+Handlers that need the result wait on the future; the rest fire and forget.
+
+When the queue is full ``submit`` raises QueueFull so the caller can answer
+429 instead of piling up latency.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time as time_module
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import db as dbm
+import metrics
+from admission import admission
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_SIZE = int(os.environ.get("BUS_WRITE_QUEUE_SIZE", "1000"))
+WRITE_BATCH_SIZE = int(os.environ.get("BUS_WRITE_BATCH_SIZE", "64"))
+WRITE_TIMEOUT = 10.0  # seconds a handler waits for its write to commit
+
+
+class QueueFull(Exception):
+    """The write queue is at capacity; the caller should back off"""
+
+
+# (shard path, fn, args, kwargs, future, enqueue time)
+Intent = Tuple[str, Callable[..., Any], tuple, dict, Future, float]
+
+
+class WriteQueue:
+    def __init__(self, maxsize: int = WRITE_QUEUE_SIZE, batch_size: int = WRITE_BATCH_SIZE,
+                 threaded: bool = True) -> None:
+        self.batch_size = batch_size
+        self.threaded = threaded
+        self._queue: "queue.Queue[Intent]" = queue.Queue(maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, bus_id: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """Queue ``fn(*args, conn=<shard connection>, **kwargs)`` for the writer"""
+        return self.submit_shard(dbm.shard_path(dbm.shard_index(bus_id)), fn, *args, **kwargs)
+
+    def submit_shard(self, path: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        """Like submit(), for a write addressed to a database file rather than a bus"""
+        future: Future = Future()
+        if not self.threaded:
+            # Inline mode (replay, scripts): run and commit immediately
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((path, fn, args, kwargs, future, time_module.perf_counter()))
+        except queue.Full:
+            metrics.incr('write_queue.rejected')
+            raise QueueFull()
+        metrics.set_gauge('write_queue.depth', self._queue.qsize())
+        return future
+
+    def call(self, bus_id: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Submit a write and wait for its committed result"""
+        return self.submit(bus_id, fn, *args, **kwargs).result(WRITE_TIMEOUT)
+
+    def call_shard(self, path: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return self.submit_shard(path, fn, *args, **kwargs).result(WRITE_TIMEOUT)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self) -> None:
+        # Started lazily so each forked gunicorn worker gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    # _run() doesn't let errors escape, but don't leave
+                    # callers waiting out WRITE_TIMEOUT if it ever dies
+                    logger.error("Writer thread died; restarting it")
+                    metrics.incr('write_queue.restarts')
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        conns: Dict[str, sqlite3.Connection] = {}
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            metrics.set_gauge('write_queue.depth', self._queue.qsize())
+            metrics.observe('write_queue.batch_size', len(batch))
+
+            by_shard: Dict[str, List[Intent]] = {}
+            for intent in batch:
+                by_shard.setdefault(intent[0], []).append(intent)
+            for path, intents in by_shard.items():
+                try:
+                    conn = conns.get(path)
+                    if conn is None:
+                        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+                        conn.row_factory = sqlite3.Row
+                        conns[path] = conn
+                    self._apply(conn, intents)
+                except Exception as e:
+                    # Can't open the file, or the connection broke mid-rollback:
+                    # fail these intents now and reconnect on the next batch
+                    metrics.incr('write_queue.errors', len(intents))
+                    logger.error(f"Writer could not use {path}: {e}")
+                    stale = conns.pop(path, None)
+                    if stale is not None:
+                        stale.close()
+                    for intent in intents:
+                        if not intent[4].done():
+                            intent[4].set_exception(e)
+
+    def _apply(self, conn: sqlite3.Connection, intents: List[Intent]) -> None:
+        started = time_module.perf_counter()
+        # The oldest intent's wait is the load signal for admission control
+        admission.observe_delay((started - intents[0][5]) * 1000)
+        outcomes: List[Tuple[Future, bool, Any]] = []
+        # In-memory mirrors are only updated once the batch has committed
+        pending = dbm.defer_mirror()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for _, fn, args, kwargs, future, enqueued in intents:
+                metrics.observe('write_queue.wait_ms', (started - enqueued) * 1000)
+                mark = len(pending)
+                conn.execute("SAVEPOINT intent")
+                try:
+                    outcomes.append((future, True, fn(*args, conn=conn, **kwargs)))
+                    conn.execute("RELEASE intent")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO intent")
+                    conn.execute("RELEASE intent")
+                    del pending[mark:]
+                    metrics.incr('write_queue.errors')
+                    logger.error(f"Write intent {fn.__name__} failed: {e}")
+                    outcomes.append((future, False, e))
+            conn.execute("COMMIT")
+            dbm.publish_mirror()
+        except Exception as e:
+            # The transaction as a whole failed (e.g. lock timeout)
+            dbm.discard_mirror()
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            metrics.incr('write_queue.errors', len(intents))
+            logger.error(f"Write batch of {len(intents)} failed: {e}")
+            outcomes = [(intent[4], False, e) for intent in intents]
+
+        metrics.observe('write_queue.commit_ms', (time_module.perf_counter() - started) * 1000)
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+writes = WriteQueue(threaded=os.environ.get("BUS_WRITE_BEHIND", "1") == "1")
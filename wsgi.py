@@ -1,4 +1,27 @@
+import time
+
+_started = time.perf_counter()
+
+import metrics
+import migrations
+import app as app_module
 from app import app as application
 
+# Migrate once per process at startup; a no-op when the schema is current
+_migrate_started = time.perf_counter()
+_applied = migrations.migrate_all()
+_migrated = time.perf_counter()
+metrics.set_gauge('startup.migrate_ms', (_migrated - _migrate_started) * 1000)
+
+# Pick up tracking mid-route after a restart (see snapshot.py)
+_warm = app_module.warm_start()
+_now = time.perf_counter()
+metrics.set_gauge('startup.total_ms', (_now - _started) * 1000)
+application.logger.info(
+    f"Started in {(_now - _started) * 1000:.1f} ms "
+    f"({sum(_applied.values())} migration(s) applied in {(_migrated - _migrate_started) * 1000:.1f} ms, "
+    f"{'warm' if _warm else 'cold'} start)"
+)
+
 if __name__ == '__main__':
-    application.run()
\ No newline at end of file
+    application.run()